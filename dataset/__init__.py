@@ -1 +1 @@
-__all__ = ['attempts', 'keys', 'event_registry', 'manifest', 'utils', 'dataset']
+__all__ = ['attempts', 'keys', 'inventory_cache', 'key_index', 'job_state', 'chunk_writer', 'spark_json', 'event_registry', 'manifest', 'utils', 'dataset']
@@ -4,7 +4,7 @@ import boto3
 from dataset.utils import encode_array, encode_json, prune_fields
 from dataset.lookup import determine_student_id
 
-def attempts_handler(bucket_key, context, excluded_indices):
+def attempts_handler(bucket_key, context, excluded_indices, s3_client=None):
     """
     Entry point for attempts extraction. Any exception is swallowed so the
     Spark job cannot be aborted by a bad record or failed download.
@@ -13,8 +13,9 @@ def attempts_handler(bucket_key, context, excluded_indices):
         # Use the key to read in the file contents, split on line endings
         bucket_name, key = bucket_key
 
-        # Create a session using the specified profile
-        s3_client = boto3.client('s3')
+        # Create a session using the specified profile, unless one is shared with us
+        if s3_client is None:
+            s3_client = boto3.client('s3')
 
         response = s3_client.get_object(Bucket=bucket_name, Key=key)
 
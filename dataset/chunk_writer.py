@@ -0,0 +1,215 @@
+import io
+
+from dataset.datashop import problem_units
+
+# A streaming writer for DataShop XML chunks. Messages are written to the current chunk as they
+# are rendered, and the chunk is uploaded to S3 as it fills: once a chunk holds more than a part
+# of data, a multipart upload is started and each full part is uploaded and dropped. The writer
+# so only ever holds one part of one chunk, however large the export.
+#
+# Chunks are written as save_xml_chunk writes them, as the chunk prefix, the messages and the
+# chunk suffix joined by newlines, and named {chunk_name}_{n}.xml under the target prefix. A
+# chunk that never grows past a part is uploaded with a single put_object when it is closed.
+#
+# Chunks are cut either every max_messages messages, or with max_bytes by their encoded size:
+# the messages are then written a problem at a time (see problem_units), and a new chunk is
+# started whenever the next problem would take the chunk past max_bytes, so a problem is never
+# split across chunks. A problem larger than max_bytes gets a chunk of its own.
+#
+# Messages that failed to render are None; they are reported, counted in skipped_messages and
+# left out, as a failed message must not cost the rest of its chunk.
+#
+# A failed upload abandons the chunk, aborting its multipart upload. By default the error is
+# raised; with on_error, it is passed to on_error(chunk_index, error) instead and the rest of
+# the chunk's messages are discarded, so the writer carries on with the next chunk, which takes
+# the failed chunk's name.
+
+# S3 requires every part of a multipart upload but the last to be at least 5 MiB
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+
+class XmlChunkWriter:
+    """
+    Writes messages to XML chunks, cut every max_messages messages or, with max_bytes, by size.
+    Use extend() for each session's messages, and close() (or a with block) to finish the last
+    chunk. The key, messages and bytes of each chunk written are listed in chunks.
+    """
+
+    def __init__(self, s3_client, bucket_name, target_prefix, chunk_prefix, chunk_suffix, max_messages,
+                 part_size=DEFAULT_PART_SIZE, max_bytes=None, chunk_name="chunk", on_error=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.target_prefix = target_prefix
+        self.chunk_prefix = chunk_prefix.encode('utf-8')
+        self.chunk_suffix = ('\n' + chunk_suffix).encode('utf-8')
+        self.max_messages = max_messages
+        self.part_size = part_size
+        self.max_bytes = max_bytes
+        self.chunk_name = chunk_name
+        self.on_error = on_error
+
+        self.chunks = []
+        self.skipped_messages = 0
+        self.chunk_key = None
+        self.chunk_messages = 0
+        self.chunk_bytes = 0
+        self.buffer = io.BytesIO()
+        self.upload_id = None
+        self.parts = []
+        self.failed = False
+
+    @property
+    def chunk_keys(self):
+        return [chunk["key"] for chunk in self.chunks]
+
+    @property
+    def number_of_chunks(self):
+        return len(self.chunks)
+
+    def write(self, message):
+        if message is None:
+            self.skip_messages(1)
+            return
+
+        if self.chunk_key is not None and self.chunk_messages >= self.max_messages:
+            self.finish_chunk()
+
+        self.write_messages([('\n' + message).encode('utf-8')])
+
+    def extend(self, messages):
+        """Write messages that start at a problem, such as all of a session's messages."""
+        messages = list(messages)
+        rendered = [message for message in messages if message is not None]
+        if len(rendered) < len(messages):
+            self.skip_messages(len(messages) - len(rendered))
+        messages = rendered
+
+        if self.max_bytes is None:
+            for message in messages:
+                self.write(message)
+            return
+
+        for unit in problem_units(messages):
+            self.write_unit(unit)
+
+    def skip_messages(self, count):
+        self.skipped_messages += count
+        print(f"Skipping {count} messages that failed to render")
+
+    def write_unit(self, messages):
+        """Write messages that must not be split, starting a new chunk first if they do not fit."""
+        encoded = [('\n' + message).encode('utf-8') for message in messages]
+        unit_bytes = sum(len(message) for message in encoded)
+
+        if self.chunk_key is not None and self.chunk_bytes + unit_bytes + len(self.chunk_suffix) > self.max_bytes:
+            self.finish_chunk()
+
+        self.write_messages(encoded)
+
+    def write_messages(self, encoded_messages):
+        if self.chunk_key is None:
+            self.start_chunk()
+
+        for message in encoded_messages:
+            self.append(message)
+            self.chunk_messages += 1
+
+    def close(self):
+        if self.chunk_key is not None:
+            self.finish_chunk()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def start_chunk(self):
+        self.chunk_key = f'{self.target_prefix}{self.chunk_name}_{len(self.chunks)}.xml'
+        self.chunk_messages = 0
+        self.chunk_bytes = 0
+        self.append(self.chunk_prefix)
+
+    def append(self, data):
+        self.chunk_bytes += len(data)
+        if self.failed:
+            return
+
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_size:
+            self.upload_part()
+
+    def upload_part(self):
+        try:
+            if self.upload_id is None:
+                response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.chunk_key)
+                self.upload_id = response['UploadId']
+
+            part_number = len(self.parts) + 1
+            response = self.s3_client.upload_part(Bucket=self.bucket_name, Key=self.chunk_key, PartNumber=part_number,
+                                                  UploadId=self.upload_id, Body=self.buffer.getvalue())
+            self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+            self.buffer = io.BytesIO()
+        except Exception as e:
+            self.fail(e)
+
+    def finish_chunk(self):
+        self.chunk_bytes += len(self.chunk_suffix)
+        if not self.failed:
+            self.buffer.write(self.chunk_suffix)
+            if self.upload_id is not None:
+                self.upload_part()
+
+        if not self.failed:
+            try:
+                if self.upload_id is None:
+                    self.s3_client.put_object(Bucket=self.bucket_name, Key=self.chunk_key, Body=self.buffer.getvalue())
+                else:
+                    self.s3_client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.chunk_key, UploadId=self.upload_id,
+                                                             MultipartUpload={'Parts': self.parts})
+            except Exception as e:
+                self.fail(e)
+
+        if not self.failed:
+            self.chunks.append({"key": self.chunk_key, "messages": self.chunk_messages, "bytes": self.chunk_bytes})
+        self.reset()
+
+    def fail(self, error):
+        """Abandon the current chunk after a failed upload, raising the error unless there is an on_error."""
+        if self.on_error is None:
+            self.abort()
+            raise error
+
+        self.on_error(len(self.chunks), error)
+        try:
+            self.abort_upload()
+        except Exception:
+            # The upload error was already reported; an upload left incomplete is only storage
+            pass
+        self.failed = True
+        self.buffer = io.BytesIO()
+
+    def abort(self):
+        """Abandon the current chunk, aborting its multipart upload if one was started."""
+        try:
+            self.abort_upload()
+        finally:
+            self.reset()
+
+    def abort_upload(self):
+        if self.upload_id is not None:
+            upload_id, self.upload_id, self.parts = self.upload_id, None, []
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.chunk_key, UploadId=upload_id)
+
+    def reset(self):
+        self.chunk_key = None
+        self.chunk_messages = 0
+        self.chunk_bytes = 0
+        self.buffer = io.BytesIO()
+        self.upload_id = None
+        self.parts = []
+        self.failed = False
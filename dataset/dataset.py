@@ -1,20 +1,36 @@
 from pyspark import SparkContext, SparkConf
 from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
 import boto3
 import pandas as pd
+import pyarrow as pa
 import io
+import functools
+import itertools
 import math
 import os
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
-from dataset.keys import list_keys_from_inventory
-from dataset.utils import parallel_map, prune_fields
+from dataset.keys import list_keys_from_inventory, iter_keys_from_inventory, merge_fresh_keys, iter_fresh_keys, list_keys_for_sections, list_keys_after, spark_inventory_keys
+from dataset.utils import broadcast_context, resolve_context, parallel_map, parallel_map_batches, parallel_records, sorted_groups, task_partitions, parallel_write, distribute_keys, prune_fields
 from dataset.manifest import build_html_manifest, build_json_manifest
 from dataset.event_registry import get_event_config
-from dataset.datashop import handle_datashop, process_jsonl_file, process_part_attempts, process_tutor_messages
+from dataset.datashop import handle_datashop, process_jsonl_file, process_part_attempts, process_tutor_messages, session_key, part_attempt_order
 from dataset.lookup import retrieve_lookup
+from dataset.job_state import JobState
+from dataset.chunk_writer import XmlChunkWriter
+from dataset.spark_json import spark_json_fields, write_event_csv
 
 
+# Every XML chunk should have the <?xml ?> directive and the
+# outermost tutor_related_message_sequence element
+XML_CHUNK_PREFIX = """<?xml version= \"1.0\" encoding= \"UTF-8\"?>
+    <tutor_related_message_sequence version_number= \"4\" xmlns:xsi= \"http://www.w3.org/2001/XMLSchema-instance\" xsi:noNamespaceSchemaLocation= \"http://pslcdatashop.org/dtd/tutor_message_v4.xsd\">
+    """
+XML_CHUNK_SUFFIX = "</tutor_related_message_sequence>"
+
 def generate_datashop(context):
     
     # Initialize the Spark context and S3 client
@@ -23,19 +39,10 @@ def generate_datashop(context):
 
     # Define key parameters
     source_bucket = context["bucket_name"]
-    inventory_bucket = context["inventory_bucket_name"]
     target_prefix = f'{context["job_id"]}/'
     chunk_size = context["chunk_size"]
     section_ids = context["section_ids"]
 
-    # Retrieve matching keys from S3 inventory
-    debug_log(context, "Listing keys from inventory")
-    keys = list_keys_from_inventory(section_ids, "attempt_evaluated", source_bucket, inventory_bucket)
-    
-    debug_log(context, f"Found {len(keys)} keys from inventory")
-    number_of_chunks = calculate_number_of_chunks(len(keys), chunk_size)
-    debug_log(context, f"Calculated number of chunks: {number_of_chunks}")
-
     # Retrieve the datashop lookup context
     lookup = retrieve_lookup(s3_client, context)
 
@@ -43,91 +50,159 @@ def generate_datashop(context):
 
     context['lookup'] = lookup
 
-    
-    # Process keys in chunks, serially
-    all_part_attempts = []
-    for chunk_index, chunk_keys in enumerate(chunkify(keys, chunk_size)):
-        try:
-            # Process keys in parallel to 
-            part_attempts = parallel_map(sc, source_bucket, chunk_keys, process_jsonl_file, context, [])
-            all_part_attempts.extend(part_attempts)
+    # With broadcast_lookup, and always when rendering on the executors, tasks get the lookup
+    # through a broadcast variable
+    task_context = task_context_for(sc, context)
+
+    # The tutor_message keys are listed and processed as the mode requires: written on the
+    # executors, grouped on the cluster, or collected to the driver. Grouped sessions stream in
+    # a partition at a time as they are rendered, unless they are ingested concurrently
+    def ingest_tutor_messages(concurrent=False):
+        tutor_key_chunks, tutor_number_of_chunks = plan_key_chunks(section_ids, "tutor_message", context)
+        if context.get("executor_rendering", False):
+            return write_sessions_on_executors(sc, source_bucket, tutor_key_chunks, task_context, process_tutor_messages, None, "tutor_chunk")
+        if context.get("distributed_sessions", False):
+            if concurrent:
+                return session_groups(sc, source_bucket, tutor_key_chunks, task_context).collect()
+            return distributed_session_groups(sc, source_bucket, tutor_key_chunks, task_context)
+        return collect_key_chunks(sc, source_bucket, tutor_key_chunks, tutor_number_of_chunks, task_context, "tutor chunk")
+
+    # With concurrent_sources, that happens on a second driver thread, whose Spark jobs run
+    # alongside those for the attempt_evaluated keys, instead of after them. The thread lists the
+    # keys and runs the whole job there, collecting even the grouped sessions, so that nothing
+    # is left to do lazily on the main thread. That trades memory for time: with
+    # distributed_sessions, every tutor session is held on the driver at once, where the
+    # sequential path streams them a partition at a time
+    tutor_ingest = None
+    if context.get("concurrent_sources", False):
+        source_executor = ThreadPoolExecutor(max_workers=1)
+        tutor_ingest = source_executor.submit(ingest_tutor_messages, concurrent=True)
+        source_executor.shutdown(wait=False)
+
+    def tutor_messages_ingested():
+        return tutor_ingest.result() if tutor_ingest is not None else ingest_tutor_messages()
 
+    # Retrieve matching keys from S3 inventory
+    debug_log(context, "Listing keys from inventory")
+    key_chunks, number_of_chunks = plan_key_chunks(section_ids, "attempt_evaluated", context)
+    debug_log(context, f"Calculated number of chunks: {number_of_chunks}")
+
+    # With executor_rendering, the sessions are grouped on the cluster and rendered and written
+    # as XML chunks on the executors, and only the chunks' metadata comes back to the driver.
+    # A failed job is reported, and the manifests list the chunks of the jobs that succeeded
+    if context.get("executor_rendering", False):
+        chunk_metadata = []
+        try:
+            chunk_metadata.extend(write_sessions_on_executors(sc, source_bucket, key_chunks, task_context, process_part_attempts, part_attempt_order, "chunk"))
         except Exception as e:
-            print(f"Error processing chunk {chunk_index + 1}/{number_of_chunks}: {e}")
-
-    # partition the all_part_attempts list into a Dict
-    # where the keys are section_id + "_" + user_id, and the 
-    # values are lists of part_attempts
-    partitioned_part_attempts = {}
-    for part_attempt in all_part_attempts:
-        key = str(part_attempt.get('section_id', '')) + "_" + str(part_attempt.get('user_id', '')) + "_" + str(part_attempt.get('session_id', ''))
-        
-        if key not in partitioned_part_attempts:
-            partitioned_part_attempts[key] = []
-        partitioned_part_attempts[key].append(part_attempt)
-
-    # For each key in the partitioned_part_attempts dict, sort the list of part_attempts
-
-    all_results = []
-    for key in partitioned_part_attempts:
-        partitioned_part_attempts[key].sort(key=lambda x: (
-            x.get('page_attempt_guid', ''),
-            x.get('activity_id', ''),
-            x.get('activity_attempt_number', 0),
-            x.get('part_id', ''),
-            x.get('part_attempt_number', 0)
-        ))
-
-        results = process_part_attempts(partitioned_part_attempts[key], context)
-        all_results.extend(results)
-
-    tutor_keys = list_keys_from_inventory(section_ids, "tutor_message", source_bucket, inventory_bucket)
-    tutor_number_of_chunks = calculate_number_of_chunks(len(tutor_keys), chunk_size)
-
-    all_tutor_messages = []
-    for chunk_index, chunk_keys in enumerate(chunkify(tutor_keys, chunk_size)):
+            print(f"Error processing sessions: {e}")
         try:
-            # Process keys in parallel to 
-            part_attempts = parallel_map(sc, source_bucket, chunk_keys, process_jsonl_file, context, [])
-            all_tutor_messages.extend(part_attempts)
-
+            chunk_metadata.extend(tutor_messages_ingested())
         except Exception as e:
-            print(f"Error processing tutor chunk {chunk_index + 1}/{tutor_number_of_chunks}: {e}")
-
-    partitioned_part_attempts = {}
-    for part_attempt in all_tutor_messages:
-        key = str(part_attempt.get('section_id', '')) + "_" + str(part_attempt.get('user_id', '')) + "_" + str(part_attempt.get('session_id', ''))
-        
-        if key not in partitioned_part_attempts:
-            partitioned_part_attempts[key] = []
-        partitioned_part_attempts[key].append(part_attempt)
-
-    for key in partitioned_part_attempts:
-        
-        results = process_tutor_messages(partitioned_part_attempts[key], context)
-        all_results.extend(results)
-
-    # Calculate total number of chunks based on combined results
-    total_number_of_chunks = calculate_number_of_chunks(len(all_results), chunk_size)
-
-    # Every XML chunk should have the <?xml ?> directive and the
-    # outermost tutor_related_message_sequence element
-    chunk_prefix =  """<?xml version= \"1.0\" encoding= \"UTF-8\"?>
-    <tutor_related_message_sequence version_number= \"4\" xmlns:xsi= \"http://www.w3.org/2001/XMLSchema-instance\" xsi:noNamespaceSchemaLocation= \"http://pslcdatashop.org/dtd/tutor_message_v4.xsd\">
-    """
-    chunk_suffix = "</tutor_related_message_sequence>"
+            print(f"Error processing tutor sessions: {e}")
+
+        chunk_keys = [metadata["key"] for metadata in chunk_metadata]
+        debug_log(context, f"Saved {len(chunk_keys)} chunks, {sum(metadata['messages'] for metadata in chunk_metadata)} messages")
+
+        context['lookup'] = {}
+        build_manifests(s3_client, context, len(chunk_keys), "xml", chunk_keys=chunk_keys)
+        sc.stop()
+        return len(chunk_keys)
+
+    # With streaming_xml, the messages are written to XML chunks as they are rendered, instead of
+    # all being held until the end and then chunked. So are they with xml_chunk_bytes, which cuts
+    # the chunks by size without splitting a problem across chunks. As when saving the chunks
+    # at the end, a chunk that fails to upload is reported and skipped, and the others are written
+    streaming_xml = context.get("streaming_xml", False) or context.get("xml_chunk_bytes")
+    if streaming_xml:
+        all_results = XmlChunkWriter(s3_client, context["results_bucket_name"], target_prefix, XML_CHUNK_PREFIX, XML_CHUNK_SUFFIX, chunk_size,
+                                     max_bytes=context.get("xml_chunk_bytes"),
+                                     on_error=lambda chunk_index, e: print(f"Error processing chunk {chunk_index + 1}: {e}"))
+    else:
+        all_results = []
+
+    if context.get("distributed_sessions", False):
+
+        # Group the part attempts by session and sort them on the cluster, taking the sessions
+        # a partition at a time. Every raw part attempt still comes to the driver to be rendered
+        # here; executor_rendering renders and writes them on the executors instead
+        try:
+            for _, part_attempts in distributed_session_groups(sc, source_bucket, key_chunks, task_context, part_attempt_order):
+                all_results.extend(process_part_attempts(part_attempts, context))
+        except Exception as e:
+            print(f"Error processing sessions: {e}")
+    else:
+
+        # Process keys in chunks
+        all_part_attempts = collect_key_chunks(sc, source_bucket, key_chunks, number_of_chunks, task_context, "chunk")
+
+        # partition the all_part_attempts list into a Dict
+        # where the keys are section_id + "_" + user_id + "_" + session_id, and the 
+        # values are lists of part_attempts
+        partitioned_part_attempts = {}
+        for part_attempt in all_part_attempts:
+            key = session_key(part_attempt)
+            
+            if key not in partitioned_part_attempts:
+                partitioned_part_attempts[key] = []
+            partitioned_part_attempts[key].append(part_attempt)
+
+        # For each key in the partitioned_part_attempts dict, sort the list of part_attempts
+        for key in partitioned_part_attempts:
+            partitioned_part_attempts[key].sort(key=part_attempt_order)
+
+            results = process_part_attempts(partitioned_part_attempts[key], context)
+            all_results.extend(results)
 
-    # Process keys in chunks, serially
-    for chunk_index, chunked_results in enumerate(chunkify(all_results, chunk_size)):
+    if context.get("distributed_sessions", False):
         try:
-            chunk_data = [chunk_prefix] + chunked_results + [chunk_suffix]
+            for _, tutor_messages in tutor_messages_ingested():
+                all_results.extend(process_tutor_messages(tutor_messages, context))
+        except Exception as e:
+            print(f"Error processing tutor sessions: {e}")
+    else:
+        all_tutor_messages = tutor_messages_ingested()
+
+        partitioned_part_attempts = {}
+        for part_attempt in all_tutor_messages:
+            key = session_key(part_attempt)
             
-            # Save the collected results as an XML chunk to S3
-            save_xml_chunk(chunk_data, s3_client, target_prefix, chunk_index, results_bucket_name=context["results_bucket_name"])
-            print(f"Successfully processed chunk {chunk_index + 1}/{total_number_of_chunks}")
+            if key not in partitioned_part_attempts:
+                partitioned_part_attempts[key] = []
+            partitioned_part_attempts[key].append(part_attempt)
 
+        try:
+            for key in partitioned_part_attempts:
+                
+                results = process_tutor_messages(partitioned_part_attempts[key], context)
+                all_results.extend(results)
         except Exception as e:
-            print(f"Error processing chunk {chunk_index + 1}/{total_number_of_chunks}: {e}")
+            print(f"Error processing tutor sessions: {e}")
+
+    if streaming_xml:
+
+        # Finish the last chunk; the others were written as they filled
+        all_results.close()
+        total_number_of_chunks = all_results.number_of_chunks
+    else:
+
+        # Calculate total number of chunks based on combined results
+        total_number_of_chunks = calculate_number_of_chunks(len(all_results), chunk_size)
+
+        chunk_prefix = XML_CHUNK_PREFIX
+        chunk_suffix = XML_CHUNK_SUFFIX
+
+        # Process keys in chunks, serially
+        for chunk_index, chunked_results in enumerate(chunkify(all_results, chunk_size)):
+            try:
+                chunk_data = [chunk_prefix] + chunked_results + [chunk_suffix]
+                
+                # Save the collected results as an XML chunk to S3
+                save_xml_chunk(chunk_data, s3_client, target_prefix, chunk_index, results_bucket_name=context["results_bucket_name"])
+                print(f"Successfully processed chunk {chunk_index + 1}/{total_number_of_chunks}")
+
+            except Exception as e:
+                print(f"Error processing chunk {chunk_index + 1}/{total_number_of_chunks}: {e}")
 
     # Build and save JSON and HTML manifests, resetting the lookup so we don't preserve it
     context['lookup'] = {}
@@ -139,6 +214,94 @@ def generate_datashop(context):
     return total_number_of_chunks
 
 
+def session_groups(sc, source_bucket, key_chunks, context, order=None):
+    """
+    An RDD of the (session key, records) pairs for the keys: the records of all of the keys are
+    produced by process_jsonl_file in one Spark job, grouped by session (see session_key) and
+    sorted by order on the cluster.
+    """
+    key_chunks = list(key_chunks)
+    keys = [key for chunk_keys in key_chunks for key in chunk_keys]
+    chunk_sizes = [chunk_total_bytes(chunk_keys) for chunk_keys in key_chunks]
+    total_bytes = sum(chunk_sizes) if chunk_sizes and None not in chunk_sizes else None
+
+    records = parallel_records(sc, source_bucket, keys, process_jsonl_file, context, [], total_bytes=total_bytes)
+    return sorted_groups(records, session_key, order)
+
+
+def distributed_session_groups(sc, source_bucket, key_chunks, context, order=None):
+    """
+    Yield the session_groups of the keys a partition at a time, so the driver never holds more
+    than the two partitions being handed over. The driver still receives every raw record, as
+    only the grouping and sorting run on the cluster; see write_sessions_on_executors to render
+    the sessions there too.
+    """
+    return session_groups(sc, source_bucket, key_chunks, context, order).toLocalIterator(prefetchPartitions=True)
+
+
+def write_sessions_on_executors(sc, source_bucket, key_chunks, context, render, order, chunk_name):
+    """
+    Group the records of the keys by session on the cluster (see session_groups), then on the
+    executors render each session with render(records, context), using the broadcast lookup,
+    and save each partition's messages as XML chunks of at most chunk_size messages (or of at
+    most xml_chunk_bytes), named {chunk_name}_{partition}_{n}.xml. Returns the chunks' metadata,
+    in partition order.
+    """
+    # Every task needs the lookup to render, so it is shipped as a broadcast rather than
+    # pickled into each task
+    if 'lookup_broadcast' not in context:
+        context = broadcast_context(sc, context)
+
+    sessions = session_groups(sc, source_bucket, key_chunks, context, order)
+
+    write_chunks = functools.partial(write_xml_chunks, render, context, f'{context["job_id"]}/', context["results_bucket_name"], context["chunk_size"], chunk_name)
+    return sessions.mapPartitionsWithIndex(write_chunks).collect()
+
+
+def write_xml_chunks(render, context, target_prefix, results_bucket_name, chunk_size, chunk_name, partition_index, sessions):
+    """Render a partition's sessions and save them as XML chunks from an executor, yielding each chunk's metadata."""
+    task_context = resolve_context(context)
+
+    with XmlChunkWriter(boto3.client('s3'), results_bucket_name, target_prefix, XML_CHUNK_PREFIX, XML_CHUNK_SUFFIX, chunk_size,
+                        max_bytes=context.get("xml_chunk_bytes"), chunk_name=f'{chunk_name}_{partition_index}') as writer:
+        for _, records in sessions:
+            writer.extend(render(records, task_context))
+
+    yield from writer.chunks
+
+
+
+def collect_key_chunks(sc, source_bucket, key_chunks, number_of_chunks, context, description):
+    """
+    Process chunks of keys with process_jsonl_file, collecting all of the results to the driver.
+    Chunks are processed serially, one Spark job each, or with single_job all together in one
+    Spark job (see single_job_partitions). The results are DataShop records of nested values,
+    so arrow_results does not apply to them.
+    """
+    def collect(keys, **kwargs):
+        return parallel_map(sc, source_bucket, keys, process_jsonl_file, context, [], **kwargs)
+
+    if context.get("single_job", False):
+        key_chunks = list(key_chunks)
+        keys = [key for chunk_keys in key_chunks for key in chunk_keys]
+        try:
+            return collect(keys, num_partitions=single_job_partitions(sc, context, len(key_chunks), len(keys), key_chunks_total_bytes(key_chunks)))
+        except Exception as e:
+            print(f"Error processing {description}s: {e}")
+            return []
+
+    results = []
+    for chunk_index, chunk_keys in enumerate(key_chunks):
+        try:
+            # Process keys in parallel to 
+            results.extend(collect(chunk_keys, total_bytes=chunk_total_bytes(chunk_keys)))
+
+        except Exception as e:
+            print(f"Error processing {description} {chunk_label(chunk_index, number_of_chunks)}: {e}")
+
+    return results
+
+
 def generate_dataset(section_ids, action, context):
     """function to generate the dataset for given section IDs and action."""
 
@@ -147,10 +310,6 @@ def generate_dataset(section_ids, action, context):
     s3_client = boto3.client('s3')
 
     # Define key parameters
-    source_bucket = context["bucket_name"]
-    inventory_bucket = context["inventory_bucket_name"]
-    target_prefix = f'{context["job_id"]}/'
-    chunk_size = context["chunk_size"]
     event_jsonl_processor, columns = get_event_config(action)
 
     # Create a list of indices of field to remove, to honor the exclude_fields parameter
@@ -163,31 +322,33 @@ def generate_dataset(section_ids, action, context):
     debug_log(context, "Retrieving lookup data")
     context["lookup"] = retrieve_lookup(s3_client, context)
 
-    # Retrieve matching keys from S3 inventory
-    debug_log(context, "Listing keys from inventory")
-    keys = list_keys_from_inventory(section_ids, action, source_bucket, inventory_bucket)
-    number_of_chunks = calculate_number_of_chunks(len(keys), chunk_size)
-
-    debug_log(context, f"Calculated number of chunks: {number_of_chunks}")
-    debug_log(context, f"Found {len(keys)} keys from inventory")
-
-    # Process keys in chunks, serially
-    for chunk_index, chunk_keys in enumerate(chunkify(keys, chunk_size)):
-        try:
-            # Process keys in parallel
-            chunk_data = parallel_map(sc, source_bucket, chunk_keys, event_jsonl_processor, context, excluded_indices)
-            
-            # Save the collected results as a CSV file to S3
-            save_chunk_to_s3(chunk_data, columns, s3_client, target_prefix, chunk_index, results_bucket_name=context["results_bucket_name"])
-            print(f"Successfully processed chunk {chunk_index + 1}/{number_of_chunks}")
-
-        except Exception as e:
-            print(f"Error processing chunk {chunk_index + 1}/{number_of_chunks}: {e}")
+    # With broadcast_lookup, tasks get the lookup through a broadcast variable
+    task_context = task_context_for(sc, context)
+
+    # With executor_writes, each partition of keys is processed and saved as its own chunk on
+    # the executors, and only the chunks' metadata is brought back to the driver. Keys scanned
+    # with spark_inventory are already distributed, and single_job processes all keys in one
+    # job, so both are always written this way
+    chunk_keys = None
+    if context.get("spark_json", False) and action in spark_json_fields:
+
+        # Read, filter and write the events with Spark's native JSON reader and CSV writer
+        keys = list(list_inventory_keys(section_ids, action, context))
+        debug_log(context, f"Found {len(keys)} keys from inventory")
+        chunk_keys = write_event_csv(spark, s3_client, context["bucket_name"], keys, action, columns, context)
+        number_of_chunks = len(chunk_keys)
+    elif any(context.get(option, False) for option in ("executor_writes", "spark_inventory", "single_job")):
+        chunk_metadata = write_chunks_on_executors(sc, spark, section_ids, action, task_context, event_jsonl_processor, columns, excluded_indices)
+        number_of_chunks = len(chunk_metadata)
+        chunk_keys = [metadata["key"] for metadata in chunk_metadata]
+        debug_log(context, f"Saved {number_of_chunks} chunks, {sum(metadata['rows'] for metadata in chunk_metadata)} rows")
+    else:
+        number_of_chunks = write_chunks_from_driver(sc, spark, s3_client, section_ids, action, task_context, event_jsonl_processor, columns, excluded_indices)
 
     # Build and save JSON and HTML manifests
     debug_log(context, "Building manifests")
     context['lookup'] = {}
-    build_manifests(s3_client, context, number_of_chunks, "csv")
+    build_manifests(s3_client, context, number_of_chunks, "csv", chunk_keys=chunk_keys)
 
     # Stop Spark context
     debug_log(context, "Ending job, stopping Spark context")
@@ -196,9 +357,263 @@ def generate_dataset(section_ids, action, context):
     return number_of_chunks
 
 
+def write_chunks_from_driver(sc, spark, s3_client, section_ids, action, context, event_jsonl_processor, columns, excluded_indices):
+    """
+    Process the keys chunk by chunk, collecting each chunk's results to the driver and saving
+    them from there. Returns the number of chunks saved.
+    """
+    source_bucket = context["bucket_name"]
+    target_prefix = f'{context["job_id"]}/'
+
+    # With checkpoint, the planned chunks and the completed ones are saved as the job's state
+    job_state = None
+
+    # Retrieve matching keys from S3 inventory. When streaming keys, chunks are dispatched
+    # as soon as enough keys have been listed, and the number of chunks is only known at the end.
+    # With checkpoint (and whole chunks), a rerun of the job takes the chunks from its state
+    if context.get("checkpoint", False) and not context.get("output_chunk_rows"):
+        job_state = JobState(s3_client, context["results_bucket_name"], context["job_id"])
+        if job_state.load():
+            debug_log(context, f"Resuming job, {len(job_state.completed)} chunks already completed")
+        else:
+            debug_log(context, "Listing keys from inventory")
+            job_state.plan(plan_key_chunks(section_ids, action, context)[0])
+        key_chunks = [chunk_keys if total_bytes is None else KeyChunk(chunk_keys, total_bytes)
+                      for chunk_keys, total_bytes in zip(job_state.key_chunks, job_state.chunk_bytes)]
+        number_of_chunks = len(key_chunks)
+    else:
+        debug_log(context, "Listing keys from inventory")
+        key_chunks, number_of_chunks = plan_key_chunks(section_ids, action, context)
+    debug_log(context, f"Calculated number of chunks: {number_of_chunks}")
+
+    # Each chunk is a call that processes its keys in parallel, returning the chunk data.
+    # With arrow_results (and whole chunks), each chunk comes back as an Arrow table,
+    # which is written as CSV without turning it back into Python rows
+    if context.get("arrow_results", False) and not context.get("output_chunk_rows"):
+        chunks = (functools.partial(parallel_map_batches, sc, source_bucket, chunk_keys, event_jsonl_processor, context, excluded_indices,
+                                    column_names=columns, total_bytes=chunk_total_bytes(chunk_keys))
+                  for chunk_keys in key_chunks)
+    else:
+        chunks = (functools.partial(parallel_map, sc, source_bucket, chunk_keys, event_jsonl_processor, context, excluded_indices,
+                                    total_bytes=chunk_total_bytes(chunk_keys))
+                  for chunk_keys in key_chunks)
+
+    # With output_chunk_rows, the results are written as CSV chunks of exactly that many rows
+    # (the last one excepted) instead of one CSV chunk per chunk of keys
+    output_chunk_rows = context.get("output_chunk_rows")
+    pending_rows = []
+    saved_chunks = 0
+
+    # With pipeline_uploads, chunks are saved on a background thread while the next chunk
+    # is processed on the executors
+    with ChunkUploader(context.get("pipeline_uploads", 0)) as uploader:
+
+        # Process keys in chunks, serially
+        processed_chunks = 0
+        for chunk_index, process_chunk in enumerate(chunks):
+            processed_chunks += 1
+            if job_state is not None and job_state.is_complete(chunk_index):
+                print(f"Skipping completed chunk {chunk_label(chunk_index, number_of_chunks)}")
+                continue
+            try:
+                # Process keys in parallel
+                chunk_data = process_chunk()
+                
+                # Save the collected results as a CSV file to S3
+                if output_chunk_rows:
+                    pending_rows.extend(chunk_data)
+                    for rows in take_full_chunks(pending_rows, output_chunk_rows):
+                        uploader.submit(chunk_label(saved_chunks, None), save_chunk_to_s3, rows, columns, s3_client, target_prefix, saved_chunks, results_bucket_name=context["results_bucket_name"])
+                        saved_chunks += 1
+                elif job_state is not None:
+                    uploader.submit(chunk_label(chunk_index, number_of_chunks), save_checkpointed_chunk, job_state, chunk_data, columns, s3_client, target_prefix, chunk_index, results_bucket_name=context["results_bucket_name"])
+                else:
+                    uploader.submit(chunk_label(chunk_index, number_of_chunks), save_chunk_to_s3, chunk_data, columns, s3_client, target_prefix, chunk_index, results_bucket_name=context["results_bucket_name"])
+
+            except Exception as e:
+                print(f"Error processing chunk {chunk_label(chunk_index, number_of_chunks)}: {e}")
+
+        number_of_chunks = processed_chunks
+
+        if output_chunk_rows:
+            if pending_rows or saved_chunks == 0:
+                uploader.submit(chunk_label(saved_chunks, None), save_chunk_to_s3, pending_rows, columns, s3_client, target_prefix, saved_chunks, results_bucket_name=context["results_bucket_name"])
+                saved_chunks += 1
+            number_of_chunks = saved_chunks
+
+    return number_of_chunks
+
+
+def write_chunks_on_executors(sc, spark, section_ids, action, context, event_jsonl_processor, columns, excluded_indices):
+    """
+    Distribute the keys with one partition per chunk, then process and save each partition as
+    chunk_{partition}.csv on the executors, all in one Spark job. Returns the metadata (key,
+    rows and bytes) of each chunk, in chunk order.
+    """
+    bucket_keys, number_of_chunks = distribute_chunked_keys(sc, spark, section_ids, action, context)
+
+    write_chunk = functools.partial(write_csv_chunk, columns, f'{context["job_id"]}/', context["results_bucket_name"])
+    return parallel_write(bucket_keys, event_jsonl_processor, context, excluded_indices, write_chunk)
+
+
+def distribute_chunked_keys(sc, spark, section_ids, action, context):
+    """
+    Return an RDD of (bucket_name, key) pairs with one partition per chunk, and the number of
+    chunks, from the Spark inventory scan or from the planned chunks of listed keys. With
+    single_job, the planned chunks are split further so there are single_job_partitions of them.
+    """
+    if context.get("spark_inventory", False):
+        debug_log(context, "Scanning inventory with Spark")
+        return distribute_inventory_keys(sc, spark, section_ids, action, context)
+
+    debug_log(context, "Listing keys from inventory")
+    key_chunks, number_of_chunks = plan_key_chunks(section_ids, action, context)
+    key_chunks = list(key_chunks)
+
+    if context.get("single_job", False):
+        number_of_keys = sum(len(chunk_keys) for chunk_keys in key_chunks)
+        partitions = single_job_partitions(sc, context, len(key_chunks), number_of_keys, key_chunks_total_bytes(key_chunks))
+        key_chunks = split_chunks(key_chunks, partitions)
+
+    return distribute_keys(sc, context["bucket_name"], key_chunks), len(key_chunks)
+
+
+def single_job_partitions(sc, context, number_of_chunks, number_of_keys, total_bytes):
+    """
+    The number of partitions to process all keys with in a single job: at least one per chunk,
+    and as many as task_partitions sizes for the cluster, so that the job keeps every core busy
+    instead of running one task per (large) chunk.
+    """
+    target_task_bytes = context.get("target_task_bytes")
+    partitions = task_partitions(number_of_keys, total_bytes if target_task_bytes else None, sc.defaultParallelism, target_task_bytes)
+    return max(number_of_chunks, partitions)
+
+
+def split_chunks(key_chunks, partitions):
+    """Split each chunk of keys evenly so that the chunks number about partitions in all."""
+    if not key_chunks or len(key_chunks) >= partitions:
+        return key_chunks
+
+    pieces = math.ceil(partitions / len(key_chunks))
+    return [piece for chunk_keys in key_chunks
+            for piece in chunkify(list(chunk_keys), max(1, math.ceil(len(chunk_keys) / pieces)))]
+
+
+def plan_key_chunks(section_ids, action, context):
+    """
+    List the keys for the section IDs and action, and group them into chunks. Returns the chunks
+    and their number, which is None when streaming keys as it is only known at the end.
+
+    With chunk_bytes (and not streaming), chunks are planned from the objects' sizes to each hold
+    about chunk_bytes of input, and no more than chunk_size keys. Otherwise each chunk holds
+    chunk_size keys.
+    """
+    chunk_size = context["chunk_size"]
+
+    if context.get("stream_keys", False):
+        return chunkify(list_inventory_keys(section_ids, action, context), chunk_size), None
+
+    if context.get("chunk_bytes"):
+        records = list_inventory_keys(section_ids, action, context, with_metadata=True)
+        debug_log(context, f"Found {len(records)} keys ({records['size'].sum()} bytes) from inventory")
+        sizes = dict(zip(records['key'].tolist(), records['size'].tolist()))
+        key_chunks = [KeyChunk(chunk_keys, sum(sizes[key] for key in chunk_keys))
+                      for chunk_keys in plan_chunks(records['key'].tolist(), records['size'].tolist(), context["chunk_bytes"], chunk_size)]
+        return key_chunks, len(key_chunks)
+
+    keys = list_inventory_keys(section_ids, action, context)
+    debug_log(context, f"Found {len(keys)} keys from inventory")
+    return chunkify(keys, chunk_size), calculate_number_of_chunks(len(keys), chunk_size)
+
+
+def list_inventory_keys(section_ids, action, context, with_metadata=False):
+    """
+    List the keys for the section IDs and action from the S3 inventory, honoring the job's
+    inventory options. When the job streams keys this returns a generator instead of a list.
+    With fresh_keys, keys added since the inventory snapshot are listed live and included, and
+    with live_keys the inventory is bypassed and every section's prefix is listed live.
+    With with_metadata (not supported when streaming) a key records DataFrame is returned.
+    """
+    streaming = context.get("stream_keys", False)
+    listing_workers = context.get("listing_workers", 1)
+
+    if context.get("live_keys", False):
+        if with_metadata:
+            return list_keys_after(context["bucket_name"], section_ids, action, {}, with_metadata=True, max_workers=listing_workers)
+        keys = list_keys_for_sections(context["bucket_name"], section_ids, action, max_workers=listing_workers)
+        return keys if streaming else list(keys)
+
+    inventory_options = {
+        "scan": context.get("inventory_scan", False),
+        "max_workers": context.get("inventory_workers", 1),
+        "cache_location": context.get("inventory_cache"),
+        "index": context.get("inventory_index", False)
+    }
+
+    if streaming:
+        keys = iter_keys_from_inventory(section_ids, action, context["bucket_name"], context["inventory_bucket_name"], **inventory_options)
+    elif with_metadata:
+        keys = list_keys_from_inventory(section_ids, action, context["bucket_name"], context["inventory_bucket_name"], with_metadata=True, **inventory_options)
+    else:
+        keys = list_keys_from_inventory(section_ids, action, context["bucket_name"], context["inventory_bucket_name"], **inventory_options)
+
+    if context.get("fresh_keys", False):
+        merge_func = iter_fresh_keys if streaming else merge_fresh_keys
+        keys = merge_func(keys, section_ids, action, context["bucket_name"], max_workers=listing_workers)
+
+    return keys
+
+
+def distribute_inventory_keys(sc, spark, section_ids, action, context):
+    """
+    Scan the inventory with Spark and return an RDD of (bucket_name, key) pairs with one
+    partition per chunk of about chunk_size keys (and, with chunk_bytes, about chunk_bytes of
+    input), along with the number of chunks. Only the key count and total size are brought
+    to the driver.
+    """
+    source_bucket = context["bucket_name"]
+    chunk_bytes = context.get("chunk_bytes")
+
+    if chunk_bytes:
+        keys = spark_inventory_keys(spark, section_ids, action, context["bucket_name"], context["inventory_bucket_name"], columns=('key', 'size')).cache()
+        number_of_keys, total_bytes = keys.agg(F.count('key'), F.sum('size')).first()
+        debug_log(context, f"Found {number_of_keys} keys ({total_bytes} bytes) from inventory")
+        number_of_chunks = max(calculate_number_of_chunks(number_of_keys, context["chunk_size"]),
+                               calculate_number_of_chunks(total_bytes or 0, chunk_bytes))
+    else:
+        keys = spark_inventory_keys(spark, section_ids, action, context["bucket_name"], context["inventory_bucket_name"]).cache()
+        number_of_keys = keys.count()
+        debug_log(context, f"Found {number_of_keys} keys from inventory")
+        number_of_chunks = calculate_number_of_chunks(number_of_keys, context["chunk_size"])
+
+    if number_of_chunks == 0:
+        return sc.emptyRDD(), 0
+
+    # With single_job, the chunks are made small enough for the job to run on every core
+    if context.get("single_job", False):
+        number_of_chunks = single_job_partitions(sc, context, number_of_chunks, number_of_keys, total_bytes if chunk_bytes else None)
+
+    bucket_keys = keys.repartition(number_of_chunks).rdd.map(lambda row: (source_bucket, row.key))
+    return bucket_keys, number_of_chunks
+
+
+def task_context_for(sc, context):
+    """
+    The context to ship to Spark tasks: with broadcast_lookup, one holding a broadcast of the
+    lookup. With executor_rendering every task renders sessions with the lookup, so it is always
+    broadcast then.
+    """
+    if context.get("broadcast_lookup", False) or context.get("executor_rendering", False):
+        return broadcast_context(sc, context)
+    return context
+
+
 def initialize_spark_context(app_name):
     """Initialize and return a Spark context and session."""
     conf = SparkConf().setAppName(app_name)
+
+    # Use Arrow for transfers between the JVM and Python (e.g. toPandas, createDataFrame)
+    conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
     sc = SparkContext(conf=conf)
     spark = SparkSession(sc)
     return sc, spark
@@ -210,18 +625,146 @@ def calculate_number_of_chunks(total_keys, chunk_size):
 
 
 def chunkify(lst, chunk_size):
-    """Yield successive chunks from a list."""
-    for i in range(0, len(lst), chunk_size):
-        yield lst[i:i + chunk_size]
+    """Yield successive chunks from a list, or from any iterable such as a streaming key generator."""
+    iterator = iter(lst)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class KeyChunk(list):
+    """A chunk of keys that also knows the total size of its objects, in bytes."""
+
+    def __init__(self, keys, total_bytes):
+        super().__init__(keys)
+        self.total_bytes = total_bytes
+
+
+def key_chunks_total_bytes(key_chunks):
+    """The total input size of the chunks of keys, or None unless every chunk's size is known."""
+    sizes = [chunk_total_bytes(chunk_keys) for chunk_keys in key_chunks]
+    return None if None in sizes else sum(sizes)
+
+
+def chunk_total_bytes(chunk_keys):
+    """The total size of a chunk's objects, or None when it is not known."""
+    return getattr(chunk_keys, "total_bytes", None)
+
+
+def plan_chunks(items, weights, budget, max_items=None):
+    """
+    Group items, in order, into chunks whose weights add up to about ``budget``. A chunk is
+    closed before it would exceed the budget or hold more than ``max_items`` items; an item
+    heavier than the budget gets a chunk of its own.
+    """
+    chunks = []
+    chunk = []
+    chunk_weight = 0
+    for item, weight in zip(items, weights):
+        if chunk and (chunk_weight + weight > budget or (max_items and len(chunk) >= max_items)):
+            chunks.append(chunk)
+            chunk = []
+            chunk_weight = 0
+        chunk.append(item)
+        chunk_weight += weight
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def chunk_label(chunk_index, number_of_chunks):
+    """Progress label for a chunk, e.g. '3/10', or just '3' when the total is not known yet."""
+    if number_of_chunks is None:
+        return f"{chunk_index + 1}"
+    return f"{chunk_index + 1}/{number_of_chunks}"
 
 def save_chunk_to_s3(chunk_data, columns, s3_client, target_prefix, chunk_index, results_bucket_name):
     """Save a DataFrame as a CSV file to S3."""
 
-    df = pd.DataFrame(chunk_data, columns=columns)
+    chunk_key = f'{target_prefix}chunk_{chunk_index}.csv'
+    s3_client.put_object(Bucket=results_bucket_name, Key=chunk_key, Body=encode_csv_chunk(chunk_data, columns))
+
+def save_checkpointed_chunk(job_state, chunk_data, columns, s3_client, target_prefix, chunk_index, results_bucket_name):
+    """Save a chunk as save_chunk_to_s3, then record it as completed in the job's state."""
+
+    save_chunk_to_s3(chunk_data, columns, s3_client, target_prefix, chunk_index, results_bucket_name)
+    job_state.record(chunk_index, len(chunk_data))
+
+def write_csv_chunk(columns, target_prefix, results_bucket_name, chunk_index, chunk_data):
+    """Save a chunk as a CSV file to S3 from an executor, returning the chunk's metadata."""
+
+    body = encode_csv_chunk(chunk_data, columns).encode('utf-8')
+    chunk_key = f'{target_prefix}chunk_{chunk_index}.csv'
+    boto3.client('s3').put_object(Bucket=results_bucket_name, Key=chunk_key, Body=body)
+
+    return {"key": chunk_key, "rows": len(chunk_data), "bytes": len(body)}
+
+def encode_csv_chunk(chunk_data, columns):
+    if isinstance(chunk_data, pa.Table):
+        df = chunk_data.to_pandas()
+    else:
+        df = pd.DataFrame(chunk_data, columns=columns)
     csv_buffer = io.StringIO()
     df.to_csv(csv_buffer, index=False)
-    chunk_key = f'{target_prefix}chunk_{chunk_index}.csv'
-    s3_client.put_object(Bucket=results_bucket_name, Key=chunk_key, Body=csv_buffer.getvalue())
+    return csv_buffer.getvalue()
+
+def take_full_chunks(rows, rows_per_chunk):
+    """Remove and return as many chunks of exactly ``rows_per_chunk`` rows as the front of ``rows`` holds."""
+    full_chunks = []
+    while len(rows) >= rows_per_chunk:
+        full_chunks.append(rows[:rows_per_chunk])
+        del rows[:rows_per_chunk]
+    return full_chunks
+
+
+class ChunkUploader:
+    """
+    Saves chunks either inline, or with max_pending > 0 on a background thread, so that the
+    executors can work on the next chunk while the driver encodes and uploads the previous one.
+    At most max_pending saves are queued or running at once, and submitting another first waits
+    for the oldest, which bounds the chunk data held on the driver. A chunk is reported as
+    processed, under its progress label, once its save has completed; errors from background
+    saves are printed, as for chunks that fail to process.
+    """
+
+    def __init__(self, max_pending=0):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1) if max_pending > 0 else None
+        self.pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, label, save, *args, **kwargs):
+        if self.executor is None:
+            save(*args, **kwargs)
+            print(f"Successfully processed chunk {label}")
+            return
+
+        while len(self.pending) >= self.max_pending:
+            self.wait_for_oldest()
+        self.pending.append((label, self.executor.submit(save, *args, **kwargs)))
+
+    def wait_for_oldest(self):
+        label, future = self.pending.popleft()
+        try:
+            future.result()
+            print(f"Successfully processed chunk {label}")
+        except Exception as e:
+            print(f"Error saving chunk {label}: {e}")
+
+    def close(self):
+        while self.pending:
+            self.wait_for_oldest()
+        if self.executor is not None:
+            self.executor.shutdown()
 
 def save_xml_chunk(chunk_data, s3_client, target_prefix, chunk_index, results_bucket_name):
     
@@ -232,10 +775,15 @@ def save_xml_chunk(chunk_data, s3_client, target_prefix, chunk_index, results_bu
     s3_client.put_object(Bucket=results_bucket_name, Key=chunk_key, Body=xml_string)
 
 
-def build_manifests(s3_client, context, number_of_chunks, extension):
-    """Build HTML and JSON manifests."""
-    build_html_manifest(s3_client, context, number_of_chunks, extension)
-    build_json_manifest(s3_client, context, number_of_chunks, extension)
+def build_manifests(s3_client, context, number_of_chunks, extension, chunk_keys=None):
+    """Build HTML and JSON manifests, listing chunk_keys instead of the numbered chunks when given."""
+    if chunk_keys is None:
+        build_html_manifest(s3_client, context, number_of_chunks, extension)
+        build_json_manifest(s3_client, context, number_of_chunks, extension)
+        return
+
+    build_html_manifest(s3_client, context, number_of_chunks, extension, chunk_keys=chunk_keys)
+    build_json_manifest(s3_client, context, number_of_chunks, extension, chunk_keys=chunk_keys)
 
 def debug_log(context, message):
     """Log a debug message if debugging is enabled in the context."""
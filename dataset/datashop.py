@@ -162,11 +162,49 @@ def process_tutor_messages(part_attempts, context):
     return values
 
 
-def process_jsonl_file(bucket_key, context, excluded_indices):
+def session_key(part_attempt):
+    """The key of the session a part attempt or tutor message belongs to: section, user and session."""
+    return str(part_attempt.get('section_id', '')) + "_" + str(part_attempt.get('user_id', '')) + "_" + str(part_attempt.get('session_id', ''))
+
+def part_attempt_order(part_attempt):
+    """The order of part attempts within a session."""
+    return (
+        part_attempt.get('page_attempt_guid', ''),
+        part_attempt.get('activity_id', ''),
+        part_attempt.get('activity_attempt_number', 0),
+        part_attempt.get('part_id', ''),
+        part_attempt.get('part_attempt_number', 0)
+    )
+
+
+def starts_problem(message):
+    """Whether a rendered message block opens with a START_PROBLEM context message."""
+    message = message.lstrip()
+    return message.startswith("<context_message") and 'name="START_PROBLEM"' in message.split(">", 1)[0]
+
+def problem_units(messages):
+    """
+    Group rendered message blocks into the units that must stay together in one XML chunk: each
+    unit runs from a block opening with START_PROBLEM up to the next one, as the blocks in between
+    refer to its context message.
+    """
+    unit = []
+    for message in messages:
+        if unit and starts_problem(message):
+            yield unit
+            unit = []
+        unit.append(message)
+
+    if unit:
+        yield unit
+
+
+def process_jsonl_file(bucket_key, context, excluded_indices, s3_client=None):
     bucket_name, key = bucket_key
 
-    # Create a session using the specified profile
-    s3_client = boto3.client('s3')
+    # Create a session using the specified profile, unless one is shared with us
+    if s3_client is None:
+        s3_client = boto3.client('s3')
     
     response = s3_client.get_object(Bucket=bucket_name, Key=key)
 
@@ -0,0 +1,186 @@
+import datetime
+import hashlib
+import io
+import json
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+
+# A persistent cache of filtered inventory keys. The S3 inventory is regenerated only once
+# a day, so the first job run against a snapshot materializes the keys for its action (across
+# all sections) into a compact, sorted Parquet file, and later jobs against the same snapshot
+# read that file instead of rescanning every inventory shard. Along with 'key' the file holds
+# the objects' 'size' and 'last_modified_date' when they were listed with metadata.
+#
+# The cache lives either in a local directory or under an S3 prefix given as
+# 's3://bucket/prefix', laid out as:
+#
+#   {location}/{inventoried_bucket_name}/{snapshot}/{action}.parquet
+#   {location}/{inventoried_bucket_name}/{snapshot}/{action}.json
+#
+# where snapshot is derived from the manifest's creationTimestamp, and the JSON sidecar records
+# a checksum of the manifest's file list so a cache entry is only reused for the exact set of
+# inventory files it was built from.
+
+
+def snapshot_id(manifest_json):
+    """Name of the inventory snapshot described by ``manifest_json``, e.g. '2024-01-01T01-00Z'."""
+    timestamp = manifest_json.get("creationTimestamp")
+    if timestamp is None:
+        return None
+
+    created = datetime.datetime.fromtimestamp(int(timestamp) / 1000, tz=datetime.timezone.utc)
+    return created.strftime('%Y-%m-%dT%H-%MZ')
+
+
+def manifest_checksum(manifest_json):
+    """Checksum over the (key, MD5checksum) pairs of every inventory file in the manifest."""
+    entries = sorted((f["key"], f.get("MD5checksum", "")) for f in manifest_json["files"])
+    return hashlib.md5(json.dumps(entries).encode('utf-8')).hexdigest()
+
+
+def load_cached_keys(s3_client, location, inventoried_bucket_name, manifest_json, action, with_metadata=False):
+    """
+    Return the cached keys for ``action`` in this manifest's snapshot, or None when there is
+    no cache entry or the entry was built from a different set of inventory files. With
+    ``with_metadata`` the cached key records are returned as a DataFrame, and an entry that
+    only holds keys counts as missing.
+    """
+    snapshot = snapshot_id(manifest_json)
+    if snapshot is None:
+        return None
+
+    prefix = f'{inventoried_bucket_name}/{snapshot}/{action}'
+    metadata = read_cache_object(s3_client, location, f'{prefix}.json')
+    if metadata is None:
+        return None
+
+    metadata = json.loads(metadata)
+    if metadata.get("manifest_checksum") != manifest_checksum(manifest_json):
+        return None
+
+    data = read_cache_object(s3_client, location, f'{prefix}.parquet')
+    if data is None or hashlib.md5(data).hexdigest() != metadata.get("checksum"):
+        return None
+
+    table = pq.read_table(io.BytesIO(data))
+
+    if with_metadata:
+        if 'size' not in table.column_names:
+            return None
+        return table.to_pandas()
+
+    return table.column('key').to_pylist()
+
+
+def store_cached_keys(s3_client, location, inventoried_bucket_name, manifest_json, action, keys):
+    """Write ``keys``, a list of keys or a key records DataFrame, as the cache entry for ``action`` in this manifest's snapshot."""
+    snapshot = snapshot_id(manifest_json)
+    if snapshot is None:
+        return
+
+    if isinstance(keys, pd.DataFrame):
+        table = pa.Table.from_pandas(keys.sort_values('key'), preserve_index=False)
+    else:
+        table = pa.table({'key': sorted(keys)})
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+    data = buffer.getvalue()
+
+    metadata = {
+        "manifest_checksum": manifest_checksum(manifest_json),
+        "checksum": hashlib.md5(data).hexdigest(),
+        "count": len(keys)
+    }
+
+    # Write the data before the metadata, so a partially written entry is never considered valid
+    prefix = f'{inventoried_bucket_name}/{snapshot}/{action}'
+    write_cache_object(s3_client, location, f'{prefix}.parquet', data)
+    write_cache_object(s3_client, location, f'{prefix}.json', json.dumps(metadata).encode('utf-8'))
+
+
+def evict_snapshots(s3_client, location, inventoried_bucket_name, keep=2):
+    """Delete all but the ``keep`` most recent cached snapshots for the bucket."""
+    snapshots = sorted(list_cache_dirs(s3_client, location, inventoried_bucket_name))
+    for snapshot in snapshots[:-keep] if keep > 0 else snapshots:
+        delete_cache_dir(s3_client, location, f'{inventoried_bucket_name}/{snapshot}')
+
+
+def parse_location(location):
+    """Split a cache location into (bucket, prefix) for S3, or (None, path) for a local directory."""
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        return bucket, prefix.strip('/')
+    return None, location
+
+
+def read_cache_object(s3_client, location, name):
+    bucket, prefix = parse_location(location)
+
+    if bucket is None:
+        path = os.path.join(prefix, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=join_key(prefix, name))
+        return response['Body'].read()
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+
+
+def write_cache_object(s3_client, location, name, data):
+    bucket, prefix = parse_location(location)
+
+    if bucket is None:
+        path = os.path.join(prefix, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return
+
+    s3_client.put_object(Bucket=bucket, Key=join_key(prefix, name), Body=data)
+
+
+def list_cache_dirs(s3_client, location, name):
+    bucket, prefix = parse_location(location)
+
+    if bucket is None:
+        path = os.path.join(prefix, name)
+        if not os.path.isdir(path):
+            return []
+        return [d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))]
+
+    dirs = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=join_key(prefix, name) + '/', Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            dirs.append(common_prefix['Prefix'].rstrip('/').rsplit('/', 1)[-1])
+    return dirs
+
+
+def delete_cache_dir(s3_client, location, name):
+    bucket, prefix = parse_location(location)
+
+    if bucket is None:
+        shutil.rmtree(os.path.join(prefix, name), ignore_errors=True)
+        return
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=join_key(prefix, name) + '/'):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if objects:
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects})
+
+
+def join_key(prefix, name):
+    return f'{prefix}/{name}' if prefix else name
@@ -0,0 +1,102 @@
+import json
+import threading
+
+from botocore.exceptions import ClientError
+
+# Checkpoints for chunked jobs. With the checkpoint option, generate_dataset saves the state of
+# the job in the results bucket, next to its chunks, under:
+#
+#   {job_id}/job_state/
+#
+# The planned chunks of keys are saved once, when the job starts, along with each chunk's input
+# size in bytes when it is known (and null otherwise):
+#
+#   {job_id}/job_state/plan.json
+#   {"key_chunks": [["key1", "key2"], ["key3"]], "chunk_bytes": [2048, 512]}
+#
+# and each chunk saved gets a small object of its own, holding its row count:
+#
+#   {job_id}/job_state/completed/chunk_0.json
+#   {"rows": 120}
+#
+# so recording a chunk never rewrites the plan, however many keys it holds. Rerunning the job
+# with the same job_id reuses the planned chunks instead of listing the keys again, and skips
+# the completed chunks, so only the missing ones are recomputed. Chunk indices are stable
+# across runs, so the chunks saved by earlier runs keep their names.
+
+
+def job_state_prefix(job_id):
+    return f'{job_id}/job_state/'
+
+
+def job_state_key(job_id):
+    return f'{job_state_prefix(job_id)}plan.json'
+
+
+def completed_chunk_key(job_id, chunk_index):
+    return f'{job_state_prefix(job_id)}completed/chunk_{chunk_index}.json'
+
+
+class JobState:
+    """
+    The saved state of a chunked job. record() is safe to call from the threads saving chunks,
+    and saves only the completed chunk's own object.
+    """
+
+    def __init__(self, s3_client, bucket_name, job_id):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.job_id = job_id
+        self.key = job_state_key(job_id)
+        self.key_chunks = None
+        self.chunk_bytes = None
+        self.completed = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Load the state of an earlier run, returning whether there was one."""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return False
+            raise
+
+        plan = json.loads(response['Body'].read().decode('utf-8'))
+        self.key_chunks = plan["key_chunks"]
+        self.chunk_bytes = plan.get("chunk_bytes") or [None] * len(self.key_chunks)
+        self.completed = self.load_completed()
+        return True
+
+    def load_completed(self):
+        completed = {}
+        completed_prefix = f'{job_state_prefix(self.job_id)}completed/chunk_'
+
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=completed_prefix):
+            for obj in page.get('Contents', []):
+                chunk_index = int(obj['Key'][len(completed_prefix):-len('.json')])
+                response = self.s3_client.get_object(Bucket=self.bucket_name, Key=obj['Key'])
+                completed[chunk_index] = json.loads(response['Body'].read().decode('utf-8'))
+        return completed
+
+    def plan(self, key_chunks):
+        """Save the planned chunks of keys, before any of them is processed."""
+        key_chunks = list(key_chunks)
+        self.key_chunks = [list(chunk_keys) for chunk_keys in key_chunks]
+        self.chunk_bytes = [getattr(chunk_keys, "total_bytes", None) for chunk_keys in key_chunks]
+        self.completed = {}
+
+        plan = {"key_chunks": self.key_chunks, "chunk_bytes": self.chunk_bytes}
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=json.dumps(plan).encode('utf-8'))
+
+    def is_complete(self, chunk_index):
+        return chunk_index in self.completed
+
+    def record(self, chunk_index, rows):
+        """Record a chunk as completed, with its row count."""
+        chunk = {"rows": rows}
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=completed_chunk_key(self.job_id, chunk_index),
+                                  Body=json.dumps(chunk).encode('utf-8'))
+        with self.lock:
+            self.completed[chunk_index] = chunk
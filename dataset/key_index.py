@@ -0,0 +1,143 @@
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from dataset.inventory_cache import (
+    snapshot_id, manifest_checksum, parse_location, read_cache_object, write_cache_object
+)
+
+# A (section_id, action) index over every 'section/{id}/{action}/...' key in an inventory
+# snapshot. It is built once per snapshot and stored next to the inventory cache as:
+#
+#   {location}/{inventoried_bucket_name}/{snapshot}/index.arrow
+#   {location}/{inventoried_bucket_name}/{snapshot}/index.json
+#
+# index.arrow is an Arrow IPC file with a 'key' column (plus 'size' and 'last_modified_date' when
+# the inventory was scanned for them) sorted by (section_id, action, key), and its schema metadata
+# maps each '{section_id}/{action}' to the [start, stop) rows holding its keys. A local index is memory-mapped, so looking up any set of sections only touches the
+# matching keys, no matter how large the inventory is.
+
+# Indexes already loaded by this process, keyed by snapshot and manifest checksum, so that
+# several listings against the same snapshot (as in generate_datashop) share one index
+loaded_indexes = {}
+
+
+def build_key_index(batches):
+    """Build an index table from Arrow record batches holding a 'key' column, and optionally key metadata."""
+    if batches:
+        table = pa.Table.from_batches(batches)
+    else:
+        table = pa.table({'key': pa.array([], type=pa.string())})
+
+    parts = pc.split_pattern(table.column('key'), '/', max_splits=3)
+    table = table.append_column('section_id', pc.list_element(parts, 1)) \
+                 .append_column('action', pc.list_element(parts, 2)) \
+                 .sort_by([('section_id', 'ascending'), ('action', 'ascending'), ('key', 'ascending')])
+
+    # Sorted, each section/action pair is a single run of rows
+    prefixes = pc.binary_join_element_wise(table.column('section_id'), table.column('action'), '/')
+    runs = pc.run_end_encode(prefixes.combine_chunks()) if len(table) > 0 else None
+
+    offsets = {}
+    if runs is not None:
+        start = 0
+        for prefix, stop in zip(runs.values.to_pylist(), runs.run_ends.to_pylist()):
+            offsets[prefix] = [start, stop]
+            start = stop
+
+    table = table.drop_columns(['section_id', 'action'])
+    return table.replace_schema_metadata({'offsets': json.dumps(offsets)})
+
+
+def lookup_keys(index, section_ids, action, with_metadata=False):
+    """
+    Keys for ``action`` in each of ``section_ids``, read from the index in O(matching keys).
+    With ``with_metadata`` the matching rows are returned as a key records DataFrame.
+    """
+    offsets = json.loads(index.schema.metadata[b'offsets'])
+
+    slices = []
+    for section_id in section_ids:
+        start, stop = offsets.get(f'{section_id}/{action}', (0, 0))
+        slices.append(index.slice(start, stop - start))
+
+    if with_metadata:
+        df = pa.concat_tables(slices).to_pandas() if slices else index.slice(0, 0).to_pandas()
+        df['last_modified_date'] = pd.to_datetime(df['last_modified_date'], utc=True)
+        return df
+
+    keys = []
+    for table in slices:
+        keys.extend(table.column('key').to_pylist())
+
+    return keys
+
+
+def load_key_index(s3_client, location, inventoried_bucket_name, manifest_json):
+    """
+    Return the index for this manifest's snapshot, from this process or the cache location,
+    or None when it does not exist or was built from a different set of inventory files.
+    """
+    snapshot = snapshot_id(manifest_json)
+    checksum = manifest_checksum(manifest_json)
+
+    memo_key = (inventoried_bucket_name, snapshot, checksum)
+    if memo_key in loaded_indexes:
+        return loaded_indexes[memo_key]
+
+    if location is None or snapshot is None:
+        return None
+
+    prefix = f'{inventoried_bucket_name}/{snapshot}/index'
+    metadata = read_cache_object(s3_client, location, f'{prefix}.json')
+    if metadata is None:
+        return None
+
+    metadata = json.loads(metadata)
+    if metadata.get("manifest_checksum") != checksum:
+        return None
+
+    bucket, path = parse_location(location)
+    if bucket is None:
+        path = os.path.join(path, f'{prefix}.arrow')
+        if not os.path.exists(path) or os.path.getsize(path) != metadata.get("size"):
+            return None
+        source = pa.memory_map(path)
+    else:
+        data = read_cache_object(s3_client, location, f'{prefix}.arrow')
+        if data is None or len(data) != metadata.get("size"):
+            return None
+        source = pa.py_buffer(data)
+
+    index = pa.ipc.open_file(source).read_all()
+    loaded_indexes[memo_key] = index
+    return index
+
+
+def store_key_index(s3_client, location, inventoried_bucket_name, manifest_json, index):
+    """Remember ``index`` for this process and, when a location is given, write it there."""
+    snapshot = snapshot_id(manifest_json)
+    checksum = manifest_checksum(manifest_json)
+    loaded_indexes[(inventoried_bucket_name, snapshot, checksum)] = index
+
+    if location is None or snapshot is None:
+        return
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, index.schema) as writer:
+        writer.write_table(index, max_chunksize=65536)
+    data = sink.getvalue().to_pybytes()
+
+    metadata = {
+        "manifest_checksum": checksum,
+        "size": len(data),
+        "count": len(index)
+    }
+
+    # Write the data before the metadata, so a partially written index is never considered valid
+    prefix = f'{inventoried_bucket_name}/{snapshot}/index'
+    write_cache_object(s3_client, location, f'{prefix}.arrow', data)
+    write_cache_object(s3_client, location, f'{prefix}.json', json.dumps(metadata).encode('utf-8'))
@@ -1,16 +1,49 @@
 import boto3 
+from concurrent.futures import ThreadPoolExecutor
+import collections
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import bisect
 import io
 import datetime
-import re
 import json
+import threading
+from pyspark.sql import functions as F
+
+from dataset.inventory_cache import load_cached_keys, store_cached_keys, evict_snapshots
+from dataset.key_index import build_key_index, load_key_index, store_key_index, lookup_keys
+
+# Columns of the key records returned when listing with with_metadata=True
+KEY_RECORD_COLUMNS = ['key', 'size', 'last_modified_date']
+
+# Guards loading, building and storing the key index, so that sources listed concurrently
+# share one index per snapshot instead of each building and storing its own
+key_index_lock = threading.Lock()
 
 # This lists matching keys, driven from an S3 inventory bucket. The data in this bucket
 # is generated once a day by AWS and contains a list of all keys in the source bucket, stored
 # in a collection of Parquet files.  We have to first read a manifest.json file to get the list
 # of Parquet files, then read each Parquet file to get the list of keys, and filter them based on
 # the section IDs and action. 
-def list_keys_from_inventory(section_ids, action, inventoried_bucket_name, bucket_name): 
+#
+# With scan=True each Parquet file is read through ranged GETs, projecting only the key column
+# and skipping row groups that cannot contain a matching key (see scan_parquet).
+#
+# Up to max_workers Parquet files are downloaded and parsed concurrently. Results are
+# still assembled in manifest order, so the key list (and chunk numbering) is stable.
+#
+# When cache_location is given, the keys for the action (across all sections) are read from,
+# or on first use written to, the inventory cache for the manifest's snapshot (see
+# dataset/inventory_cache.py), and only filtered by section here.
+#
+# With index=True, a (section_id, action) index over the whole snapshot is built once (and
+# stored at cache_location, when given) and the keys are looked up in it (see dataset/key_index.py).
+#
+# With with_metadata=True the result is a key records DataFrame (see key_records) carrying
+# each object's size and last modified time from the inventory, instead of a list of keys.
+def list_keys_from_inventory(section_ids, action, inventoried_bucket_name, bucket_name, scan=False, max_workers=1, cache_location=None, index=False, with_metadata=False): 
    
     s3_client = boto3.client('s3')
     
@@ -21,23 +54,146 @@ def list_keys_from_inventory(section_ids, action, inventoried_bucket_name, bucke
         if manifest_json is None:
             raise FileNotFoundError("No inventory manifest found in the last two days")
 
-        # Iterate over the Parquet files in the manifest, fetching and reading each one
-        # to get the list of keys, and filtering them based on the section IDs and action
-        all = []
-        for i in range(len(manifest_json["files"])):
-            key = manifest_json["files"][i]["key"]
-            results = fetch_parquet(section_ids, action, s3_client, bucket_name, key)
-            all.extend(results)
-            
-        return all
+        if index:
+            with key_index_lock:
+                key_index = load_key_index(s3_client, cache_location, inventoried_bucket_name, manifest_json)
+
+                # Indexes built before metadata was tracked only hold keys, and are rebuilt when it is needed
+                if key_index is None or (with_metadata and 'size' not in key_index.column_names):
+                    batches = fetch_inventory_batches(None, None, s3_client, bucket_name, manifest_json, max_workers, columns=KEY_RECORD_COLUMNS)
+                    key_index = build_key_index(batches)
+                    store_key_index(s3_client, cache_location, inventoried_bucket_name, manifest_json, key_index)
+                    if cache_location is not None:
+                        evict_snapshots(s3_client, cache_location, inventoried_bucket_name)
+
+            return lookup_keys(key_index, section_ids, action, with_metadata=with_metadata)
+
+        if cache_location is None:
+            if with_metadata:
+                return fetch_inventory_records(section_ids, action, s3_client, bucket_name, manifest_json, scan, max_workers)
+            return fetch_inventory_keys(section_ids, action, s3_client, bucket_name, manifest_json, scan, max_workers)
+
+        # The cache always holds key records, so it can serve listings with or without metadata
+        records = load_cached_keys(s3_client, cache_location, inventoried_bucket_name, manifest_json, action, with_metadata=True)
+
+        if records is None:
+            records = fetch_inventory_records(None, action, s3_client, bucket_name, manifest_json, scan, max_workers)
+            store_cached_keys(s3_client, cache_location, inventoried_bucket_name, manifest_json, action, records)
+            evict_snapshots(s3_client, cache_location, inventoried_bucket_name)
+
+            # The cache holds the keys sorted, so this run lists them in the order later runs read
+            # them back, and every run on the snapshot plans the same chunks
+            records = records.sort_values('key').reset_index(drop=True)
+
+        records = records.loc[filter_keys(records['key'], section_ids, action).index].reset_index(drop=True)
+
+        if with_metadata:
+            return records
+        return records['key'].tolist()
         
     except FileNotFoundError:
         # Bubble up so the job fails loudly instead of silently returning no data
         raise
     except Exception as e:
         print(e)
-        return []
+        return key_records() if with_metadata else []
     
+# Streaming variant of list_keys_from_inventory: keys are yielded as each Parquet file is
+# scanned (still in manifest order), so callers can start processing before the listing is
+# complete. The cache and index modes already have the full list and simply yield from it.
+def iter_keys_from_inventory(section_ids, action, inventoried_bucket_name, bucket_name, scan=False, max_workers=1, cache_location=None, index=False):
+
+    if cache_location is not None or index:
+        yield from list_keys_from_inventory(section_ids, action, inventoried_bucket_name, bucket_name,
+                                            scan=scan, max_workers=max_workers, cache_location=cache_location, index=index)
+        return
+
+    s3_client = boto3.client('s3')
+
+    try:
+        manifest_json = get_most_recent_manifest(inventoried_bucket_name, bucket_name)
+
+        if manifest_json is None:
+            raise FileNotFoundError("No inventory manifest found in the last two days")
+
+        yield from stream_inventory_keys(section_ids, action, s3_client, bucket_name, manifest_json, scan, max_workers)
+
+    except FileNotFoundError:
+        # Bubble up so the job fails loudly instead of silently returning no data
+        raise
+    except Exception as e:
+        print(e)
+
+# Spark variant of list_keys_from_inventory, for snapshots too large to bring to the driver.
+# The inventory Parquet files are read by the executors, projecting only the key column, and
+# the section ID and action are extracted from each key with column expressions. The keys are
+# then filtered by action and joined against a broadcast of the requested section IDs. The
+# result is a Spark DataFrame of the given inventory columns; no key list is built on the driver.
+def spark_inventory_keys(spark, section_ids, action, inventoried_bucket_name, bucket_name, columns=('key',)):
+    manifest_json = get_most_recent_manifest(inventoried_bucket_name, bucket_name)
+    paths = [f"s3://{bucket_name}/{file['key']}" for file in manifest_json['files']]
+
+    parts = F.split(F.col('key'), '/', 4)
+    keys = spark.read.parquet(*paths).select(*columns) \
+        .where((parts.getItem(0) == 'section') & (F.size(parts) == 4) & (parts.getItem(2) == action)) \
+        .withColumn('section_id', parts.getItem(1))
+
+    sections = spark.createDataFrame([(str(section_id),) for section_id in section_ids], ['section_id'])
+    return keys.join(F.broadcast(sections), 'section_id').select(*columns)
+
+# Fetch and read each Parquet file in the manifest to get the list of keys, filtering
+# them based on the section IDs (all sections when None) and action
+def fetch_inventory_keys(section_ids, action, s3_client, bucket_name, manifest_json, scan=False, max_workers=1):
+    return list(stream_inventory_keys(section_ids, action, s3_client, bucket_name, manifest_json, scan, max_workers))
+
+def stream_inventory_keys(section_ids, action, s3_client, bucket_name, manifest_json, scan=False, max_workers=1):
+
+    def fetch(file):
+        return fetch_parquet(section_ids, action, s3_client, bucket_name, file["key"], scan=scan, size=file.get("size"))
+
+    for results in ordered_map(fetch, manifest_json["files"], max_workers):
+        yield from results
+
+# Same as fetch_inventory_keys, but returning a key records DataFrame
+def fetch_inventory_records(section_ids, action, s3_client, bucket_name, manifest_json, scan=False, max_workers=1):
+
+    def fetch(file):
+        return fetch_parquet(section_ids, action, s3_client, bucket_name, file["key"], scan=scan, size=file.get("size"), with_metadata=True)
+
+    frames = list(ordered_map(fetch, manifest_json["files"], max_workers))
+    if not frames:
+        return key_records()
+    return pd.concat(frames, ignore_index=True)
+
+# Scan each Parquet file in the manifest, returning the matching rows as Arrow record batches
+# in manifest order. section_ids and action may be None to match any section or action.
+def fetch_inventory_batches(section_ids, action, s3_client, bucket_name, manifest_json, max_workers=1, columns=('key',)):
+
+    def fetch(file):
+        return list(scan_parquet(section_ids, action, s3_client, bucket_name, file["key"], columns=columns, size=file.get("size")))
+
+    all = []
+    for batches in ordered_map(fetch, manifest_json["files"], max_workers):
+        all.extend(batches)
+
+    return all
+
+def ordered_map(func, items, max_workers=1):
+    """
+    Apply ``func`` to ``items`` on up to ``max_workers`` threads, yielding results in input order.
+    At most ``max_workers`` results are pending at once, so results that the caller has not
+    consumed yet do not pile up in memory.
+    """
+    max_workers = max(1, max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) > max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
 # This function will return the most recent manifest file from the inventory bucket
 # It first looks for yesterday's manifest, and if that does not exist, looks for the day prior.
 #
@@ -64,8 +220,15 @@ def get_most_recent_manifest(inventoried_bucket_name, bucket_name):
     raise FileNotFoundError(f"No inventory manifest found for keys: {attempted_keys}")
     
     
-def fetch_parquet(section_ids, action, s3_client, bucket_name, key):
-    
+def fetch_parquet(section_ids, action, s3_client, bucket_name, key, scan=False, size=None, with_metadata=False):
+
+    if scan:
+        columns = KEY_RECORD_COLUMNS if with_metadata else ['key']
+        batches = list(scan_parquet(section_ids, action, s3_client, bucket_name, key, columns=columns, size=size))
+        if with_metadata:
+            return key_records_from_batches(batches)
+        return [k for batch in batches for k in batch.column('key').to_pylist()]
+
     response = s3_client.get_object(Bucket=bucket_name, Key=key)
     
     # Read the Parquet file content
@@ -75,51 +238,297 @@ def fetch_parquet(section_ids, action, s3_client, bucket_name, key):
     parquet_buffer = io.BytesIO(parquet_file_content)
     df = pd.read_parquet(parquet_buffer)
 
-    key_values = df['key'].tolist()
+    # Filter the DataFrame
+    filtered_df = df.loc[filter_keys(df['key'], section_ids, action).index]
 
-    # Create the regex pattern to match the desired keys
-    section_pattern = '|'.join(map(lambda x: re.escape(str(x)), section_ids))
-    pattern = rf'section/({section_pattern})/{action}/'
+    if with_metadata:
+        return key_records(filtered_df['key'], filtered_df['size'], filtered_df['last_modified_date'])
 
-    # Filter the DataFrame
-    filtered_df = df[df['key'].str.contains(pattern)]
     key_values = filtered_df['key'].tolist()
 
     return key_values
 
+
+def key_records(keys=(), sizes=(), last_modified_dates=()):
+    """
+    Build a key records DataFrame, with one row per object holding its 'key', 'size' in bytes
+    and 'last_modified_date' (UTC). The columns are plain arrays, so even millions of records
+    stay far more compact than per-key Python objects.
+    """
+    return pd.DataFrame({
+        'key': pd.Series(list(keys), dtype=object),
+        'size': pd.Series(list(sizes), dtype='int64'),
+        'last_modified_date': pd.to_datetime(pd.Series(list(last_modified_dates), dtype=object), utc=True)
+    })
+
+
+def key_records_from_batches(batches):
+    """Build a key records DataFrame from Arrow record batches holding the KEY_RECORD_COLUMNS."""
+    if not batches:
+        return key_records()
+
+    df = pa.Table.from_batches(batches).select(KEY_RECORD_COLUMNS).to_pandas()
+    df['last_modified_date'] = pd.to_datetime(df['last_modified_date'], utc=True)
+    return df
+
+
+def filter_keys(keys, section_ids, action):
+    """Filter a pandas Series of keys down to those for the given section IDs and action (either may be None to match any)."""
+    mask = match_keys(pa.array(keys, type=pa.string()), section_ids, action)
+    return keys[mask.to_numpy(zero_copy_only=False)]
+
+
+def match_keys(keys, section_ids, action):
+    """
+    Boolean mask over an Arrow array of keys, true for keys of the form
+    'section/{section_id}/{action}/...' with section_id in ``section_ids`` (either may be None
+    to match any). Keys are split into path segments and the section segment is checked
+    against a hash set, so the cost is linear in the number of keys and independent of how
+    many sections are requested.
+    """
+    # Pad with separators so every key splits into at least four segments; keys
+    # that are actually too short are excluded by the separator count
+    parts = pc.split_pattern(pc.binary_join_element_wise(keys, '///', ''), '/', max_splits=3)
+
+    mask = pc.and_(
+        pc.equal(pc.list_element(parts, 0), 'section'),
+        pc.greater_equal(pc.count_substring(keys, '/'), 3)
+    )
+
+    if action is not None:
+        mask = pc.and_(mask, pc.equal(pc.list_element(parts, 2), action))
+
+    if section_ids is not None:
+        section_set = pa.array(sorted({str(section_id) for section_id in section_ids}), type=pa.string())
+        mask = pc.and_(mask, pc.is_in(pc.list_element(parts, 1), value_set=section_set))
+
+    return pc.fill_null(mask, False)
+
+
+def scan_parquet(section_ids, action, s3_client, bucket_name, key, columns=('key',), size=None, batch_size=65536):
+    """
+    Stream the matching rows of one inventory Parquet file as Arrow record batches.
+
+    Only the requested columns are read (the inventory also carries 'size' and
+    'last_modified_date', which can be asked for here), and row groups whose min/max
+    statistics on 'key' rule out every 'section/{id}/{action}/' prefix are never fetched.
+    The file itself is read with ranged GETs, so skipped row groups and unprojected columns
+    never leave S3.
+    """
+    columns = list(columns)
+    if 'key' not in columns:
+        columns.insert(0, 'key')
+
+    parquet_file = pq.ParquetFile(S3ObjectFile(s3_client, bucket_name, key, size=size))
+    key_index = parquet_file.schema_arrow.get_field_index('key')
+
+    # Without specific sections, matching keys can be anywhere and every row group is read
+    row_groups = list(range(parquet_file.num_row_groups))
+    if section_ids is not None:
+        prefixes = sorted(f'section/{section_id}/{action}/' for section_id in section_ids)
+        row_groups = [i for i in row_groups
+                      if row_group_may_match(parquet_file.metadata.row_group(i).column(key_index).statistics, prefixes)]
+
+    if not row_groups:
+        return
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=columns):
+        filtered = batch.filter(match_keys(batch.column('key'), section_ids, action))
+        if filtered.num_rows > 0:
+            yield filtered
+
+
+def row_group_may_match(statistics, prefixes):
+    """
+    Decide from a row group's key statistics whether it can hold a key starting with
+    one of ``prefixes`` (sorted). The section prefixes never nest in one another, so the
+    ranges [prefix, prefix_upper_bound(prefix)) are disjoint and it is enough to check
+    the last prefix that sorts at or before the row group's max key.
+    """
+    if statistics is None or not statistics.has_min_max:
+        return True
+
+    low, high = statistics.min, statistics.max
+    if isinstance(low, bytes):
+        low, high = low.decode('utf-8'), high.decode('utf-8')
+
+    i = bisect.bisect_right(prefixes, high) - 1
+    return i >= 0 and prefix_upper_bound(prefixes[i]) > low
+
+
+def prefix_upper_bound(prefix):
+    """Smallest string that sorts after every string starting with ``prefix``."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class S3ObjectFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over an S3 object that fetches only the byte
+    ranges actually read. Parquet readers seek to the footer and then to individual
+    column chunks, so this avoids downloading the whole object.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, size=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        if size is None:
+            size = s3_client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+
+        end = min(self.position + len(buffer), self.size) - 1
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key, Range=f'bytes={self.position}-{end}')
+        data = response['Body'].read()
+
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
 # This function lists all keys in a bucket that match the specified section ID and action
 # It uses the S3 client to list all objects in the bucket, and filters them based on the
 # section ID and action. This is not as efficient as using the inventory, but can be used
 # when the inventory is not available - or when consistency is of higher concern.
-def list_keys(bucket_name, section_id, action):
+#
+# With start_after, only keys sorting after that key are listed (see list_keys_after), and an
+# existing s3_client can be passed in to be shared across calls (see list_keys_for_sections).
+def list_keys(bucket_name, section_id, action, with_metadata=False, start_after=None, s3_client=None):
     
     # Create a session using the specified profile
     
-    s3_client = boto3.client('s3')
+    if s3_client is None:
+        s3_client = boto3.client('s3')
     
     files = []
+    sizes = []
+    last_modified_dates = []
     
     prefix = f"section/{section_id}/{action}/"
 
     # Pagination handling
     continuation_token = None
 
+    start = {'StartAfter': start_after} if start_after else {}
+
     while True:
         # List objects with pagination
         if continuation_token:
-            response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, ContinuationToken=continuation_token)
+            response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, ContinuationToken=continuation_token, **start)
         else:
-            response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
+            response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, **start)
         
         # Check if the response contains 'Contents'
         if 'Contents' in response:
             # Append the keys to the list
             files.extend([obj['Key'] for obj in response['Contents']])
 
+            if with_metadata:
+                sizes.extend([obj['Size'] for obj in response['Contents']])
+                last_modified_dates.extend([obj['LastModified'] for obj in response['Contents']])
+
         # Check if there is a continuation token
         if response.get('IsTruncated'):
             continuation_token = response.get('NextContinuationToken')
         else:
             break
+
+    if with_metadata:
+        return key_records(files, sizes, last_modified_dates)
             
     return files
+
+# This function lists the keys for many sections at once. Each section's prefix is listed,
+# with its own sequential pagination, on a bounded pool of threads sharing a single S3 client,
+# and the keys are yielded section by section in the order of section_ids as each listing
+# completes. At most max_workers sections are listed ahead of the consumer.
+#
+# start_after optionally maps section IDs (as strings) to the key to start listing after.
+def list_keys_for_sections(bucket_name, section_ids, action, max_workers=8, start_after=None):
+    for keys in list_sections(bucket_name, section_ids, action, max_workers=max_workers, start_after=start_after):
+        yield from keys
+
+def list_sections(bucket_name, section_ids, action, max_workers=8, with_metadata=False, start_after=None):
+    """Yield the list_keys result for each of ``section_ids``, in order, listing up to ``max_workers`` sections concurrently."""
+    s3_client = boto3.client('s3')
+    start_after = start_after or {}
+
+    def list_section(section_id):
+        return list_keys(bucket_name, section_id, action, with_metadata=with_metadata,
+                         start_after=start_after.get(str(section_id)), s3_client=s3_client)
+
+    return ordered_map(list_section, section_ids, max_workers)
+
+# The inventory is one to two days old, so it misses the newest events. These functions
+# layer a freshness delta on top of an inventory listing: for each section, only the keys
+# sorting after the last key the inventory has for that section's prefix are listed live
+# (using StartAfter), and merged with the inventory keys. Event keys are written with
+# increasing names, so this finds the objects added since the snapshot at a small fraction
+# of the cost of a full listing.
+
+def merge_fresh_keys(keys, section_ids, action, bucket_name, max_workers=1):
+    """Add the keys newer than the inventory to ``keys``, a list of keys or a key records DataFrame."""
+    if isinstance(keys, pd.DataFrame):
+        last_keys = latest_keys_by_section(keys['key'])
+        fresh = list_keys_after(bucket_name, section_ids, action, last_keys, with_metadata=True, max_workers=max_workers)
+        return pd.concat([keys, fresh], ignore_index=True)
+
+    last_keys = latest_keys_by_section(keys)
+    return keys + list_keys_after(bucket_name, section_ids, action, last_keys, max_workers=max_workers)
+
+def iter_fresh_keys(keys, section_ids, action, bucket_name, max_workers=1):
+    """Streaming variant of merge_fresh_keys: yields ``keys``, then the keys newer than the inventory."""
+    last_keys = {}
+    for key in keys:
+        record_latest_key(last_keys, key)
+        yield key
+
+    yield from list_keys_after(bucket_name, section_ids, action, last_keys, max_workers=max_workers)
+
+def latest_keys_by_section(keys):
+    """Map each section ID (as a string) to the greatest of its keys."""
+    last_keys = {}
+    for key in keys:
+        record_latest_key(last_keys, key)
+    return last_keys
+
+def record_latest_key(last_keys, key):
+    section_id = key.split('/', 2)[1]
+    if key > last_keys.get(section_id, ''):
+        last_keys[section_id] = key
+
+def list_keys_after(bucket_name, section_ids, action, last_keys, with_metadata=False, max_workers=1):
+    """
+    List the keys of each section that sort after its entry in ``last_keys``. Sections with no
+    entry (no keys in the inventory yet) are listed in full.
+    """
+    results = list(list_sections(bucket_name, section_ids, action, max_workers=max_workers,
+                                 with_metadata=with_metadata, start_after=last_keys))
+
+    if with_metadata:
+        return pd.concat(results, ignore_index=True) if results else key_records()
+
+    return [key for keys in results for key in keys]
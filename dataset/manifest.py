@@ -1,6 +1,13 @@
 import json 
 
-def build_json_manifest(s3_client, context, num_chunks, extension):
+# When the chunks were not saved as chunk_0 .. chunk_{num_chunks - 1}, chunk_keys gives
+# the key of each chunk, relative to the results bucket.
+def chunk_urls(prefix, job_id, num_chunks, extension, chunk_keys=None):
+    if chunk_keys is not None:
+        return [f"{prefix}{key}" for key in chunk_keys]
+    return [f"{prefix}{job_id}/chunk_{i}.{extension}" for i in range(num_chunks)]
+
+def build_json_manifest(s3_client, context, num_chunks, extension, chunk_keys=None):
 
     bucket = context["bucket_name"]
     job_id = context["job_id"]
@@ -10,7 +17,7 @@ def build_json_manifest(s3_client, context, num_chunks, extension):
     # as URLs to the S3 objects
     manifest = {
         "context": context,
-        "chunks": [f"{prefix}{job_id}/chunk_{i}.{extension}" for i in range(num_chunks)]
+        "chunks": chunk_urls(prefix, job_id, num_chunks, extension, chunk_keys)
     }
 
     # upload the manifest to S3 into the job_id directory:
@@ -20,7 +27,7 @@ def build_json_manifest(s3_client, context, num_chunks, extension):
 
     return manifest_key
 
-def build_html_manifest(s3_client, context, num_chunks, extension):
+def build_html_manifest(s3_client, context, num_chunks, extension, chunk_keys=None):
 
     bucket = context["bucket_name"]
     job_id = context["job_id"]
@@ -39,8 +46,8 @@ def build_html_manifest(s3_client, context, num_chunks, extension):
     html += "</table>\n"
 
     html += "<ul>"
-    for i in range(num_chunks):
-        html += f'<li><a href="{prefix}{job_id}/chunk_{i}.{extension}">{prefix}{job_id}/chunk_{i}.{extension}</a></li>'
+    for url in chunk_urls(prefix, job_id, num_chunks, extension, chunk_keys):
+        html += f'<li><a href="{url}">{url}</a></li>'
 
     html += "</ul></body></html>"
 
@@ -4,7 +4,7 @@ import boto3
 from dataset.utils import prune_fields
 from dataset.lookup import determine_student_id
 
-def page_viewed_handler(bucket_key, context, excluded_indices):
+def page_viewed_handler(bucket_key, context, excluded_indices, s3_client=None):
     """
     Entry point for page viewed extraction. Never raise so Spark job keeps going.
     """
@@ -12,8 +12,9 @@ def page_viewed_handler(bucket_key, context, excluded_indices):
         # Use the key to read in the file contents, split on line endings
         bucket_name, key = bucket_key
 
-        # Create a session using the specified profile
-        s3_client = boto3.client('s3')
+        # Create a session using the specified profile, unless one is shared with us
+        if s3_client is None:
+            s3_client = boto3.client('s3')
         
         response = s3_client.get_object(Bucket=bucket_name, Key=key)
 
@@ -0,0 +1,258 @@
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType, StructField, StringType, ArrayType
+
+# An alternative to the Python event handlers for the attempt_evaluated and page_viewed
+# exports: the JSONL objects are read by Spark's native JSON reader with an explicit schema,
+# filtered with column predicates, projected to the columns of the event registry and
+# written as CSV by Spark, so no event is ever parsed or formatted in Python.
+#
+# Each output column is described by the path of its source field in the xAPI statement, how
+# its value is encoded, and (for attempts) the kinds of attempt that carry it. The read schema
+# holds the paths of all of the action's fields, plus the fields the filters need. Every leaf
+# is read as a string (or an array of strings), which Spark fills with the raw JSON text of
+# numbers and objects, so values are written as they appear in the source.
+#
+# The events are kept as the Python handlers keep them: lines that are not valid JSON are
+# dropped, and so are events missing any field the handler reads for their kind of event (the
+# handlers skip those on a KeyError), whether or not that field is an output column. Spark
+# cannot tell a missing field from a null one, so events with a null in such a field are
+# dropped too.
+
+EXTENSION_PREFIX = "http://oli.cmu.edu/extensions/"
+
+QUESTION_TYPE = "http://adlnet.gov/expapi/activities/question"
+ACTIVITY_ATTEMPT_TYPE = "http://oli.cmu.edu/extensions/activity_attempt"
+PAGE_ATTEMPT_TYPE = "http://oli.cmu.edu/extensions/page_attempt"
+
+ALL_ATTEMPTS = ("part", "activity", "page")
+
+
+def extension(name):
+    return ("context", "extensions", EXTENSION_PREFIX + name)
+
+
+STUDENT_PATH = ("actor", "account", "name")
+OBJECT_TYPE_PATH = ("object", "definition", "type")
+
+# Column -> (source path, encoding, attempt kinds). Encodings are 'value' (as is), 'array'
+# (as encode_array) and 'json' (as encode_json); 'student' resolves the student ID.
+attempts_fields = {
+    "event_type": (("object", "definition", "name", "en-US"), "value", ALL_ATTEMPTS),
+    "timestamp": (("timestamp",), "value", ALL_ATTEMPTS),
+    "user_id": (STUDENT_PATH, "student", ALL_ATTEMPTS),
+    "section_id": (extension("section_id"), "value", ALL_ATTEMPTS),
+    "project_id": (extension("project_id"), "value", ALL_ATTEMPTS),
+    "publication_id": (extension("publication_id"), "value", ALL_ATTEMPTS),
+    "page_id": (extension("page_id"), "value", ALL_ATTEMPTS),
+    "activity_id": (extension("activity_id"), "value", ("part", "activity")),
+    "activity_revision_id": (extension("activity_revision_id"), "value", ("part", "activity")),
+    "attached_objectives": (extension("attached_objectives"), "array", ("part",)),
+    "page_attempt_guid": (extension("page_attempt_guid"), "value", ALL_ATTEMPTS),
+    "page_attempt_number": (extension("page_attempt_number"), "value", ALL_ATTEMPTS),
+    "part_id": (extension("part_id"), "value", ("part",)),
+    "part_attempt_guid": (extension("part_attempt_guid"), "value", ("part",)),
+    "part_attempt_number": (extension("part_attempt_number"), "value", ("part",)),
+    "activity_attempt_number": (extension("activity_attempt_number"), "value", ("part", "activity")),
+    "activity_attempt_guid": (extension("activity_attempt_guid"), "value", ("part", "activity")),
+    "score": (("result", "score", "raw"), "value", ALL_ATTEMPTS),
+    "out_of": (("result", "score", "max"), "value", ALL_ATTEMPTS),
+    "response": (("result", "response"), "json", ("part",)),
+    "feedback": (("result", "extensions", EXTENSION_PREFIX + "feedback"), "json", ("part",)),
+    "hints": (extension("hints_requested"), "array", ("part",)),
+}
+
+page_viewed_fields = {
+    "event_type": (None, "page_viewed", None),
+    "timestamp": (("timestamp",), "value", None),
+    "user_id": (STUDENT_PATH, "student", None),
+    "section_id": (extension("section_id"), "value", None),
+    "project_id": (extension("project_id"), "value", None),
+    "publication_id": (extension("publication_id"), "value", None),
+    "page_id": (extension("page_id"), "value", None),
+    "page_attempt_guid": (extension("page_attempt_guid"), "value", None),
+    "page_attempt_number": (extension("page_attempt_number"), "value", None),
+}
+
+spark_json_fields = {
+    "attempt_evaluated": attempts_fields,
+    "page_viewed": page_viewed_fields,
+}
+
+
+def event_schema(action):
+    """The read schema for the fields of an action, plus the fields the filters need."""
+    fields = spark_json_fields[action]
+
+    leaves = {STUDENT_PATH: StringType(), extension("project_id"): StringType(), extension("page_id"): StringType()}
+    if action == "attempt_evaluated":
+        leaves[OBJECT_TYPE_PATH] = StringType()
+
+    for path, encoding, _ in fields.values():
+        if path is not None:
+            leaves[path] = ArrayType(StringType()) if encoding == "array" else StringType()
+
+    # Nest the leaves into a tree of structs, by path
+    tree = {}
+    for path, data_type in leaves.items():
+        node = tree
+        for name in path[:-1]:
+            node = node.setdefault(name, {})
+        node[path[-1]] = data_type
+
+    return to_struct(tree)
+
+
+def to_struct(tree):
+    return StructType([
+        StructField(name, to_struct(value) if isinstance(value, dict) else value, True)
+        for name, value in tree.items()
+    ])
+
+
+def field(path):
+    column = F.col(path[0])
+    for name in path[1:]:
+        column = column.getField(name)
+    return column
+
+
+def s3_path(bucket_name, key):
+    return f"s3://{bucket_name}/{key}"
+
+
+def read_events(spark, bucket_name, keys, action):
+    """Read the JSONL objects with the schema for the action, dropping lines that are not valid JSON."""
+    paths = [s3_path(bucket_name, key) for key in keys]
+    return spark.read.schema(event_schema(action)).option("mode", "DROPMALFORMED").json(paths)
+
+
+def has_fields(fields, kind=None):
+    """A predicate that the event holds every field (for the given kind of attempt) the handler reads."""
+    present = F.lit(True)
+    for path, _, kinds in fields.values():
+        if path is not None and (kind is None or kind in kinds):
+            present = present & field(path).isNotNull()
+    return present
+
+
+def filter_events(events, context):
+    """Apply the job's student, project and page filters as column predicates."""
+    ignored = [str(student_id) for student_id in context["ignored_student_ids"]]
+    if ignored:
+        events = events.where(~field(STUDENT_PATH).isin(ignored))
+
+    if context["project_id"] is not None:
+        events = events.where(field(extension("project_id")) == str(context["project_id"]))
+
+    if context["page_ids"] is not None:
+        events = events.where(field(extension("page_id")).isin([str(page_id) for page_id in context["page_ids"]]))
+
+    return events
+
+
+def attempt_kinds(context):
+    """Column predicates, by attempt kind, for the attempts selected by the job's sub types."""
+    subtypes = context["sub_types"]
+    object_type = field(OBJECT_TYPE_PATH)
+
+    kinds = {}
+    if "part_attempt_evaluated" in subtypes or "part_attempt_evaluted" in subtypes:
+        kinds["part"] = object_type == QUESTION_TYPE
+    if "activity_attempt_evaluated" in subtypes:
+        kinds["activity"] = object_type == ACTIVITY_ATTEMPT_TYPE
+    if "page_attempt_evaluated" in subtypes or "page_attempt_evaluted" in subtypes:
+        kinds["page"] = object_type == PAGE_ATTEMPT_TYPE
+    return kinds
+
+
+def encode_column(column, encoding, student_id):
+    if encoding == "student":
+        return student_id
+    if encoding == "array":
+        return F.concat(F.lit('"'), F.concat_ws(",", column), F.lit('"'))
+    if encoding == "json":
+        return F.concat(F.lit('"'), column, F.lit('"'))
+    return column
+
+
+def join_student_emails(spark, events, context):
+    """
+    Add the 'student_id' column, as determine_student_id: the account name when anonymizing,
+    otherwise the user's email from the lookup (falling back to the account name).
+    """
+    if context["anonymize"] == True:
+        return events.withColumn("student_id", field(STUDENT_PATH))
+
+    users = [(str(user_id), user.get("email")) for user_id, user in context["lookup"].get("users", {}).items()]
+    emails = spark.createDataFrame(users, "lookup_user_id string, lookup_email string")
+
+    events = events.join(F.broadcast(emails), field(STUDENT_PATH) == F.col("lookup_user_id"), "left")
+    return events.withColumn("student_id", F.coalesce(F.col("lookup_email"), field(STUDENT_PATH)))
+
+
+def event_frame(spark, bucket_name, keys, action, columns, context):
+    """A DataFrame of the output columns of the action, for the events in the given keys."""
+    fields = spark_json_fields[action]
+
+    events = filter_events(read_events(spark, bucket_name, keys, action), context)
+
+    kinds = None
+    if action == "attempt_evaluated":
+        kinds = attempt_kinds(context)
+        selected = F.lit(False)
+        for kind, predicate in kinds.items():
+            selected = selected | (predicate & has_fields(fields, kind))
+        events = events.where(selected)
+    else:
+        events = events.where(has_fields(fields))
+
+    events = join_student_emails(spark, events, context)
+
+    selection = []
+    for column in columns:
+        path, encoding, attempt_kinds_with_column = fields[column]
+
+        if path is None:
+            value = F.lit(encoding)
+        else:
+            value = encode_column(field(path), encoding, F.col("student_id"))
+
+        # Columns that only some kinds of attempt carry are null for the others
+        if kinds is not None and attempt_kinds_with_column != ALL_ATTEMPTS:
+            present = F.lit(False)
+            for kind in attempt_kinds_with_column:
+                if kind in kinds:
+                    present = present | kinds[kind]
+            value = F.when(present, value)
+
+        selection.append(value.cast("string").alias(column))
+
+    return events.select(*selection)
+
+
+def write_event_csv(spark, s3_client, bucket_name, keys, action, columns, context):
+    """
+    Write the dataset for the keys as CSV files under {job_id}/csv/ in the results bucket, and
+    return the keys of the written files, in order.
+    """
+    if not keys:
+        return []
+
+    frame = event_frame(spark, bucket_name, keys, action, columns, context)
+
+    writer = frame.write.mode("overwrite").option("header", True).option("escape", '"')
+    if context.get("output_chunk_rows"):
+        writer = writer.option("maxRecordsPerFile", context["output_chunk_rows"])
+
+    prefix = f'{context["job_id"]}/csv/'
+    writer.csv(s3_path(context["results_bucket_name"], prefix))
+
+    return list_written_chunks(s3_client, context["results_bucket_name"], prefix, ".csv")
+
+
+def list_written_chunks(s3_client, bucket_name, prefix, extension):
+    chunk_keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        chunk_keys.extend(obj['Key'] for obj in page.get('Contents', []) if obj['Key'].endswith(extension))
+    return sorted(chunk_keys)
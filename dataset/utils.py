@@ -1,5 +1,11 @@
 
+import itertools
 import json
+import math
+
+import boto3
+import pyarrow as pa
+from pyspark.rdd import portable_hash
 
 def encode_array(v):
     """
@@ -16,18 +22,205 @@ def encode_json(json_obj):
     json_str = json.dumps(json_obj, separators=(',', ':'))  # Compact JSON format
     return '"' + json_str.replace('\n', '') + '"'
 
-def parallel_map(sc, bucket_name, keys, map_func, context, columns):
+def broadcast_context(sc, context):
+    """
+    A copy of the context for Spark tasks, with the lookup replaced by a broadcast variable, so
+    the lookup is shipped to each executor once and deserialized once per executor process,
+    instead of being pickled into every task. The parallel_* functions restore it on the
+    executors (see resolve_context).
+    """
+    task_context = {key: value for key, value in context.items() if key != 'lookup'}
+    task_context['lookup_broadcast'] = sc.broadcast(context.get('lookup', {}))
+    return task_context
+
+def resolve_context(context):
+    """The context as handlers expect it, with a broadcast lookup (if any) in place of 'lookup'."""
+    lookup_broadcast = context.get('lookup_broadcast')
+    if lookup_broadcast is None:
+        return context
+    return {**context, 'lookup': lookup_broadcast.value}
+
+class PartitionHandler:
+    """
+    Runs an event handler over the keys of a Spark partition. setup(context) builds what all of
+    the partition's keys share once: the handler's context (with the lookup restored and the
+    ID filters as sets) and an S3 client. process(key) handles one key with those, and
+    teardown() releases them. Handlers accept the client through an s3_client argument.
+    """
+
+    def __init__(self, map_func, columns):
+        self.map_func = map_func
+        self.columns = columns
+        self.context = None
+        self.s3_client = None
+
+    def setup(self, context):
+        self.context = compile_filters(resolve_context(context))
+        self.s3_client = boto3.client('s3')
+
+    def process(self, bucket_key):
+        return self.map_func(bucket_key, self.context, self.columns, s3_client=self.s3_client)
+
+    def teardown(self):
+        self.context = None
+        self.s3_client = None
+
+def compile_filters(context):
+    """The context with the student and page ID filters as sets, for constant time membership tests."""
+    compiled = dict(context)
+    if compiled.get("ignored_student_ids") is not None:
+        compiled["ignored_student_ids"] = frozenset(compiled["ignored_student_ids"])
+    if compiled.get("page_ids") is not None:
+        compiled["page_ids"] = frozenset(compiled["page_ids"])
+    return compiled
+
+def process_partition_keys(map_func, context, columns, partition_keys):
+    """
+    Yield the results of map_func for each (bucket_name, key) pair of a partition. With the
+    partition_handlers option, the keys go through a PartitionHandler.
+    """
+    if not context.get("partition_handlers", False):
+        task_context = resolve_context(context)
+        for key in partition_keys:
+            yield from map_func(key, task_context, columns)
+        return
+
+    handler = PartitionHandler(map_func, columns)
+    handler.setup(context)
+    try:
+        for key in partition_keys:
+            yield from handler.process(key)
+    finally:
+        handler.teardown()
+
+def task_partitions(num_keys, total_bytes, cores, target_task_bytes):
+    """
+    The number of partitions (tasks) for num_keys keys holding total_bytes of input (None when not
+    known), on a cluster with the given number of executor cores. There are enough partitions for
+    each to hold about target_task_bytes, and at least one per core so every core has work, but
+    never more than there are keys, so no partition is empty.
+    """
+    partitions = cores
+    if total_bytes is not None:
+        partitions = max(cores, math.ceil(total_bytes / target_task_bytes))
+    return max(1, min(num_keys, partitions))
+
+def parallelize_keys(sc, bucket_keys, context, num_partitions=None, total_bytes=None):
+    """
+    An RDD of the (bucket_name, key) pairs. Unless the caller sizes the partitions explicitly,
+    they are sized with task_partitions when the context has a target_task_bytes, and otherwise
+    left to Spark's default partitioning.
+    """
+    if num_partitions is None and context.get("target_task_bytes"):
+        num_partitions = task_partitions(len(bucket_keys), total_bytes, sc.defaultParallelism, context["target_task_bytes"])
+
+    if num_partitions is None:
+        return sc.parallelize(bucket_keys)
+    return sc.parallelize(bucket_keys, max(1, num_partitions))
+
+def parallel_map(sc, bucket_name, keys, map_func, context, columns, num_partitions=None, total_bytes=None):
     
     bucket_keys = [(bucket_name, key) for key in keys]
     
-    pkeys = sc.parallelize(bucket_keys)
-    activation = pkeys.flatMap(lambda key: map_func(key, context, columns))
+    # Spark's default partitioning, unless the partitions are sized explicitly or by the input
+    pkeys = parallelize_keys(sc, bucket_keys, context, num_partitions, total_bytes)
+    if context.get("partition_handlers", False):
+        activation = pkeys.mapPartitions(lambda partition_keys: process_partition_keys(map_func, context, columns, partition_keys))
+    else:
+        activation = pkeys.flatMap(lambda key: map_func(key, resolve_context(context), columns))
     
     # Collect the results to the driver and print them
     results = activation.collect()
     
     return results
 
+def parallel_map_batches(sc, bucket_name, keys, map_func, context, columns, column_names, num_partitions=None, total_bytes=None):
+    """
+    Same as parallel_map, but each partition's results are returned to the driver as a single
+    Arrow IPC stream instead of pickled Python objects, and combined into one Arrow table.
+    The results are rows (lists), stored as string columns with the given column_names.
+    """
+    bucket_keys = [(bucket_name, key) for key in keys]
+    pkeys = parallelize_keys(sc, bucket_keys, context, num_partitions, total_bytes)
+
+    def process_partition(partition_keys):
+        results = list(process_partition_keys(map_func, context, columns, partition_keys))
+        yield results_to_stream(results, column_names)
+
+    streams = pkeys.mapPartitions(process_partition).collect()
+    return table_from_streams(streams, column_names)
+
+def results_to_stream(results, column_names):
+    """Serialize rows (see parallel_map_batches) as an Arrow IPC stream."""
+    table = pa.table({
+        name: pa.array([None if row[index] is None else str(row[index]) for row in results], type=pa.string())
+        for index, name in enumerate(column_names)
+    })
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def table_from_streams(streams, column_names):
+    """Combine the Arrow IPC streams of each partition into one table."""
+    tables = [pa.ipc.open_stream(stream).read_all() for stream in streams]
+    tables = [table for table in tables if table.num_columns > 0]
+
+    if not tables:
+        return pa.table({name: pa.array([], type=pa.string()) for name in column_names})
+
+    return pa.concat_tables(tables, promote_options='default')
+
+def parallel_records(sc, bucket_name, keys, map_func, context, columns, num_partitions=None, total_bytes=None):
+    """Same as parallel_map, but returns the RDD of results instead of collecting them."""
+    bucket_keys = [(bucket_name, key) for key in keys]
+    pkeys = parallelize_keys(sc, bucket_keys, context, num_partitions, total_bytes)
+    return pkeys.mapPartitions(lambda partition_keys: process_partition_keys(map_func, context, columns, partition_keys))
+
+def sorted_groups(records, group_key, sort_key=None, num_partitions=None):
+    """
+    Group an RDD of records by group_key(record) with a shuffle on the cluster, sorting each group
+    by sort_key(record). Every record of a group lands in the same partition, sorted next to each
+    other, so each partition is turned into its (group, [records]) pairs in a single pass.
+    """
+    if num_partitions is None:
+        num_partitions = records.getNumPartitions()
+
+    def key_record(record):
+        return ((group_key(record), sort_key(record) if sort_key is not None else ()), record)
+
+    def group_partition(keyed_records):
+        for group, group_records in itertools.groupby(keyed_records, lambda keyed_record: keyed_record[0][0]):
+            yield group, [record for _, record in group_records]
+
+    return (records.map(key_record)
+            .repartitionAndSortWithinPartitions(max(1, num_partitions), lambda key: portable_hash(key[0]))
+            .mapPartitions(group_partition))
+
+def distribute_keys(sc, bucket_name, key_chunks):
+    """An RDD of (bucket_name, key) pairs with one partition per chunk of keys, in chunk order."""
+
+    chunks = [[(bucket_name, key) for key in chunk_keys] for chunk_keys in key_chunks]
+    if not chunks:
+        return sc.emptyRDD()
+
+    # With as many slices as chunks, each chunk lands in a partition of its own
+    return sc.parallelize(chunks, len(chunks)).flatMap(lambda chunk: chunk)
+
+def parallel_write(bucket_keys, map_func, context, columns, write_chunk):
+    """
+    Process an RDD of (bucket_name, key) pairs partition by partition on the executors, where
+    write_chunk(partition_index, rows) saves each partition's rows as a chunk of its own and
+    returns its metadata. Only that metadata is collected to the driver, in partition order.
+    """
+
+    def process_partition(partition_index, partition_keys):
+        rows = list(process_partition_keys(map_func, context, columns, partition_keys))
+        yield write_chunk(partition_index, rows)
+
+    return bucket_keys.mapPartitionsWithIndex(process_partition).collect()
+
 def prune_fields(record, excluded_indices):
     """Remove fields at the specified indices from ``record``.
 
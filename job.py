@@ -19,6 +19,31 @@ if __name__ == "__main__":
     parser.add_argument("--exclude_fields", required=False, help="List of fields to exclude")
     parser.add_argument("--enforce_project_id", required=False, help="Project id to ensure the data is from this project")
     parser.add_argument("--debug", required=False, help="Enables detailed logging for debugging purposes")
+    parser.add_argument("--inventory_scan", required=False, help="Read only the needed columns and row groups of the inventory Parquet files")
+    parser.add_argument("--inventory_workers", required=False, default="4", help="Number of inventory Parquet files to fetch concurrently")
+    parser.add_argument("--inventory_cache", required=False, help="Local directory or s3://bucket/prefix to cache inventory keys per snapshot")
+    parser.add_argument("--inventory_index", required=False, help="Look up keys in a per snapshot section/action index of the inventory")
+    parser.add_argument("--stream_keys", required=False, help="Start processing chunks while the inventory is still being listed")
+    parser.add_argument("--fresh_keys", required=False, help="Also list the objects added since the inventory snapshot")
+    parser.add_argument("--live_keys", required=False, help="List every section's prefix directly instead of using the inventory")
+    parser.add_argument("--spark_inventory", required=False, help="Scan the inventory with Spark, keeping the keys distributed and saving each chunk from the executors")
+    parser.add_argument("--chunk_bytes", required=False, help="Plan chunks of keys to hold about this many bytes of input, using the objects' sizes")
+    parser.add_argument("--output_chunk_rows", required=False, help="Write CSV chunks of this many rows, independent of the chunks of keys")
+    parser.add_argument("--pipeline_uploads", required=False, default="0", help="Number of chunk uploads that may run in the background while the next chunk is processed")
+    parser.add_argument("--executor_writes", required=False, help="Save each chunk from the executors instead of collecting results to the driver")
+    parser.add_argument("--single_job", required=False, help="Process and save all keys in one Spark job from the executors, splitting chunks so every core has a task")
+    parser.add_argument("--broadcast_lookup", required=False, help="Ship the lookup data to the executors as a Spark broadcast variable")
+    parser.add_argument("--partition_handlers", required=False, help="Run event handlers once per partition, sharing an S3 client and filters across its keys")
+    parser.add_argument("--spark_json", required=False, help="Read and write attempt_evaluated and page_viewed events with Spark's JSON reader and CSV writer")
+    parser.add_argument("--arrow_results", required=False, help="Return CSV rows from the executors to the driver as Arrow record batches (not used by DataShop exports)")
+    parser.add_argument("--checkpoint", required=False, help="Save the job's planned and completed chunks, so a rerun with the same job_id resumes it")
+    parser.add_argument("--distributed_sessions", required=False, help="Group and sort DataShop part attempts by session on the cluster; the driver still receives every raw part attempt, a partition at a time, to render it (see --executor_rendering)")
+    parser.add_argument("--executor_rendering", required=False, help="Render DataShop sessions to XML and write the XML chunks on the executors")
+    parser.add_argument("--streaming_xml", required=False, help="Write DataShop XML chunks as messages are rendered, uploading them in parts")
+    parser.add_argument("--concurrent_sources", required=False, help="List and process DataShop attempt_evaluated and tutor_message keys concurrently (with --distributed_sessions, all the grouped tutor sessions are then collected to the driver at once)")
+    parser.add_argument("--xml_chunk_bytes", required=False, help="Cut DataShop XML chunks at about this many bytes, never splitting a problem across chunks")
+    parser.add_argument("--target_task_bytes", required=False, default="134217728", help="Size Spark partitions of keys to hold about this many bytes of input each (0 for Spark's default partitioning)")
+    parser.add_argument("--listing_workers", required=False, default="8", help="Number of section prefixes to list concurrently")
 
     args = parser.parse_args()
 
@@ -44,6 +69,30 @@ if __name__ == "__main__":
     project_id = guarentee_int(project_id)
 
     debug = args.debug == "true"
+    inventory_scan = args.inventory_scan == "true"
+    inventory_workers = int(args.inventory_workers)
+    inventory_index = args.inventory_index == "true"
+    stream_keys = args.stream_keys == "true"
+    fresh_keys = args.fresh_keys == "true"
+    live_keys = args.live_keys == "true"
+    listing_workers = int(args.listing_workers)
+    spark_inventory = args.spark_inventory == "true"
+    chunk_bytes = int(args.chunk_bytes) if args.chunk_bytes else None
+    output_chunk_rows = int(args.output_chunk_rows) if args.output_chunk_rows else None
+    pipeline_uploads = int(args.pipeline_uploads)
+    executor_writes = args.executor_writes == "true"
+    single_job = args.single_job == "true"
+    broadcast_lookup = args.broadcast_lookup == "true"
+    partition_handlers = args.partition_handlers == "true"
+    spark_json = args.spark_json == "true"
+    arrow_results = args.arrow_results == "true"
+    checkpoint = args.checkpoint == "true"
+    distributed_sessions = args.distributed_sessions == "true"
+    executor_rendering = args.executor_rendering == "true"
+    streaming_xml = args.streaming_xml == "true"
+    concurrent_sources = args.concurrent_sources == "true"
+    xml_chunk_bytes = int(args.xml_chunk_bytes) if args.xml_chunk_bytes else None
+    target_task_bytes = int(args.target_task_bytes) if args.target_task_bytes else 0
 
     context = {
         "bucket_name": bucket_name,
@@ -59,7 +108,32 @@ if __name__ == "__main__":
         "exclude_fields": exclude_fields,
         "project_id": project_id,
         "anonymize": anonymize, 
-        "debug": debug
+        "debug": debug,
+        "inventory_scan": inventory_scan,
+        "inventory_workers": inventory_workers,
+        "inventory_cache": args.inventory_cache,
+        "inventory_index": inventory_index,
+        "stream_keys": stream_keys,
+        "fresh_keys": fresh_keys,
+        "live_keys": live_keys,
+        "listing_workers": listing_workers,
+        "spark_inventory": spark_inventory,
+        "chunk_bytes": chunk_bytes,
+        "output_chunk_rows": output_chunk_rows,
+        "pipeline_uploads": pipeline_uploads,
+        "executor_writes": executor_writes,
+        "single_job": single_job,
+        "broadcast_lookup": broadcast_lookup,
+        "partition_handlers": partition_handlers,
+        "spark_json": spark_json,
+        "arrow_results": arrow_results,
+        "checkpoint": checkpoint,
+        "target_task_bytes": target_task_bytes,
+        "distributed_sessions": distributed_sessions,
+        "executor_rendering": executor_rendering,
+        "streaming_xml": streaming_xml,
+        "concurrent_sources": concurrent_sources,
+        "xml_chunk_bytes": xml_chunk_bytes
     }
 
     action = args.action
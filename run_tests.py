@@ -24,7 +24,7 @@ def main():
     
     commands = {
         "core": {
-            "cmd": "source env/bin/activate && python -m unittest tests.test_utils tests.test_event_registry tests.test_lookup tests.test_manifest tests.test_keys -v",
+            "cmd": "source env/bin/activate && python -m unittest tests.test_utils tests.test_event_registry tests.test_lookup tests.test_manifest tests.test_keys tests.test_inventory_cache tests.test_key_index tests.test_spark_json tests.test_job_state tests.test_chunk_writer -v",
             "desc": "Running core module tests"
         },
         "all": {
@@ -0,0 +1,147 @@
+import unittest
+from unittest.mock import Mock
+
+from dataset.chunk_writer import XmlChunkWriter
+
+
+def mock_s3_client():
+    """An S3 client recording the objects and multipart uploads written through it."""
+    s3_client = Mock()
+    s3_client.objects = {}
+    uploads = {}
+
+    def put_object(Bucket, Key, Body):
+        s3_client.objects[Key] = Body
+
+    def create_multipart_upload(Bucket, Key):
+        uploads[Key] = []
+        return {'UploadId': f'upload-{Key}'}
+
+    def upload_part(Bucket, Key, PartNumber, UploadId, Body):
+        uploads[Key].append(Body)
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(Bucket, Key, UploadId, MultipartUpload):
+        s3_client.objects[Key] = b''.join(uploads.pop(Key))
+
+    s3_client.put_object.side_effect = put_object
+    s3_client.create_multipart_upload.side_effect = create_multipart_upload
+    s3_client.upload_part.side_effect = upload_part
+    s3_client.complete_multipart_upload.side_effect = complete_multipart_upload
+    return s3_client
+
+
+class TestXmlChunkWriter(unittest.TestCase):
+
+    def test_chunks_by_message_count(self):
+        s3_client = mock_s3_client()
+
+        with XmlChunkWriter(s3_client, "results", "job/", "<seq>", "</seq>", 2) as writer:
+            writer.extend(["<m>1</m>", "<m>2</m>", "<m>3</m>"])
+
+        self.assertEqual(writer.chunk_keys, ["job/chunk_0.xml", "job/chunk_1.xml"])
+        self.assertEqual(s3_client.objects["job/chunk_0.xml"], b"<seq>\n<m>1</m>\n<m>2</m>\n</seq>")
+        self.assertEqual(s3_client.objects["job/chunk_1.xml"], b"<seq>\n<m>3</m>\n</seq>")
+        s3_client.create_multipart_upload.assert_not_called()
+
+    def test_uploads_large_chunks_in_parts(self):
+        s3_client = mock_s3_client()
+
+        with XmlChunkWriter(s3_client, "results", "job/", "<seq>", "</seq>", 100, part_size=16) as writer:
+            writer.extend([f"<m>{i}</m>" for i in range(5)])
+
+        self.assertEqual(writer.number_of_chunks, 1)
+        self.assertEqual(s3_client.objects["job/chunk_0.xml"], ("<seq>" + "".join(f"\n<m>{i}</m>" for i in range(5)) + "\n</seq>").encode('utf-8'))
+        self.assertEqual(s3_client.upload_part.call_count, 3)
+        parts = s3_client.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts']
+        self.assertEqual([part['PartNumber'] for part in parts], [1, 2, 3])
+
+    def test_chunks_by_size_without_splitting_problems(self):
+        s3_client = mock_s3_client()
+        start = '<context_message name="START_PROBLEM" />'
+        attempt = '<tool_message />'
+
+        # Each problem takes 57 bytes, so two of them fit in 140 bytes with the prefix and suffix
+        with XmlChunkWriter(s3_client, "results", "job/", "<seq>", "</seq>", 1, max_bytes=140) as writer:
+            writer.extend([start, attempt, start, attempt])
+            writer.extend([start, attempt])
+
+        self.assertEqual(writer.chunk_keys, ["job/chunk_0.xml", "job/chunk_1.xml"])
+        self.assertEqual(s3_client.objects["job/chunk_0.xml"], f"<seq>\n{start}\n{attempt}\n{start}\n{attempt}\n</seq>".encode('utf-8'))
+        self.assertEqual(s3_client.objects["job/chunk_1.xml"], f"<seq>\n{start}\n{attempt}\n</seq>".encode('utf-8'))
+        self.assertEqual([chunk["messages"] for chunk in writer.chunks], [4, 2])
+        self.assertEqual([chunk["bytes"] for chunk in writer.chunks], [len(s3_client.objects[key]) for key in writer.chunk_keys])
+
+    def test_oversized_problem_gets_its_own_chunk(self):
+        s3_client = mock_s3_client()
+        start = '<context_message name="START_PROBLEM" />'
+
+        with XmlChunkWriter(s3_client, "results", "job/", "<seq>", "</seq>", 1, max_bytes=20, chunk_name="chunk_3") as writer:
+            writer.extend([start, '<tool_message />'])
+            writer.extend([start])
+
+        self.assertEqual(writer.chunk_keys, ["job/chunk_3_0.xml", "job/chunk_3_1.xml"])
+        self.assertEqual([chunk["messages"] for chunk in writer.chunks], [2, 1])
+
+    def test_no_messages_writes_no_chunks(self):
+        s3_client = mock_s3_client()
+
+        with XmlChunkWriter(s3_client, "results", "job/", "<seq>", "</seq>", 2) as writer:
+            writer.extend([])
+
+        self.assertEqual(writer.number_of_chunks, 0)
+        s3_client.put_object.assert_not_called()
+
+    def test_failed_part_aborts_upload(self):
+        s3_client = mock_s3_client()
+        s3_client.upload_part.side_effect = Exception("expired credentials")
+
+        with self.assertRaises(Exception):
+            with XmlChunkWriter(s3_client, "results", "job/", "<seq>", "</seq>", 100, part_size=16) as writer:
+                writer.extend(["<m>first</m>", "<m>second</m>"])
+
+        s3_client.abort_multipart_upload.assert_called_once_with(Bucket="results", Key="job/chunk_0.xml", UploadId="upload-job/chunk_0.xml")
+        self.assertEqual(writer.number_of_chunks, 0)
+
+    def test_skips_messages_that_failed_to_render(self):
+        s3_client = mock_s3_client()
+
+        with XmlChunkWriter(s3_client, "results", "job/", "<seq>", "</seq>", 2, max_bytes=1000) as writer:
+            writer.extend(['<context_message name="START_PROBLEM"/>', None, "<m>1</m>"])
+            writer.write(None)
+
+        self.assertEqual(writer.skipped_messages, 2)
+        self.assertEqual(s3_client.objects["job/chunk_0.xml"],
+                         b'<seq>\n<context_message name="START_PROBLEM"/>\n<m>1</m>\n</seq>')
+
+    def test_failed_chunks_are_reported_and_skipped(self):
+        s3_client = mock_s3_client()
+        put_object = s3_client.put_object.side_effect
+        puts = []
+
+        def throttled_put_object(Bucket, Key, Body):
+            puts.append(Key)
+            if len(puts) == 1:
+                raise Exception("throttled")
+            put_object(Bucket, Key, Body)
+
+        s3_client.put_object.side_effect = throttled_put_object
+        s3_client.upload_part.side_effect = Exception("expired credentials")
+        errors = []
+
+        with XmlChunkWriter(s3_client, "results", "job/", "<seq>", "</seq>", 2, part_size=32,
+                            on_error=lambda chunk_index, e: errors.append((chunk_index, str(e)))) as writer:
+            writer.extend(["<m>1</m>", "<m>2</m>"])
+            writer.extend(["<m>3</m>", "<m>4-long-enough-for-a-part</m>"])
+            writer.extend(["<m>5</m>"])
+
+        # The first chunk fails to upload and the second fails mid-upload; the third is written
+        # under the first free name
+        self.assertEqual(errors, [(0, "throttled"), (0, "expired credentials")])
+        s3_client.abort_multipart_upload.assert_called_once_with(Bucket="results", Key="job/chunk_0.xml", UploadId="upload-job/chunk_0.xml")
+        self.assertEqual(writer.chunk_keys, ["job/chunk_0.xml"])
+        self.assertEqual(s3_client.objects["job/chunk_0.xml"], b"<seq>\n<m>5</m>\n</seq>")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 from unittest.mock import Mock, MagicMock
 import pandas as pd
 import io
+from botocore.exceptions import ClientError
 
 # Sample xAPI event data
 SAMPLE_PART_ATTEMPT_EVENT = {
@@ -249,6 +250,26 @@ def create_mock_s3_client():
     
     return mock_client
 
+def mock_s3_client(objects):
+    """An S3 client storing objects in the given dict, by key."""
+    s3_client = Mock()
+
+    def paginate(Bucket, Prefix):
+        return [{'Contents': [{'Key': key} for key in sorted(objects) if key.startswith(Prefix)]}]
+
+    def get_object(Bucket, Key):
+        if Key not in objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(objects[Key])}
+
+    def put_object(Bucket, Key, Body):
+        objects[Key] = Body
+
+    s3_client.get_object.side_effect = get_object
+    s3_client.put_object.side_effect = put_object
+    s3_client.get_paginator.return_value.paginate.side_effect = paginate
+    return s3_client
+
 def create_mock_spark_context():
     """Create a mock Spark context."""
     mock_sc = Mock()
@@ -263,6 +284,37 @@ def create_mock_spark_context():
     
     return mock_sc
 
+class LocalRDD:
+    """An in-memory stand-in for the RDD operations used by the shuffles, one list per partition."""
+
+    def __init__(self, partitions):
+        self.partitions = partitions
+
+    def getNumPartitions(self):
+        return len(self.partitions)
+
+    def map(self, func):
+        return LocalRDD([[func(item) for item in partition] for partition in self.partitions])
+
+    def mapPartitions(self, func):
+        return LocalRDD([list(func(iter(partition))) for partition in self.partitions])
+
+    def mapPartitionsWithIndex(self, func):
+        return LocalRDD([list(func(index, iter(partition))) for index, partition in enumerate(self.partitions)])
+
+    def repartitionAndSortWithinPartitions(self, num_partitions, partition_func):
+        partitions = [[] for _ in range(num_partitions)]
+        for partition in self.partitions:
+            for key, value in partition:
+                partitions[partition_func(key) % num_partitions].append((key, value))
+        return LocalRDD([sorted(partition, key=lambda item: item[0]) for partition in partitions])
+
+    def toLocalIterator(self, prefetchPartitions=False):
+        return iter([item for partition in self.partitions for item in partition])
+
+    def collect(self):
+        return [item for partition in self.partitions for item in partition]
+
 def create_sample_part_attempt():
     """Create a sample parsed part attempt."""
     return {
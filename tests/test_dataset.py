@@ -2,15 +2,20 @@ import unittest
 from unittest.mock import Mock, patch, MagicMock, call
 import pandas as pd
 import io
+import json
 import math
+import os
+import threading
 from dataset.dataset import (
     generate_dataset, generate_datashop, initialize_spark_context,
     calculate_number_of_chunks, chunkify, save_chunk_to_s3, save_xml_chunk,
-    build_manifests
+    build_manifests, plan_chunks, split_chunks, ChunkUploader
 )
+from dataset.keys import key_records
+from dataset.event_registry import attempts_columns
 from tests.test_data import (
     SAMPLE_CONTEXT, SAMPLE_LOOKUP_DATA, create_mock_s3_client, 
-    create_mock_spark_context, create_sample_part_attempt
+    create_mock_spark_context, create_sample_part_attempt, LocalRDD, mock_s3_client
 )
 
 class TestDataset(unittest.TestCase):
@@ -123,6 +128,335 @@ class TestDataset(unittest.TestCase):
         # Verify cleanup
         mock_sc.stop.assert_called_once()
 
+    @patch.dict(os.environ, {"PYTHONHASHSEED": "0"})
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.save_xml_chunk')
+    @patch('dataset.dataset.process_tutor_messages')
+    @patch('dataset.dataset.process_part_attempts')
+    @patch('dataset.dataset.parallel_records')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_datashop_distributed_sessions(self, mock_boto, mock_init_spark, mock_list_keys,
+                                                    mock_retrieve_lookup, mock_parallel_map, mock_parallel_records,
+                                                    mock_process_attempts, mock_process_tutor, mock_save_xml, mock_build_manifests):
+
+        context_distributed = self.sample_context.copy()
+        context_distributed['distributed_sessions'] = True
+
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (Mock(), Mock())
+        mock_list_keys.return_value = ['key1', 'key2']
+        mock_retrieve_lookup.return_value = SAMPLE_LOOKUP_DATA
+
+        def attempt(user_id, part_id):
+            return {'section_id': 1001, 'user_id': user_id, 'session_id': 'sess', 'page_attempt_guid': 'page1',
+                    'activity_id': 1, 'activity_attempt_number': 1, 'part_id': part_id, 'part_attempt_number': 1}
+
+        mock_parallel_records.side_effect = [
+            LocalRDD([[attempt('123', 'part2'), attempt('456', 'part1')], [attempt('123', 'part1')]]),
+            LocalRDD([]),
+        ]
+        mock_process_attempts.side_effect = lambda part_attempts, context: [f"{a['user_id']}/{a['part_id']}" for a in part_attempts]
+
+        generate_datashop(context_distributed)
+
+        # The part attempts never come back through parallel_map, and each session is sorted
+        mock_parallel_map.assert_not_called()
+        self.assertEqual(mock_parallel_records.call_args_list[0][0][2], ['key1', 'key2'])
+        sessions = sorted([(a['user_id'], a['part_id']) for a in c[0][0]] for c in mock_process_attempts.call_args_list)
+        self.assertEqual(sessions, [[('123', 'part1'), ('123', 'part2')], [('456', 'part1')]])
+        mock_process_tutor.assert_not_called()
+
+    @patch.dict(os.environ, {"PYTHONHASHSEED": "0"})
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.process_tutor_messages')
+    @patch('dataset.dataset.process_part_attempts')
+    @patch('dataset.dataset.parallel_records')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_datashop_executor_rendering(self, mock_boto, mock_init_spark, mock_list_keys,
+                                                  mock_retrieve_lookup, mock_parallel_records,
+                                                  mock_process_attempts, mock_process_tutor, mock_build_manifests):
+
+        context_rendering = self.sample_context.copy()
+        context_rendering['executor_rendering'] = True
+        context_rendering['chunk_size'] = 2
+
+        mock_sc = Mock()
+        mock_sc.broadcast.side_effect = lambda value: Mock(value=value)
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (mock_sc, Mock())
+        mock_list_keys.return_value = ['key1']
+        mock_retrieve_lookup.return_value = SAMPLE_LOOKUP_DATA
+
+        attempts = [{'section_id': 1001, 'user_id': '123', 'session_id': 'sess', 'part_id': f'part{i}'} for i in range(3)]
+        mock_parallel_records.side_effect = [LocalRDD([attempts]), LocalRDD([])]
+        lookups = []
+        mock_process_attempts.side_effect = lambda part_attempts, context: lookups.append(context['lookup']) or [f"<m>{a['part_id']}</m>" for a in part_attempts]
+
+        result = generate_datashop(context_rendering)
+
+        # The session's three messages are written as two chunks by the executor
+        chunk_keys = [f"{context_rendering['job_id']}/chunk_0_0.xml", f"{context_rendering['job_id']}/chunk_0_1.xml"]
+        self.assertEqual(result, 2)
+        self.assertEqual(mock_build_manifests.call_args[1]['chunk_keys'], chunk_keys)
+        bodies = {c[1]['Key']: c[1]['Body'].decode('utf-8') for c in self.mock_s3_client.put_object.call_args_list}
+        self.assertIn("<m>part0</m>\n<m>part1</m>", bodies[chunk_keys[0]])
+        self.assertTrue(bodies[chunk_keys[1]].endswith("<m>part2</m>\n</tutor_related_message_sequence>"))
+        self.assertEqual(lookups, [SAMPLE_LOOKUP_DATA])
+        mock_process_tutor.assert_not_called()
+
+        # The lookup is broadcast once, without broadcast_lookup, instead of pickled into each task
+        mock_sc.broadcast.assert_called_once_with(SAMPLE_LOOKUP_DATA)
+        self.assertNotIn('lookup', mock_parallel_records.call_args[0][4])
+
+    @patch.dict(os.environ, {"PYTHONHASHSEED": "0"})
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.process_tutor_messages')
+    @patch('dataset.dataset.process_part_attempts')
+    @patch('dataset.dataset.parallel_records')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_datashop_executor_rendering_failures(self, mock_boto, mock_init_spark, mock_list_keys,
+                                                           mock_retrieve_lookup, mock_parallel_records,
+                                                           mock_process_attempts, mock_process_tutor, mock_build_manifests):
+
+        context_rendering = self.sample_context.copy()
+        context_rendering['executor_rendering'] = True
+
+        mock_sc = Mock()
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (mock_sc, Mock())
+        mock_list_keys.return_value = ['key1']
+        mock_retrieve_lookup.return_value = SAMPLE_LOOKUP_DATA
+
+        # The attempts job fails outright, and one tutor message fails to render
+        tutor_messages = [{'section_id': 1001, 'user_id': '123', 'session_id': 'sess', 'n': n} for n in range(2)]
+        mock_parallel_records.side_effect = [Exception("stage failed"), LocalRDD([tutor_messages])]
+        mock_process_tutor.side_effect = lambda messages, context: [None, "<m>tutor</m>"]
+
+        result = generate_datashop(context_rendering)
+
+        # The tutor messages that rendered are still written, and the job finishes with its manifests
+        tutor_chunk_key = f"{context_rendering['job_id']}/tutor_chunk_0_0.xml"
+        self.assertEqual(result, 1)
+        self.assertEqual(mock_build_manifests.call_args[1]['chunk_keys'], [tutor_chunk_key])
+        body = self.mock_s3_client.put_object.call_args[1]['Body'].decode('utf-8')
+        self.assertIn("<m>tutor</m>", body)
+        self.assertNotIn("None", body)
+        mock_sc.stop.assert_called_once()
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.save_xml_chunk')
+    @patch('dataset.dataset.process_part_attempts')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_datashop_streaming_xml(self, mock_boto, mock_init_spark, mock_list_keys,
+                                             mock_retrieve_lookup, mock_parallel_map,
+                                             mock_process_attempts, mock_save_xml, mock_build_manifests):
+
+        context_streaming = self.sample_context.copy()
+        context_streaming['streaming_xml'] = True
+        context_streaming['chunk_size'] = 2
+
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (Mock(), Mock())
+        mock_list_keys.return_value = ['key1']
+        mock_retrieve_lookup.return_value = SAMPLE_LOOKUP_DATA
+        mock_parallel_map.side_effect = [
+            [{**create_sample_part_attempt(), 'user_id': user_id, 'session_id': 'sess'} for user_id in ('1', '2', '3')],
+            [],
+        ]
+        mock_process_attempts.side_effect = lambda part_attempts, context: [f"<m>{a['user_id']}</m>" for a in part_attempts]
+
+        result = generate_datashop(context_streaming)
+
+        # Three messages, written as they are rendered into chunks of two
+        self.assertEqual(result, 2)
+        mock_save_xml.assert_not_called()
+        bodies = {c[1]['Key']: c[1]['Body'] for c in self.mock_s3_client.put_object.call_args_list}
+        job_id = context_streaming['job_id']
+        self.assertIn(b"<m>1</m>\n<m>2</m>\n</tutor_related_message_sequence>", bodies[f"{job_id}/chunk_0.xml"])
+        self.assertIn(b"<m>3</m>\n</tutor_related_message_sequence>", bodies[f"{job_id}/chunk_1.xml"])
+        self.assertEqual(mock_build_manifests.call_args[0][2], 2)
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.process_tutor_messages')
+    @patch('dataset.dataset.process_part_attempts')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_datashop_streaming_xml_failed_tutor_message(self, mock_boto, mock_init_spark, mock_list_keys,
+                                                                  mock_retrieve_lookup, mock_parallel_map, mock_process_attempts,
+                                                                  mock_process_tutor, mock_build_manifests):
+
+        context_streaming = self.sample_context.copy()
+        context_streaming['xml_chunk_bytes'] = 10000
+
+        mock_sc = Mock()
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (mock_sc, Mock())
+        mock_list_keys.return_value = ['key1']
+        mock_retrieve_lookup.return_value = SAMPLE_LOOKUP_DATA
+        mock_parallel_map.side_effect = [
+            [{**create_sample_part_attempt(), 'session_id': 'attempts'}],
+            [{'section_id': 1001, 'user_id': '1', 'session_id': 'tutor'}],
+        ]
+        mock_process_attempts.return_value = ['<m>attempt</m>']
+
+        # process_tutor_message returns None for a message it fails to render
+        mock_process_tutor.return_value = [None, '<m>tutor</m>']
+
+        result = generate_datashop(context_streaming)
+
+        # The failed message is left out, and the export finishes with its manifests
+        self.assertEqual(result, 1)
+        body = self.mock_s3_client.put_object.call_args[1]['Body']
+        self.assertIn(b"<m>attempt</m>\n<m>tutor</m>", body)
+        self.assertEqual(mock_build_manifests.call_args[0][2], 1)
+        mock_sc.stop.assert_called_once()
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.process_part_attempts')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_datashop_streaming_xml_upload_error(self, mock_boto, mock_init_spark, mock_list_keys,
+                                                          mock_retrieve_lookup, mock_parallel_map,
+                                                          mock_process_attempts, mock_build_manifests):
+
+        context_streaming = self.sample_context.copy()
+        context_streaming['streaming_xml'] = True
+        context_streaming['distributed_sessions'] = True
+        context_streaming['chunk_size'] = 1
+
+        mock_sc = Mock()
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (mock_sc, Mock())
+        mock_list_keys.return_value = ['key1']
+        mock_retrieve_lookup.return_value = SAMPLE_LOOKUP_DATA
+        self.mock_s3_client.put_object.side_effect = [Exception("throttled"), None]
+
+        sessions = [('1', [{'user_id': '1'}]), ('2', [{'user_id': '2'}])]
+        mock_process_attempts.side_effect = lambda part_attempts, context: [f"<m>{a['user_id']}</m>" for a in part_attempts]
+
+        with patch('dataset.dataset.distributed_session_groups', side_effect=[iter(sessions), iter([])]):
+            result = generate_datashop(context_streaming)
+
+        # The first chunk fails to upload; the second session is still written, and the job
+        # finishes with its manifests
+        self.assertEqual(result, 1)
+        self.assertEqual(mock_build_manifests.call_args[0][2], 1)
+        self.assertIn(b"<m>2</m>", self.mock_s3_client.put_object.call_args[1]['Body'])
+        mock_sc.stop.assert_called_once()
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.save_xml_chunk')
+    @patch('dataset.dataset.process_tutor_messages')
+    @patch('dataset.dataset.process_part_attempts')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_datashop_concurrent_sources(self, mock_boto, mock_init_spark, mock_list_keys,
+                                                  mock_retrieve_lookup, mock_parallel_map, mock_process_attempts,
+                                                  mock_process_tutor, mock_save_xml, mock_build_manifests):
+
+        context_concurrent = self.sample_context.copy()
+        context_concurrent['concurrent_sources'] = True
+
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (Mock(), Mock())
+        mock_list_keys.side_effect = lambda section_ids, action, *args, **kwargs: [f'{action}.jsonl']
+        mock_retrieve_lookup.return_value = SAMPLE_LOOKUP_DATA
+
+        # The attempts are only processed while the tutor messages are being processed too
+        tutor_started = threading.Event()
+        overlapped = []
+        def process_keys(sc, bucket, keys, *args, **kwargs):
+            if keys == ['tutor_message.jsonl']:
+                tutor_started.set()
+                return [{'section_id': 1001, 'user_id': '1', 'session_id': 'tutor'}]
+            overlapped.append(tutor_started.wait(5))
+            return [{'section_id': 1001, 'user_id': '1', 'session_id': 'attempt'}]
+        mock_parallel_map.side_effect = process_keys
+        mock_process_attempts.return_value = ['<attempt/>']
+        mock_process_tutor.return_value = ['<tutor/>']
+
+        result = generate_datashop(context_concurrent)
+
+        self.assertEqual(result, 1)
+        self.assertEqual(overlapped, [True])
+
+        # The messages are merged as before, attempts first
+        self.assertEqual(mock_save_xml.call_args[0][0][1:-1], ['<attempt/>', '<tutor/>'])
+
+    @patch.dict(os.environ, {"PYTHONHASHSEED": "0"})
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.save_xml_chunk')
+    @patch('dataset.dataset.process_tutor_messages')
+    @patch('dataset.dataset.process_part_attempts')
+    @patch('dataset.dataset.parallel_records')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.iter_keys_from_inventory')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_datashop_concurrent_distributed_sessions(self, mock_boto, mock_init_spark, mock_list_keys,
+                                                               mock_retrieve_lookup, mock_parallel_records, mock_process_attempts,
+                                                               mock_process_tutor, mock_save_xml, mock_build_manifests):
+
+        context_concurrent = self.sample_context.copy()
+        context_concurrent['concurrent_sources'] = True
+        context_concurrent['distributed_sessions'] = True
+        context_concurrent['stream_keys'] = True
+
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (Mock(), Mock())
+        mock_retrieve_lookup.return_value = SAMPLE_LOOKUP_DATA
+
+        # Both the listing and the grouping job for the tutor messages run on the second thread
+        listed_on = {}
+        def list_keys(section_ids, action, *args, **kwargs):
+            listed_on[action] = threading.current_thread()
+            yield f'{action}.jsonl'
+        mock_list_keys.side_effect = list_keys
+
+        local_collect = LocalRDD.collect
+        collected_on = []
+        def collect(rdd):
+            collected_on.append(threading.current_thread())
+            return local_collect(rdd)
+
+        mock_parallel_records.side_effect = lambda sc, bucket, keys, *args, **kwargs: LocalRDD([[
+            {'section_id': 1001, 'user_id': '1', 'session_id': keys[0]}
+        ]])
+        mock_process_attempts.return_value = ['<attempt/>']
+        mock_process_tutor.return_value = ['<tutor/>']
+
+        with patch.object(LocalRDD, 'collect', collect):
+            result = generate_datashop(context_concurrent)
+
+        # The attempt sessions stream in on the main thread, and only the tutor sessions are collected
+        self.assertEqual(result, 1)
+        self.assertIsNot(listed_on['tutor_message'], threading.main_thread())
+        self.assertEqual(collected_on, [listed_on['tutor_message']])
+        self.assertEqual(mock_save_xml.call_args[0][0][1:-1], ['<attempt/>', '<tutor/>'])
+
     def test_generate_datashop_grouping_logic(self):
         """Test the grouping and sorting logic for datashop generation."""
         
@@ -356,6 +690,346 @@ class TestDataset(unittest.TestCase):
         # parallel_map should be called 3 times (once per chunk)
         self.assertEqual(mock_parallel_map.call_count, 3)
 
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.save_chunk_to_s3')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.iter_keys_from_inventory')
+    @patch('dataset.dataset.get_event_config')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_dataset_streaming_keys(self, mock_boto, mock_init_spark, mock_get_config,
+                                             mock_iter_keys, mock_retrieve_lookup, mock_parallel_map,
+                                             mock_save_chunk, mock_build_manifests):
+
+        context_streaming = self.sample_context.copy()
+        context_streaming['chunk_size'] = 2
+        context_streaming['stream_keys'] = True
+
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (Mock(), Mock())
+        mock_get_config.return_value = (Mock(), ['col1', 'col2'])
+        mock_retrieve_lookup.return_value = {}
+        mock_parallel_map.return_value = [['data']]
+
+        listed = []
+        def key_generator():
+            for key in ['key1', 'key2', 'key3', 'key4', 'key5']:
+                listed.append(key)
+                yield key
+        mock_iter_keys.return_value = key_generator()
+
+        # Record how many keys had been listed when each chunk was dispatched
+        listed_at_dispatch = []
+        mock_parallel_map.side_effect = lambda *args, **kwargs: listed_at_dispatch.append(len(listed)) or [['data']]
+
+        result = generate_dataset([1001], "attempt_evaluated", context_streaming)
+
+        self.assertEqual(result, 3)
+        self.assertEqual(listed_at_dispatch, [2, 4, 5])
+        self.assertEqual(mock_build_manifests.call_args[0][2], 3)
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.parallel_write')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.spark_inventory_keys')
+    @patch('dataset.dataset.get_event_config')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_dataset_spark_inventory(self, mock_boto, mock_init_spark, mock_get_config,
+                                              mock_spark_keys, mock_retrieve_lookup, mock_parallel_map,
+                                              mock_parallel_write, mock_build_manifests):
+
+        context_spark = self.sample_context.copy()
+        context_spark['chunk_size'] = 2
+        context_spark['spark_inventory'] = True
+
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (Mock(), Mock())
+        mock_get_config.return_value = (Mock(), ['col1', 'col2'])
+        mock_retrieve_lookup.return_value = {}
+        mock_spark_keys.return_value.cache.return_value.count.return_value = 5
+        mock_parallel_write.return_value = [
+            {"key": f"test-job-123/chunk_{index}.csv", "rows": 1, "bytes": 10} for index in range(3)
+        ]
+
+        result = generate_dataset([1001], "attempt_evaluated", context_spark)
+
+        # The keys stay in Spark, repartitioned into one partition per chunk, and all of the
+        # chunks are written from the executors in a single job
+        self.assertEqual(result, 3)
+        repartitioned = mock_spark_keys.return_value.cache.return_value.repartition
+        repartitioned.assert_called_once_with(3)
+        mock_parallel_write.assert_called_once()
+        self.assertIs(mock_parallel_write.call_args[0][0], repartitioned.return_value.rdd.map.return_value)
+        mock_parallel_map.assert_not_called()
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.write_event_csv')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.get_event_config')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_dataset_spark_json(self, mock_boto, mock_init_spark, mock_get_config, mock_list_keys, mock_retrieve_lookup,
+                                         mock_parallel_map, mock_write_event_csv, mock_build_manifests):
+
+        context_spark_json = self.sample_context.copy()
+        context_spark_json['spark_json'] = True
+        context_spark_json['exclude_fields'] = ['feedback']
+
+        mock_spark = Mock()
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (Mock(), mock_spark)
+        mock_get_config.return_value = (Mock(), list(attempts_columns))
+        mock_retrieve_lookup.return_value = {}
+        mock_list_keys.return_value = ['key1', 'key2']
+        chunk_keys = ['test-job-123/csv/part-00000.csv', 'test-job-123/csv/part-00001.csv']
+        mock_write_event_csv.return_value = chunk_keys
+
+        result = generate_dataset([1001], "attempt_evaluated", context_spark_json)
+
+        # The events are written by Spark, with the excluded columns left out
+        self.assertEqual(result, 2)
+        mock_parallel_map.assert_not_called()
+        spark, s3_client, bucket_name, keys, action, columns, _ = mock_write_event_csv.call_args[0]
+        self.assertIs(spark, mock_spark)
+        self.assertEqual((bucket_name, keys, action), ('test-bucket', ['key1', 'key2'], 'attempt_evaluated'))
+        self.assertNotIn('feedback', columns)
+        self.assertIn('response', columns)
+        self.assertEqual(mock_build_manifests.call_args[1]['chunk_keys'], chunk_keys)
+
+    def test_plan_chunks(self):
+        self.assertEqual(plan_chunks(['a', 'b', 'c', 'd', 'e'], [40, 50, 30, 200, 10], 100),
+                         [['a', 'b'], ['c'], ['d'], ['e']])
+        self.assertEqual(plan_chunks(['a', 'b', 'c'], [1, 1, 1], 100, max_items=2), [['a', 'b'], ['c']])
+        self.assertEqual(plan_chunks([], [], 100), [])
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.save_chunk_to_s3')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.get_event_config')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_dataset_byte_and_row_chunks(self, mock_boto, mock_init_spark, mock_get_config,
+                                                  mock_list_keys, mock_retrieve_lookup, mock_parallel_map,
+                                                  mock_save_chunk, mock_build_manifests):
+
+        context_bytes = self.sample_context.copy()
+        context_bytes['chunk_bytes'] = 100
+        context_bytes['output_chunk_rows'] = 2
+
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (Mock(), Mock())
+        mock_get_config.return_value = (Mock(), ['col1'])
+        mock_retrieve_lookup.return_value = {}
+        mock_list_keys.return_value = key_records(['key1', 'key2', 'key3'], [60, 60, 30], ['2024-01-01T00:00:00Z'] * 3)
+        mock_parallel_map.side_effect = lambda sc, bucket, keys, *args, **kwargs: [[key] for key in keys for _ in range(3)]
+
+        result = generate_dataset([1001], "attempt_evaluated", context_bytes)
+
+        # Keys are planned by size ([key1], [key2, key3]) and the 9 rows written in chunks of 2
+        self.assertTrue(mock_list_keys.call_args[1]['with_metadata'])
+        self.assertEqual([c[0][2] for c in mock_parallel_map.call_args_list], [['key1'], ['key2', 'key3']])
+        self.assertEqual([c[1]['total_bytes'] for c in mock_parallel_map.call_args_list], [60, 90])
+        self.assertEqual([len(c[0][0]) for c in mock_save_chunk.call_args_list], [2, 2, 2, 2, 1])
+        self.assertEqual([c[0][4] for c in mock_save_chunk.call_args_list], [0, 1, 2, 3, 4])
+        self.assertEqual(result, 5)
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.save_chunk_to_s3')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.get_event_config')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_dataset_pipelined_uploads(self, mock_boto, mock_init_spark, mock_get_config,
+                                                mock_list_keys, mock_retrieve_lookup, mock_parallel_map,
+                                                mock_save_chunk, mock_build_manifests):
+
+        context_pipelined = self.sample_context.copy()
+        context_pipelined['chunk_size'] = 1
+        context_pipelined['pipeline_uploads'] = 1
+
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (Mock(), Mock())
+        mock_get_config.return_value = (Mock(), ['col1'])
+        mock_retrieve_lookup.return_value = {}
+        mock_list_keys.return_value = ['key1', 'key2']
+
+        # The first upload only completes once the second chunk is being processed
+        second_chunk_started = threading.Event()
+        mock_parallel_map.side_effect = lambda sc, bucket, keys, *args, **kwargs: (keys == ['key2'] and second_chunk_started.set()) or [['data']]
+        first_upload_overlapped = []
+        mock_save_chunk.side_effect = lambda *args, **kwargs: args[4] == 0 and first_upload_overlapped.append(second_chunk_started.wait(5))
+
+        result = generate_dataset([1001], "attempt_evaluated", context_pipelined)
+
+        self.assertEqual(result, 2)
+        self.assertEqual(first_upload_overlapped, [True])
+        self.assertEqual(sorted(c[0][4] for c in mock_save_chunk.call_args_list), [0, 1])
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.save_chunk_to_s3')
+    @patch('dataset.dataset.parallel_map')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.get_event_config')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_dataset_resumes_from_checkpoint(self, mock_boto, mock_init_spark, mock_get_config,
+                                                      mock_list_keys, mock_retrieve_lookup, mock_parallel_map,
+                                                      mock_save_chunk, mock_build_manifests):
+
+        context_checkpoint = self.sample_context.copy()
+        context_checkpoint['checkpoint'] = True
+
+        # An earlier run planned two chunks and completed the first
+        objects = {
+            'test-job-123/job_state/plan.json': json.dumps({
+                "key_chunks": [["key1"], ["key2", "key3"]],
+                "chunk_bytes": [100, 300],
+            }).encode('utf-8'),
+            'test-job-123/job_state/completed/chunk_0.json': json.dumps({"rows": 1}).encode('utf-8'),
+        }
+        mock_boto.return_value = mock_s3_client(objects)
+        mock_init_spark.return_value = (Mock(), Mock())
+        mock_get_config.return_value = (Mock(), ['col1'])
+        mock_retrieve_lookup.return_value = {}
+        mock_parallel_map.return_value = [['data'], ['data']]
+
+        result = generate_dataset([1001], "attempt_evaluated", context_checkpoint)
+
+        self.assertEqual(result, 2)
+        mock_list_keys.assert_not_called()
+        mock_parallel_map.assert_called_once()
+        self.assertEqual(mock_parallel_map.call_args[0][2], ["key2", "key3"])
+        self.assertEqual([c[0][4] for c in mock_save_chunk.call_args_list], [1])
+        self.assertEqual(mock_parallel_map.call_args[1]['total_bytes'], 300)
+        self.assertEqual(json.loads(objects['test-job-123/job_state/completed/chunk_1.json']), {"rows": 2})
+
+    def test_chunk_uploader_bounds_pending_saves(self):
+        release = threading.Event()
+        save = Mock(side_effect=lambda: release.wait(5))
+
+        uploader = ChunkUploader(max_pending=1)
+        uploader.submit(0, save)
+        self.assertEqual(len(uploader.pending), 1)
+
+        release.set()
+        uploader.submit(1, save)
+        self.assertEqual(len(uploader.pending), 1)
+
+        uploader.close()
+        self.assertEqual(save.call_count, 2)
+        self.assertEqual(len(uploader.pending), 0)
+
+    @patch('builtins.print')
+    def test_chunk_uploader_reports_chunks_once_saved(self, mock_print):
+        release = threading.Event()
+        save = Mock(side_effect=[None, Exception("upload failed")])
+
+        uploader = ChunkUploader(max_pending=2)
+        uploader.submit("1/2", lambda: release.wait(5) and save())
+        uploader.submit("2/2", save)
+        mock_print.assert_not_called()
+
+        release.set()
+        uploader.close()
+        self.assertEqual([c[0][0] for c in mock_print.call_args_list],
+                         ["Successfully processed chunk 1/2", "Error saving chunk 2/2: upload failed"])
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.parallel_write')
+    @patch('dataset.dataset.distribute_keys')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.get_event_config')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_dataset_executor_writes(self, mock_boto, mock_init_spark, mock_get_config,
+                                              mock_list_keys, mock_retrieve_lookup, mock_distribute_keys,
+                                              mock_parallel_write, mock_build_manifests):
+
+        context_executor = self.sample_context.copy()
+        context_executor['chunk_size'] = 2
+        context_executor['executor_writes'] = True
+
+        mock_sc = Mock()
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (mock_sc, Mock())
+        mock_get_config.return_value = (Mock(), ['col1'])
+        mock_retrieve_lookup.return_value = {}
+        mock_list_keys.return_value = ['key1', 'key2', 'key3']
+        mock_parallel_write.return_value = [
+            {"key": "test-job-123/chunk_0.csv", "rows": 10, "bytes": 100},
+            {"key": "test-job-123/chunk_1.csv", "rows": 5, "bytes": 50}
+        ]
+
+        result = generate_dataset([1001], "attempt_evaluated", context_executor)
+
+        self.assertEqual(result, 2)
+        self.assertEqual(list(mock_distribute_keys.call_args[0][2]), [['key1', 'key2'], ['key3']])
+        self.assertEqual(mock_build_manifests.call_args[1]['chunk_keys'], ["test-job-123/chunk_0.csv", "test-job-123/chunk_1.csv"])
+
+        # Chunks are written from the executors, returning only their metadata
+        write_chunk = mock_parallel_write.call_args[0][4]
+        with patch('boto3.client') as mock_executor_boto:
+            metadata = write_chunk(3, [['a'], ['b']])
+        self.assertEqual(metadata['key'], f"{context_executor['job_id']}/chunk_3.csv")
+        self.assertEqual(metadata['rows'], 2)
+        self.assertEqual(mock_executor_boto.return_value.put_object.call_args[1]['Key'], metadata['key'])
+
+    @patch('dataset.dataset.build_manifests')
+    @patch('dataset.dataset.parallel_write')
+    @patch('dataset.dataset.distribute_keys')
+    @patch('dataset.dataset.retrieve_lookup')
+    @patch('dataset.dataset.list_keys_from_inventory')
+    @patch('dataset.dataset.get_event_config')
+    @patch('dataset.dataset.initialize_spark_context')
+    @patch('boto3.client')
+    def test_generate_dataset_single_job(self, mock_boto, mock_init_spark, mock_get_config,
+                                         mock_list_keys, mock_retrieve_lookup, mock_distribute_keys,
+                                         mock_parallel_write, mock_build_manifests):
+
+        context_single = self.sample_context.copy()
+        context_single['chunk_size'] = 4
+        context_single['single_job'] = True
+
+        mock_sc = Mock(defaultParallelism=4)
+        mock_boto.return_value = self.mock_s3_client
+        mock_init_spark.return_value = (mock_sc, Mock())
+        mock_get_config.return_value = (Mock(), ['col1'])
+        mock_retrieve_lookup.return_value = {}
+        mock_list_keys.return_value = ['key1', 'key2', 'key3', 'key4', 'key5']
+        mock_parallel_write.return_value = [
+            {"key": f"test-job-123/chunk_{index}.csv", "rows": 1, "bytes": 10} for index in range(4)
+        ]
+
+        result = generate_dataset([1001], "attempt_evaluated", context_single)
+
+        # One job over all keys, split beyond the two planned chunks so every core has a task
+        self.assertEqual(result, 4)
+        self.assertEqual(mock_distribute_keys.call_args[0][2], [['key1', 'key2'], ['key3', 'key4'], ['key5']])
+        mock_parallel_write.assert_called_once()
+        self.assertIs(mock_parallel_write.call_args[0][0], mock_distribute_keys.return_value)
+
+    def test_split_chunks(self):
+        key_chunks = [['key1', 'key2', 'key3', 'key4'], ['key5']]
+
+        self.assertEqual(split_chunks(key_chunks, 2), key_chunks)
+        self.assertEqual(split_chunks(key_chunks, 4), [['key1', 'key2'], ['key3', 'key4'], ['key5']])
+        self.assertEqual(split_chunks([], 4), [])
+
+    def test_chunkify_iterator(self):
+        chunks = list(chunkify(iter(range(5)), 2))
+        self.assertEqual(chunks, [[0, 1], [2, 3], [4]])
+
     def test_generate_dataset_exception_handling(self):
         """Test that exceptions in chunk processing are handled gracefully."""
         
@@ -1,5 +1,5 @@
 import unittest
-from dataset.datashop import to_xml_message, trim_to_100_bytes, parse_attempt
+from dataset.datashop import to_xml_message, trim_to_100_bytes, parse_attempt, starts_problem, problem_units
 from dataset.lookup import post_process
 
 import json
@@ -10,6 +10,19 @@ class TestDatashop(unittest.TestCase):
         self.assertEqual(trim_to_100_bytes("1234567890" * 10), "1234567890" * 10)
         self.assertEqual(trim_to_100_bytes("1234567890" * 10 + "1234567890"), "1234567890" * 10)
 
+    def test_problem_units(self):
+        start = '<context_message context_message_id="c1" name="START_PROBLEM"><meta /></context_message>\n<tool_message />'
+        attempt = '<tool_message /><tutor_message />'
+
+        self.assertTrue(starts_problem(start))
+        self.assertFalse(starts_problem(attempt))
+        self.assertFalse(starts_problem('<context_message context_message_id="c2" name="OTHER" />'))
+
+        self.assertEqual(list(problem_units([start, attempt, attempt, start, attempt])),
+                         [[start, attempt, attempt], [start, attempt]])
+        self.assertEqual(list(problem_units([attempt, start])), [[attempt], [start]])
+        self.assertEqual(list(problem_units([])), [])
+
     def test_from_part_attempt(self):
 
         # read the test.json file from this dir
@@ -0,0 +1,122 @@
+import unittest
+from unittest.mock import Mock, patch
+import os
+import tempfile
+from dataset.inventory_cache import (
+    snapshot_id, manifest_checksum, load_cached_keys, store_cached_keys,
+    evict_snapshots, parse_location
+)
+from dataset.keys import list_keys_from_inventory, key_records
+from tests.test_data import SAMPLE_INVENTORY_MANIFEST
+
+class TestInventoryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.location = self.temp_dir.name
+        self.bucket_name = "test-bucket"
+        self.keys = [
+            'section/1002/attempt_evaluated/file3.jsonl',
+            'section/1001/attempt_evaluated/file1.jsonl'
+        ]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_snapshot_id(self):
+        self.assertEqual(snapshot_id(SAMPLE_INVENTORY_MANIFEST), '2021-01-01T00-00Z')
+        self.assertIsNone(snapshot_id({'files': []}))
+
+    def test_manifest_checksum_changes_with_files(self):
+        changed = {**SAMPLE_INVENTORY_MANIFEST, 'files': [
+            {**SAMPLE_INVENTORY_MANIFEST['files'][0], 'MD5checksum': 'def456'}
+        ]}
+        self.assertNotEqual(manifest_checksum(SAMPLE_INVENTORY_MANIFEST), manifest_checksum(changed))
+
+    def test_store_and_load_round_trip(self):
+        store_cached_keys(None, self.location, self.bucket_name, SAMPLE_INVENTORY_MANIFEST, 'attempt_evaluated', self.keys)
+
+        result = load_cached_keys(None, self.location, self.bucket_name, SAMPLE_INVENTORY_MANIFEST, 'attempt_evaluated')
+
+        self.assertEqual(result, sorted(self.keys))
+        self.assertIsNone(load_cached_keys(None, self.location, self.bucket_name, SAMPLE_INVENTORY_MANIFEST, 'page_viewed'))
+
+    def test_load_rejects_different_manifest_files(self):
+        store_cached_keys(None, self.location, self.bucket_name, SAMPLE_INVENTORY_MANIFEST, 'attempt_evaluated', self.keys)
+        changed = {**SAMPLE_INVENTORY_MANIFEST, 'files': SAMPLE_INVENTORY_MANIFEST['files'] + [
+            {'key': 'test-bucket-inventory/test-bucket/2024-01-01T01-00Z/other.parquet', 'MD5checksum': 'fff'}
+        ]}
+
+        self.assertIsNone(load_cached_keys(None, self.location, self.bucket_name, changed, 'attempt_evaluated'))
+
+    def test_load_rejects_corrupt_data(self):
+        store_cached_keys(None, self.location, self.bucket_name, SAMPLE_INVENTORY_MANIFEST, 'attempt_evaluated', self.keys)
+        path = os.path.join(self.location, self.bucket_name, '2021-01-01T00-00Z', 'attempt_evaluated.parquet')
+        with open(path, 'ab') as f:
+            f.write(b'garbage')
+
+        self.assertIsNone(load_cached_keys(None, self.location, self.bucket_name, SAMPLE_INVENTORY_MANIFEST, 'attempt_evaluated'))
+
+    def test_evict_snapshots_keeps_most_recent(self):
+        for snapshot in ['2024-01-01T01-00Z', '2024-01-02T01-00Z', '2024-01-03T01-00Z']:
+            os.makedirs(os.path.join(self.location, self.bucket_name, snapshot))
+
+        evict_snapshots(None, self.location, self.bucket_name, keep=2)
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.location, self.bucket_name))),
+                         ['2024-01-02T01-00Z', '2024-01-03T01-00Z'])
+
+    def test_s3_location(self):
+        self.assertEqual(parse_location('s3://results-bucket/inventory_cache/'), ('results-bucket', 'inventory_cache'))
+        self.assertEqual(parse_location('/tmp/cache'), (None, '/tmp/cache'))
+
+        mock_s3_client = Mock()
+        store_cached_keys(mock_s3_client, 's3://results-bucket/inventory_cache', self.bucket_name,
+                          SAMPLE_INVENTORY_MANIFEST, 'attempt_evaluated', self.keys)
+
+        written = [call_args[1]['Key'] for call_args in mock_s3_client.put_object.call_args_list]
+        self.assertEqual(written, [
+            'inventory_cache/test-bucket/2021-01-01T00-00Z/attempt_evaluated.parquet',
+            'inventory_cache/test-bucket/2021-01-01T00-00Z/attempt_evaluated.json'
+        ])
+
+    @patch('boto3.client')
+    def test_list_keys_from_inventory_uses_cache(self, mock_boto_client):
+        mock_boto_client.return_value = Mock()
+
+        with patch('dataset.keys.get_most_recent_manifest', return_value=SAMPLE_INVENTORY_MANIFEST), \
+             patch('dataset.keys.fetch_parquet', return_value=key_records(self.keys, [10, 20], ['2024-01-01T00:00:00Z'] * 2)) as mock_fetch_parquet:
+
+            first = list_keys_from_inventory([1001, 1002], 'attempt_evaluated', self.bucket_name,
+                                             'test-bucket-inventory', cache_location=self.location)
+            second = list_keys_from_inventory([1001, 1002], 'attempt_evaluated', self.bucket_name,
+                                              'test-bucket-inventory', cache_location=self.location)
+            third = list_keys_from_inventory([1001], 'attempt_evaluated', self.bucket_name,
+                                             'test-bucket-inventory', cache_location=self.location)
+
+        # The inventory is scanned once, for all sections, and the cache serves the later calls.
+        # The run that fills the cache lists the keys in the same order as the runs reading it
+        self.assertEqual(mock_fetch_parquet.call_count, 1)
+        self.assertIsNone(mock_fetch_parquet.call_args[0][0])
+        self.assertEqual(first, sorted(self.keys))
+        self.assertEqual(second, first)
+        self.assertEqual(third, ['section/1001/attempt_evaluated/file1.jsonl'])
+
+    @patch('boto3.client')
+    def test_list_keys_from_inventory_cache_with_metadata(self, mock_boto_client):
+        mock_boto_client.return_value = Mock()
+        records = key_records(self.keys, [10, 20], ['2024-01-01T00:00:00Z', '2024-01-02T00:00:00Z'])
+
+        with patch('dataset.keys.get_most_recent_manifest', return_value=SAMPLE_INVENTORY_MANIFEST), \
+             patch('dataset.keys.fetch_parquet', return_value=records):
+            list_keys_from_inventory([1001], 'attempt_evaluated', self.bucket_name,
+                                     'test-bucket-inventory', cache_location=self.location)
+            result = list_keys_from_inventory([1002], 'attempt_evaluated', self.bucket_name,
+                                              'test-bucket-inventory', cache_location=self.location, with_metadata=True)
+
+        self.assertEqual(result['key'].tolist(), ['section/1002/attempt_evaluated/file3.jsonl'])
+        self.assertEqual(result['size'].tolist(), [10])
+        self.assertEqual(str(result['last_modified_date'][0]), '2024-01-01 00:00:00+00:00')
+
+if __name__ == '__main__':
+    unittest.main()
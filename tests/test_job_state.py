@@ -0,0 +1,70 @@
+import json
+import unittest
+from unittest.mock import Mock
+
+from botocore.exceptions import ClientError
+
+from dataset.dataset import KeyChunk
+from dataset.job_state import JobState, job_state_key, completed_chunk_key
+from tests.test_data import mock_s3_client
+
+
+class TestJobState(unittest.TestCase):
+
+    def test_load_without_state(self):
+        job_state = JobState(mock_s3_client({}), "results", "job")
+
+        self.assertFalse(job_state.load())
+        self.assertIsNone(job_state.key_chunks)
+
+    def test_plan_and_record(self):
+        objects = {}
+        job_state = JobState(mock_s3_client(objects), "results", "job")
+
+        job_state.plan(iter([("key1", "key2"), ("key3",)]))
+        plan = objects[job_state_key("job")]
+        job_state.record(1, 42)
+
+        # Recording a chunk leaves the plan as it was saved, and only adds the chunk's own object
+        self.assertIs(objects[job_state_key("job")], plan)
+        self.assertEqual(json.loads(plan), {
+            "key_chunks": [["key1", "key2"], ["key3"]],
+            "chunk_bytes": [None, None],
+        })
+        self.assertEqual(json.loads(objects[completed_chunk_key("job", 1)]), {"rows": 42})
+
+    def test_resume(self):
+        objects = {}
+        JobState(mock_s3_client(objects), "results", "job").plan([["key1"], ["key2"]])
+        first_run = JobState(mock_s3_client(objects), "results", "job")
+        first_run.load()
+        first_run.record(0, 3)
+
+        job_state = JobState(mock_s3_client(objects), "results", "job")
+
+        self.assertTrue(job_state.load())
+        self.assertEqual(job_state.key_chunks, [["key1"], ["key2"]])
+        self.assertEqual(job_state.completed, {0: {"rows": 3}})
+        self.assertTrue(job_state.is_complete(0))
+        self.assertFalse(job_state.is_complete(1))
+
+    def test_plan_keeps_chunk_bytes(self):
+        objects = {}
+        key_chunks = [KeyChunk(["key1", "key2"], 2048), KeyChunk(["key3"], 512)]
+        JobState(mock_s3_client(objects), "results", "job").plan(key_chunks)
+
+        job_state = JobState(mock_s3_client(objects), "results", "job")
+        job_state.load()
+
+        self.assertEqual(job_state.chunk_bytes, [2048, 512])
+
+    def test_load_raises_other_errors(self):
+        s3_client = Mock()
+        s3_client.get_object.side_effect = ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetObject')
+
+        with self.assertRaises(ClientError):
+            JobState(s3_client, "results", "job").load()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+from unittest.mock import Mock, patch
+import io
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dataset import key_index
+from dataset.key_index import build_key_index, lookup_keys, load_key_index, store_key_index
+from dataset.keys import list_keys_from_inventory
+from tests.test_data import SAMPLE_INVENTORY_MANIFEST
+
+KEYS = [
+    'section/1002/tutor_message/file5.jsonl',
+    'section/1001/attempt_evaluated/file2.jsonl',
+    'section/1001/page_viewed/file3.jsonl',
+    'section/1001/attempt_evaluated/file1.jsonl',
+    'section/1002/attempt_evaluated/file4.jsonl',
+]
+
+class TestKeyIndex(unittest.TestCase):
+
+    def setUp(self):
+        key_index.loaded_indexes.clear()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.location = self.temp_dir.name
+        self.bucket_name = "test-bucket"
+
+    def tearDown(self):
+        key_index.loaded_indexes.clear()
+        self.temp_dir.cleanup()
+
+    def build(self, keys=KEYS):
+        return build_key_index([pa.record_batch({'key': keys})])
+
+    def test_lookup_keys(self):
+        index = self.build()
+
+        self.assertEqual(lookup_keys(index, [1001], 'attempt_evaluated'), [
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1001/attempt_evaluated/file2.jsonl'
+        ])
+        self.assertEqual(lookup_keys(index, [1001, 1002], 'attempt_evaluated'), [
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1001/attempt_evaluated/file2.jsonl',
+            'section/1002/attempt_evaluated/file4.jsonl'
+        ])
+        self.assertEqual(lookup_keys(index, [1002], 'tutor_message'), ['section/1002/tutor_message/file5.jsonl'])
+        self.assertEqual(lookup_keys(index, [9999], 'attempt_evaluated'), [])
+
+    def test_lookup_keys_with_metadata(self):
+        index = build_key_index([pa.record_batch({
+            'key': KEYS,
+            'size': list(range(len(KEYS))),
+            'last_modified_date': pa.array([0] * len(KEYS), type=pa.timestamp('ms'))
+        })])
+
+        result = lookup_keys(index, [1001], 'attempt_evaluated', with_metadata=True)
+
+        self.assertEqual(result['key'].tolist(), [
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1001/attempt_evaluated/file2.jsonl'
+        ])
+        self.assertEqual(result['size'].tolist(), [3, 1])
+
+    def test_empty_index(self):
+        index = build_key_index([])
+        self.assertEqual(lookup_keys(index, [1001], 'attempt_evaluated'), [])
+
+    def test_store_and_load_local(self):
+        store_key_index(None, self.location, self.bucket_name, SAMPLE_INVENTORY_MANIFEST, self.build())
+        key_index.loaded_indexes.clear()
+
+        index = load_key_index(None, self.location, self.bucket_name, SAMPLE_INVENTORY_MANIFEST)
+
+        self.assertIsNotNone(index)
+        self.assertEqual(lookup_keys(index, [1001], 'page_viewed'), ['section/1001/page_viewed/file3.jsonl'])
+
+    def test_load_rejects_different_manifest_files(self):
+        store_key_index(None, self.location, self.bucket_name, SAMPLE_INVENTORY_MANIFEST, self.build())
+        key_index.loaded_indexes.clear()
+        changed = {**SAMPLE_INVENTORY_MANIFEST, 'files': [
+            {**SAMPLE_INVENTORY_MANIFEST['files'][0], 'MD5checksum': 'def456'}
+        ]}
+
+        self.assertIsNone(load_key_index(None, self.location, self.bucket_name, changed))
+
+    def test_load_from_s3(self):
+        written = {}
+        mock_s3_client = Mock()
+        mock_s3_client.put_object.side_effect = lambda Bucket, Key, Body: written.__setitem__(Key, Body)
+
+        def mock_get_object(Bucket, Key):
+            body = Mock()
+            body.read.return_value = written[Key]
+            return {'Body': body}
+        mock_s3_client.get_object.side_effect = mock_get_object
+
+        store_key_index(mock_s3_client, 's3://results/inventory_cache', self.bucket_name, SAMPLE_INVENTORY_MANIFEST, self.build())
+        key_index.loaded_indexes.clear()
+
+        index = load_key_index(mock_s3_client, 's3://results/inventory_cache', self.bucket_name, SAMPLE_INVENTORY_MANIFEST)
+        self.assertEqual(lookup_keys(index, [1002], 'attempt_evaluated'), ['section/1002/attempt_evaluated/file4.jsonl'])
+
+    @patch('boto3.client')
+    def test_list_keys_from_inventory_builds_index_once(self, mock_boto_client):
+        buffer = io.BytesIO()
+        pq.write_table(pa.table({'key': sorted(KEYS + ['other/1001/attempt_evaluated/x.jsonl'])}), buffer)
+        data = buffer.getvalue()
+
+        mock_s3_client = Mock()
+        def mock_get_object(Bucket, Key, Range):
+            start, end = Range[len('bytes='):].split('-')
+            body = Mock()
+            body.read.return_value = data[int(start):int(end) + 1]
+            return {'Body': body}
+        mock_s3_client.get_object.side_effect = mock_get_object
+        mock_boto_client.return_value = mock_s3_client
+
+        manifest = {**SAMPLE_INVENTORY_MANIFEST, 'files': [{**SAMPLE_INVENTORY_MANIFEST['files'][0], 'size': len(data)}]}
+
+        with patch('dataset.keys.get_most_recent_manifest', return_value=manifest), \
+             patch('dataset.keys.build_key_index', wraps=build_key_index) as mock_build:
+            attempts = list_keys_from_inventory([1001, 1002], 'attempt_evaluated', self.bucket_name,
+                                                'test-bucket-inventory', cache_location=self.location, index=True)
+            tutor = list_keys_from_inventory([1001, 1002], 'tutor_message', self.bucket_name,
+                                             'test-bucket-inventory', cache_location=self.location, index=True)
+
+        self.assertEqual(mock_build.call_count, 1)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(tutor, ['section/1002/tutor_message/file5.jsonl'])
+
+    @patch('boto3.client')
+    def test_list_keys_from_inventory_builds_index_once_concurrently(self, mock_boto_client):
+        buffer = io.BytesIO()
+        pq.write_table(pa.table({'key': sorted(KEYS)}), buffer)
+        data = buffer.getvalue()
+
+        mock_s3_client = Mock()
+        def mock_get_object(Bucket, Key, Range):
+            start, end = Range[len('bytes='):].split('-')
+            body = Mock()
+            body.read.return_value = data[int(start):int(end) + 1]
+            return {'Body': body}
+        mock_s3_client.get_object.side_effect = mock_get_object
+        mock_boto_client.return_value = mock_s3_client
+
+        manifest = {**SAMPLE_INVENTORY_MANIFEST, 'files': [{**SAMPLE_INVENTORY_MANIFEST['files'][0], 'size': len(data)}]}
+
+        # A slow build leaves both threads time to miss the index, unless the second waits for the first
+        def slow_build(batches):
+            time.sleep(0.1)
+            return build_key_index(batches)
+
+        def list_keys(action):
+            return list_keys_from_inventory([1001, 1002], action, self.bucket_name,
+                                            'test-bucket-inventory', cache_location=self.location, index=True)
+
+        with patch('dataset.keys.get_most_recent_manifest', return_value=manifest), \
+             patch('dataset.keys.build_key_index', side_effect=slow_build) as mock_build:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                attempts = executor.submit(list_keys, 'attempt_evaluated')
+                tutor = executor.submit(list_keys, 'tutor_message')
+                attempts, tutor = attempts.result(), tutor.result()
+
+        self.assertEqual(mock_build.call_count, 1)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(tutor, ['section/1002/tutor_message/file5.jsonl'])
+
+if __name__ == '__main__':
+    unittest.main()
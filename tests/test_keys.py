@@ -4,9 +4,40 @@ import pandas as pd
 import io
 import json
 from datetime import datetime, timedelta
-from dataset.keys import list_keys_from_inventory, get_most_recent_manifest, fetch_parquet, list_keys
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dataset.keys import list_keys_from_inventory, get_most_recent_manifest, fetch_parquet, list_keys, scan_parquet, row_group_may_match, filter_keys, iter_keys_from_inventory, KEY_RECORD_COLUMNS, key_records, merge_fresh_keys, iter_fresh_keys, list_keys_for_sections
 from tests.test_data import SAMPLE_INVENTORY_MANIFEST, create_mock_s3_client
 
+def create_ranged_s3_client(data):
+    """Mock S3 client serving ``data`` for get_object calls, honoring the Range argument."""
+    mock_s3_client = Mock()
+
+    def mock_get_object(Bucket, Key, Range=None):
+        body = data
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            body = data[int(start):int(end) + 1]
+        mock_body = Mock()
+        mock_body.read.return_value = body
+        return {'Body': mock_body}
+
+    mock_s3_client.get_object.side_effect = mock_get_object
+    return mock_s3_client
+
+
+def create_inventory_parquet(keys, row_group_size):
+    table = pa.table({
+        'bucket': ['test-bucket'] * len(keys),
+        'key': keys,
+        'size': list(range(len(keys))),
+        'last_modified_date': pa.array([datetime(2024, 1, 1) + timedelta(hours=i) for i in range(len(keys))], type=pa.timestamp('ms'))
+    })
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, row_group_size=row_group_size)
+    return buffer.getvalue()
+
+
 class TestKeys(unittest.TestCase):
 
     def setUp(self):
@@ -47,6 +78,51 @@ class TestKeys(unittest.TestCase):
             self.assertIsInstance(result, list)
             self.assertTrue(len(result) > 0)
 
+    @patch('boto3.client')
+    def test_list_keys_from_inventory_concurrent_preserves_order(self, mock_boto_client):
+        mock_boto_client.return_value = Mock()
+        manifest = {**SAMPLE_INVENTORY_MANIFEST, 'files': [
+            {'key': f'inventory/shard{i}.parquet', 'size': 10 * (5 - i)} for i in range(5)
+        ]}
+
+        def fake_fetch(section_ids, action, s3_client, bucket_name, key, scan=False, size=None):
+            # Later shards finish first, results must still come back in manifest order
+            import time
+            time.sleep(size / 1000.0)
+            return [f'{key}/a', f'{key}/b']
+
+        with patch('dataset.keys.get_most_recent_manifest', return_value=manifest), \
+             patch('dataset.keys.fetch_parquet', side_effect=fake_fetch):
+            result = list_keys_from_inventory(
+                self.section_ids, self.action,
+                self.inventory_bucket_name, self.bucket_name, max_workers=4
+            )
+
+        expected = [f'inventory/shard{i}.parquet/{suffix}' for i in range(5) for suffix in ('a', 'b')]
+        self.assertEqual(result, expected)
+
+    @patch('boto3.client')
+    def test_iter_keys_from_inventory_streams(self, mock_boto_client):
+        mock_boto_client.return_value = Mock()
+        manifest = {**SAMPLE_INVENTORY_MANIFEST, 'files': [
+            {'key': f'inventory/shard{i}.parquet', 'size': 1} for i in range(5)
+        ]}
+
+        with patch('dataset.keys.get_most_recent_manifest', return_value=manifest), \
+             patch('dataset.keys.fetch_parquet', side_effect=lambda *args, **kwargs: [f'{args[4]}/a']) as mock_fetch_parquet:
+            keys = iter_keys_from_inventory(self.section_ids, self.action,
+                                            self.inventory_bucket_name, self.bucket_name, max_workers=2)
+
+            first = next(keys)
+
+            # The first key is available before every shard has been fetched
+            self.assertEqual(first, 'inventory/shard0.parquet/a')
+            self.assertLess(mock_fetch_parquet.call_count, 5)
+
+            rest = list(keys)
+
+        self.assertEqual(rest, [f'inventory/shard{i}.parquet/a' for i in range(1, 5)])
+
     @patch('boto3.client')
     def test_list_keys_from_inventory_exception_handling(self, mock_boto_client):
         mock_s3_client = Mock()
@@ -272,5 +348,216 @@ class TestKeys(unittest.TestCase):
         # Should return empty list
         self.assertEqual(result, [])
 
+    def test_scan_parquet_filters_and_projects(self):
+        keys = sorted([
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1001/page_viewed/file2.jsonl',
+            'section/1002/attempt_evaluated/file3.jsonl',
+            'section/9999/attempt_evaluated/file4.jsonl',
+        ])
+        data = create_inventory_parquet(keys, row_group_size=2)
+        mock_s3_client = create_ranged_s3_client(data)
+
+        batches = list(scan_parquet(self.section_ids, self.action, mock_s3_client,
+                                    self.bucket_name, "test-key", size=len(data)))
+
+        result = [k for batch in batches for k in batch.column('key').to_pylist()]
+        self.assertEqual(result, [
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1002/attempt_evaluated/file3.jsonl'
+        ])
+        self.assertEqual(batches[0].schema.names, ['key'])
+
+        # Every read is a ranged read, never a full download
+        for call_args in mock_s3_client.get_object.call_args_list:
+            self.assertIn('Range', call_args[1])
+
+    def test_scan_parquet_skips_row_groups(self):
+        keys = [f'section/{section_id}/attempt_evaluated/file.jsonl' for section_id in range(2000, 2100)]
+        data = create_inventory_parquet(sorted(keys), row_group_size=10)
+        mock_s3_client = create_ranged_s3_client(data)
+
+        with patch.object(pq.ParquetFile, 'iter_batches', autospec=True,
+                          side_effect=pq.ParquetFile.iter_batches) as mock_iter_batches:
+            result = fetch_parquet([2005], self.action, mock_s3_client, self.bucket_name,
+                                   "test-key", scan=True, size=len(data))
+
+        self.assertEqual(result, ['section/2005/attempt_evaluated/file.jsonl'])
+        self.assertEqual(mock_iter_batches.call_args[1]['row_groups'], [0])
+
+    def test_scan_parquet_optional_columns(self):
+        keys = ['section/1001/attempt_evaluated/file1.jsonl']
+        data = create_inventory_parquet(keys, row_group_size=10)
+        mock_s3_client = create_ranged_s3_client(data)
+
+        batches = list(scan_parquet(self.section_ids, self.action, mock_s3_client, self.bucket_name,
+                                    "test-key", columns=['size'], size=len(data)))
+
+        self.assertEqual(batches[0].schema.names, ['key', 'size'])
+
+    def test_filter_keys_segments(self):
+        keys = pd.Series([
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1001/attempt_evaluated/',
+            'section/1001/attempt_evaluated',            # No trailing separator
+            'section/10011/attempt_evaluated/file2.jsonl',  # Section id sharing a prefix
+            'section/1001/attempt_evaluated_v2/file3.jsonl',
+            'archive/section/1001/attempt_evaluated/file4.jsonl',
+            'section/1001',
+            'section',
+            ''
+        ])
+
+        result = filter_keys(keys, [1001], self.action).tolist()
+
+        self.assertEqual(result, [
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1001/attempt_evaluated/'
+        ])
+
+    def test_filter_keys_many_sections(self):
+        section_ids = list(range(5000))
+        keys = pd.Series([f'section/{i}/attempt_evaluated/file.jsonl' for i in range(0, 10000, 3)])
+
+        result = filter_keys(keys, section_ids, self.action).tolist()
+
+        self.assertEqual(result, [f'section/{i}/attempt_evaluated/file.jsonl' for i in range(0, 5000, 3)])
+
+    def test_filter_keys_any_section_or_action(self):
+        keys = pd.Series([
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1002/page_viewed/file2.jsonl',
+            'other/1001/attempt_evaluated/file3.jsonl'
+        ])
+
+        self.assertEqual(filter_keys(keys, None, self.action).tolist(), ['section/1001/attempt_evaluated/file1.jsonl'])
+        self.assertEqual(len(filter_keys(keys, None, None)), 2)
+
+    def test_fetch_parquet_with_metadata(self):
+        keys = [
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1001/page_viewed/file2.jsonl',
+            'section/1002/attempt_evaluated/file3.jsonl'
+        ]
+        data = create_inventory_parquet(keys, row_group_size=10)
+
+        for scan in (True, False):
+            mock_s3_client = create_ranged_s3_client(data)
+            result = fetch_parquet(self.section_ids, self.action, mock_s3_client, self.bucket_name,
+                                   "test-key", scan=scan, size=len(data), with_metadata=True)
+
+            self.assertEqual(list(result.columns), KEY_RECORD_COLUMNS)
+            self.assertEqual(result['key'].tolist(), [keys[0], keys[2]])
+            self.assertEqual(result['size'].tolist(), [0, 2])
+            self.assertEqual(str(result['last_modified_date'].iloc[1]), '2024-01-01 02:00:00+00:00')
+
+    @patch('boto3.client')
+    def test_list_keys_with_metadata(self, mock_boto_client):
+        mock_s3_client = Mock()
+        mock_s3_client.list_objects_v2.return_value = {
+            'Contents': [
+                {'Key': 'section/1001/attempt_evaluated/file1.jsonl', 'Size': 100, 'LastModified': datetime(2024, 1, 1)},
+                {'Key': 'section/1001/attempt_evaluated/file2.jsonl', 'Size': 200, 'LastModified': datetime(2024, 1, 2)}
+            ],
+            'IsTruncated': False
+        }
+        mock_boto_client.return_value = mock_s3_client
+
+        result = list_keys(self.bucket_name, 1001, self.action, with_metadata=True)
+
+        self.assertEqual(result['size'].tolist(), [100, 200])
+        self.assertEqual(len(result), 2)
+
+    @patch('boto3.client')
+    def test_merge_fresh_keys_lists_after_inventory(self, mock_boto_client):
+        mock_s3_client = Mock()
+        mock_s3_client.list_objects_v2.side_effect = [
+            {'Contents': [{'Key': 'section/1001/attempt_evaluated/file3.jsonl'}], 'IsTruncated': False},
+            {'Contents': [{'Key': 'section/1002/attempt_evaluated/file1.jsonl'}], 'IsTruncated': False}
+        ]
+        mock_boto_client.return_value = mock_s3_client
+
+        inventory = [
+            'section/1001/attempt_evaluated/file2.jsonl',
+            'section/1001/attempt_evaluated/file1.jsonl'
+        ]
+        result = merge_fresh_keys(inventory, [1001, 1002], self.action, self.bucket_name)
+
+        self.assertEqual(result, inventory + [
+            'section/1001/attempt_evaluated/file3.jsonl',
+            'section/1002/attempt_evaluated/file1.jsonl'
+        ])
+        # Only keys after the last inventory key are listed; a section missing from the inventory is listed in full
+        mock_s3_client.list_objects_v2.assert_any_call(
+            Bucket=self.bucket_name, Prefix='section/1001/attempt_evaluated/',
+            StartAfter='section/1001/attempt_evaluated/file2.jsonl'
+        )
+        mock_s3_client.list_objects_v2.assert_any_call(Bucket=self.bucket_name, Prefix='section/1002/attempt_evaluated/')
+
+    @patch('boto3.client')
+    def test_merge_fresh_keys_with_metadata(self, mock_boto_client):
+        mock_s3_client = Mock()
+        mock_s3_client.list_objects_v2.return_value = {
+            'Contents': [{'Key': 'section/1001/attempt_evaluated/file2.jsonl', 'Size': 20, 'LastModified': datetime(2024, 1, 3)}],
+            'IsTruncated': False
+        }
+        mock_boto_client.return_value = mock_s3_client
+
+        records = key_records(['section/1001/attempt_evaluated/file1.jsonl'], [10], ['2024-01-01T00:00:00Z'])
+        result = merge_fresh_keys(records, [1001], self.action, self.bucket_name)
+
+        self.assertEqual(result['key'].tolist(), [
+            'section/1001/attempt_evaluated/file1.jsonl',
+            'section/1001/attempt_evaluated/file2.jsonl'
+        ])
+        self.assertEqual(result['size'].tolist(), [10, 20])
+
+    @patch('boto3.client')
+    def test_iter_fresh_keys(self, mock_boto_client):
+        mock_s3_client = Mock()
+        mock_s3_client.list_objects_v2.return_value = {
+            'Contents': [{'Key': 'section/1001/attempt_evaluated/file2.jsonl'}],
+            'IsTruncated': False
+        }
+        mock_boto_client.return_value = mock_s3_client
+
+        keys = iter_fresh_keys(iter(['section/1001/attempt_evaluated/file1.jsonl']), [1001], self.action, self.bucket_name)
+
+        self.assertEqual(next(keys), 'section/1001/attempt_evaluated/file1.jsonl')
+        mock_s3_client.list_objects_v2.assert_not_called()
+        self.assertEqual(list(keys), ['section/1001/attempt_evaluated/file2.jsonl'])
+
+    @patch('boto3.client')
+    def test_list_keys_for_sections(self, mock_boto_client):
+        def mock_list_objects_v2(Bucket, Prefix, ContinuationToken=None):
+            if ContinuationToken is None:
+                return {'Contents': [{'Key': f'{Prefix}file1.jsonl'}], 'IsTruncated': True, 'NextContinuationToken': 'token'}
+            return {'Contents': [{'Key': f'{Prefix}file2.jsonl'}], 'IsTruncated': False}
+
+        mock_s3_client = Mock()
+        mock_s3_client.list_objects_v2.side_effect = mock_list_objects_v2
+        mock_boto_client.return_value = mock_s3_client
+
+        section_ids = list(range(1000, 1010))
+        result = list(list_keys_for_sections(self.bucket_name, section_ids, self.action, max_workers=4))
+
+        # One shared client, and keys come back in section order regardless of completion order
+        self.assertEqual(mock_boto_client.call_count, 1)
+        self.assertEqual(result, [f'section/{section_id}/{self.action}/file{i}.jsonl'
+                                  for section_id in section_ids for i in (1, 2)])
+
+    def test_row_group_may_match(self):
+        prefixes = ['section/1001/attempt_evaluated/', 'section/1002/attempt_evaluated/']
+
+        def stats(low, high):
+            return Mock(has_min_max=True, min=low, max=high)
+
+        self.assertTrue(row_group_may_match(stats('section/1000/a', 'section/1001/attempt_evaluated/x'), prefixes))
+        self.assertTrue(row_group_may_match(stats('section/1001/attempt_evaluated/x', 'section/1001/attempt_evaluated/y'), prefixes))
+        self.assertFalse(row_group_may_match(stats('section/1001/page_viewed/a', 'section/1001/video/z'), prefixes))
+        self.assertFalse(row_group_may_match(stats('section/1003/a', 'section/1009/z'), prefixes))
+        self.assertFalse(row_group_may_match(stats('section/0/a', 'section/1000/z'), prefixes))
+        self.assertTrue(row_group_may_match(None, prefixes))
+
 if __name__ == '__main__':
     unittest.main()
@@ -82,6 +82,17 @@ class TestManifest(unittest.TestCase):
         self.assertEqual(len(json_content['chunks']), 0)
         self.assertEqual(json_content['chunks'], [])
 
+    def test_build_manifests_with_chunk_keys(self):
+        chunk_keys = [f"{self.sample_context['job_id']}/chunk_0.csv", f"{self.sample_context['job_id']}/chunk_2.csv"]
+
+        build_json_manifest(self.mock_s3_client, self.sample_context, 2, self.extension, chunk_keys=chunk_keys)
+        build_html_manifest(self.mock_s3_client, self.sample_context, 2, self.extension, chunk_keys=chunk_keys)
+
+        expected_prefix = f"https://{self.sample_context['results_bucket_name']}.s3.us-east-1.amazonaws.com/"
+        json_body, html_body = [c[1]['Body'] for c in self.mock_s3_client.put_object.call_args_list]
+        self.assertEqual(json.loads(json_body)['chunks'], [expected_prefix + key for key in chunk_keys])
+        self.assertIn(f'href="{expected_prefix}{chunk_keys[1]}"', html_body)
+
     def test_build_html_manifest_structure(self):
         result = build_html_manifest(
             self.mock_s3_client, self.sample_context, 
@@ -0,0 +1,153 @@
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+from pyspark.sql.types import StructType, ArrayType, StringType
+from dataset.attempts import attempts_handler
+from dataset.page_viewed import page_viewed_handler
+from dataset.event_registry import attempts_columns, page_viewed_columns
+from dataset.spark_json import (
+    spark_json_fields, event_schema, event_frame, write_event_csv, list_written_chunks, EXTENSION_PREFIX
+)
+from tests.test_data import (
+    SAMPLE_PART_ATTEMPT_EVENT, SAMPLE_ACTIVITY_ATTEMPT_EVENT, SAMPLE_PAGE_VIEWED_EVENT,
+    SAMPLE_CONTEXT, SAMPLE_LOOKUP_DATA
+)
+
+JAVA_AVAILABLE = shutil.which("java") is not None or os.environ.get("JAVA_HOME") is not None
+
+class TestSparkJson(unittest.TestCase):
+
+    def test_fields_cover_registry_columns(self):
+        self.assertEqual(list(spark_json_fields["attempt_evaluated"]), attempts_columns)
+        self.assertEqual(list(spark_json_fields["page_viewed"]), page_viewed_columns)
+
+    def test_event_schema(self):
+        schema = event_schema("attempt_evaluated")
+
+        extensions = schema["context"].dataType["extensions"].dataType
+        self.assertIsInstance(extensions, StructType)
+        self.assertEqual(extensions[EXTENSION_PREFIX + "section_id"].dataType, StringType())
+        self.assertEqual(extensions[EXTENSION_PREFIX + "attached_objectives"].dataType, ArrayType(StringType()))
+        self.assertEqual(schema["object"].dataType["definition"].dataType["type"].dataType, StringType())
+        self.assertEqual(schema["result"].dataType["response"].dataType, StringType())
+
+    def test_event_schema_reads_the_fields_the_handler_reads(self):
+        schema = event_schema("page_viewed")
+
+        self.assertEqual(sorted(schema.fieldNames()), ["actor", "context", "timestamp"])
+        extensions = schema["context"].dataType["extensions"].dataType
+        self.assertEqual(sorted(extensions.fieldNames()), sorted(
+            EXTENSION_PREFIX + name
+            for name in ("section_id", "project_id", "publication_id", "page_id", "page_attempt_guid", "page_attempt_number")
+        ))
+
+    def test_list_written_chunks(self):
+        mock_s3_client = Mock()
+        mock_s3_client.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': 'job/csv/part-00001.csv'}, {'Key': 'job/csv/_SUCCESS'}]},
+            {'Contents': [{'Key': 'job/csv/part-00000.csv'}]}
+        ]
+
+        self.assertEqual(list_written_chunks(mock_s3_client, 'results', 'job/csv/', '.csv'),
+                         ['job/csv/part-00000.csv', 'job/csv/part-00001.csv'])
+
+
+def without_field(event, name):
+    """A copy of the event without the given context extension."""
+    event = copy.deepcopy(event)
+    del event["context"]["extensions"][EXTENSION_PREFIX + name]
+    return event
+
+
+@unittest.skipUnless(JAVA_AVAILABLE, "Spark needs a Java runtime")
+class TestSparkJsonEvents(unittest.TestCase):
+    """Runs the Spark reader on a local session, checking it keeps the rows the Python handlers keep."""
+
+    @classmethod
+    def setUpClass(cls):
+        from pyspark.sql import SparkSession
+        cls.spark = SparkSession.builder.master("local[1]").appName("test_spark_json").getOrCreate()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.spark.stop()
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.context = {**SAMPLE_CONTEXT, "lookup": SAMPLE_LOOKUP_DATA, "project_id": None, "page_ids": None,
+                        "ignored_student_ids": [], "sub_types": ["part_attempt_evaluated", "activity_attempt_evaluated"]}
+
+        # Objects are read from and written to the temporary directory instead of S3
+        local_path = lambda bucket_name, key: os.path.join(self.temp_dir.name, bucket_name, key)
+        patcher = patch('dataset.spark_json.s3_path', side_effect=local_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_events(self, key, lines):
+        path = os.path.join(self.temp_dir.name, "test-bucket", key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        content = '\n'.join(line if isinstance(line, str) else json.dumps(line) for line in lines)
+        with open(path, 'w') as f:
+            f.write(content)
+
+        s3_client = Mock()
+        s3_client.get_object.return_value = {'Body': Mock(read=Mock(return_value=content.encode('utf-8')))}
+        return s3_client
+
+    def assert_rows_match_handler(self, action, columns, handler, lines):
+        s3_client = self.write_events("events.jsonl", lines)
+
+        expected = [[None if value is None else str(value) for value in row]
+                    for row in handler(("test-bucket", "events.jsonl"), self.context, [], s3_client=s3_client)]
+        rows = event_frame(self.spark, "test-bucket", ["events.jsonl"], action, columns, self.context).collect()
+
+        self.assertTrue(expected)
+        self.assertEqual(sorted([list(row) for row in rows], key=str), sorted(expected, key=str))
+
+    def test_attempts_match_handler(self):
+        self.assert_rows_match_handler("attempt_evaluated", attempts_columns, attempts_handler, [
+            SAMPLE_PART_ATTEMPT_EVENT,
+            SAMPLE_ACTIVITY_ATTEMPT_EVENT,
+            '{"actor": {"account": ',
+            without_field(SAMPLE_PART_ATTEMPT_EVENT, "part_id"),
+            without_field(SAMPLE_ACTIVITY_ATTEMPT_EVENT, "activity_id"),
+        ])
+
+    def test_page_views_match_handler(self):
+        self.assert_rows_match_handler("page_viewed", page_viewed_columns, page_viewed_handler, [
+            SAMPLE_PAGE_VIEWED_EVENT,
+            'not json',
+            without_field(SAMPLE_PAGE_VIEWED_EVENT, "page_attempt_guid"),
+        ])
+
+    def test_write_event_csv(self):
+        self.write_events("events.jsonl", [SAMPLE_PAGE_VIEWED_EVENT, 'not json'])
+        results_dir = os.path.join(self.temp_dir.name, self.context["results_bucket_name"])
+
+        s3_client = Mock()
+        s3_client.get_paginator.return_value.paginate.side_effect = lambda Bucket, Prefix: [{'Contents': [
+            {'Key': os.path.relpath(os.path.join(root, name), results_dir)}
+            for root, _, names in os.walk(os.path.join(results_dir, Prefix)) for name in names
+        ]}]
+
+        chunk_keys = write_event_csv(self.spark, s3_client, "test-bucket", ["events.jsonl"], "page_viewed", page_viewed_columns, self.context)
+
+        lines = []
+        for chunk_key in chunk_keys:
+            with open(os.path.join(results_dir, chunk_key)) as f:
+                lines.extend(line for line in f.read().splitlines() if line)
+        self.assertTrue(chunk_keys)
+        self.assertEqual([line for line in lines if line != ','.join(page_viewed_columns)], [
+            'page_viewed,2024-09-02T18:20:33Z,student@example.com,1001,2001,3001,4001,page-guid-123,1'
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
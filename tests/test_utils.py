@@ -1,7 +1,8 @@
+import os
 import unittest
 from unittest.mock import Mock, patch, MagicMock
-from dataset.utils import encode_array, encode_json, parallel_map, serial_map, prune_fields, guarentee_int
-from tests.test_data import create_mock_spark_context, SAMPLE_CONTEXT
+from dataset.utils import broadcast_context, resolve_context, process_partition_keys, encode_array, encode_json, task_partitions, parallel_map, parallel_map_batches, sorted_groups, parallel_write, distribute_keys, serial_map, prune_fields, guarentee_int
+from tests.test_data import create_mock_spark_context, LocalRDD, SAMPLE_CONTEXT
 
 class TestUtils(unittest.TestCase):
 
@@ -41,6 +42,132 @@ class TestUtils(unittest.TestCase):
         mock_sc.parallelize.assert_called_once()
         self.assertIsInstance(result, list)
 
+    def test_parallel_write(self):
+        partitions = [[("test-bucket", "key1")], [("test-bucket", "key2"), ("test-bucket", "key3")]]
+        bucket_keys = Mock()
+        bucket_keys.mapPartitionsWithIndex.side_effect = lambda func: Mock(collect=lambda: [
+            result for index, keys in enumerate(partitions) for result in func(index, iter(keys))
+        ])
+
+        def mock_map_func(key, context, columns):
+            return [[key[1], "a"], [key[1], "b"]]
+
+        def write_chunk(partition_index, rows):
+            return {"key": f"job/chunk_{partition_index}.csv", "rows": len(rows)}
+
+        result = parallel_write(bucket_keys, mock_map_func, SAMPLE_CONTEXT, [], write_chunk)
+
+        self.assertEqual(result, [{"key": "job/chunk_0.csv", "rows": 2}, {"key": "job/chunk_1.csv", "rows": 4}])
+
+    def test_task_partitions(self):
+        # Without sizes, one partition per core, but no more than there are keys
+        self.assertEqual(task_partitions(20, None, 8, 100), 8)
+        self.assertEqual(task_partitions(5, None, 8, 100), 5)
+
+        # With sizes, enough partitions to hold about the target bytes each
+        self.assertEqual(task_partitions(20000, 2500, 8, 100), 25)
+        self.assertEqual(task_partitions(20000, 100, 8, 100), 8)
+        self.assertEqual(task_partitions(10, 2500, 8, 100), 10)
+        self.assertEqual(task_partitions(0, None, 8, 100), 1)
+
+    def test_parallel_map_sizes_partitions(self):
+        mock_sc = create_mock_spark_context()
+        mock_sc.defaultParallelism = 2
+        context = {**SAMPLE_CONTEXT, "target_task_bytes": 100}
+
+        parallel_map(mock_sc, "test-bucket", ["key1", "key2", "key3", "key4"], Mock(return_value=[]), context, [], total_bytes=300)
+
+        mock_sc.parallelize.assert_called_once_with([("test-bucket", f"key{i}") for i in range(1, 5)], 3)
+
+    def test_parallel_map_batches_rows(self):
+        partitions = [[("test-bucket", "key1")], [], [("test-bucket", "key2")]]
+        mock_sc = Mock()
+        mock_sc.parallelize.return_value.mapPartitions.side_effect = lambda func: Mock(collect=lambda: [
+            result for keys in partitions for result in func(iter(keys))
+        ])
+
+        def mock_map_func(key, context, columns):
+            return [[key[1], 1, None]]
+
+        table = parallel_map_batches(mock_sc, "test-bucket", ["key1", "key2"], mock_map_func, SAMPLE_CONTEXT, [],
+                                     column_names=["key", "count", "empty"], num_partitions=3)
+
+        self.assertEqual(table.column_names, ["key", "count", "empty"])
+        self.assertEqual(table.to_pydict(), {"key": ["key1", "key2"], "count": ["1", "1"], "empty": [None, None]})
+        mock_sc.parallelize.assert_called_once_with([("test-bucket", "key1"), ("test-bucket", "key2")], 3)
+
+    @patch.dict(os.environ, {"PYTHONHASHSEED": "0"})
+    def test_sorted_groups(self):
+        records = LocalRDD([
+            [{"session": "b", "n": 2}, {"session": "a", "n": 3}],
+            [{"session": "a", "n": 1}, {"session": "b", "n": 1}, {"session": "c", "n": 5}],
+        ])
+
+        groups = dict(sorted_groups(records, lambda r: r["session"], lambda r: r["n"], num_partitions=2).collect())
+
+        self.assertEqual(groups, {
+            "a": [{"session": "a", "n": 1}, {"session": "a", "n": 3}],
+            "b": [{"session": "b", "n": 1}, {"session": "b", "n": 2}],
+            "c": [{"session": "c", "n": 5}],
+        })
+
+    def test_distribute_keys(self):
+        mock_sc = Mock()
+        distribute_keys(mock_sc, "test-bucket", [["key1", "key2"], ["key3"]])
+
+        mock_sc.parallelize.assert_called_once_with(
+            [[("test-bucket", "key1"), ("test-bucket", "key2")], [("test-bucket", "key3")]], 2
+        )
+
+    def test_distribute_keys_without_keys(self):
+        mock_sc = Mock()
+        result = distribute_keys(mock_sc, "test-bucket", [])
+
+        # No partitions at all, so no empty chunk gets written
+        self.assertIs(result, mock_sc.emptyRDD.return_value)
+        mock_sc.parallelize.assert_not_called()
+
+    def test_broadcast_context(self):
+        mock_sc = Mock()
+        mock_sc.broadcast.side_effect = lambda value: Mock(value=value)
+        context = {**SAMPLE_CONTEXT, 'lookup': {'users': {'1': {'email': 'a@b.c'}}}}
+
+        task_context = broadcast_context(mock_sc, context)
+
+        self.assertNotIn('lookup', task_context)
+        mock_sc.broadcast.assert_called_once_with(context['lookup'])
+        self.assertEqual(resolve_context(task_context)['lookup'], context['lookup'])
+        self.assertIs(resolve_context(context), context)
+
+    def test_parallel_map_resolves_broadcast_lookup(self):
+        mock_sc = Mock()
+        mock_sc.parallelize.side_effect = lambda keys: Mock(flatMap=lambda func: Mock(collect=lambda: [r for k in keys for r in func(k)]))
+        lookup_broadcast = Mock(value={'users': {}})
+
+        result = parallel_map(mock_sc, "test-bucket", ["key1"], lambda key, context, columns: [context['lookup']],
+                              {'lookup_broadcast': lookup_broadcast}, [])
+
+        self.assertEqual(result, [{'users': {}}])
+
+    @patch('boto3.client')
+    def test_process_partition_keys_with_partition_handlers(self, mock_boto_client):
+        context = {**SAMPLE_CONTEXT, 'partition_handlers': True, 'lookup_broadcast': Mock(value={'users': {}})}
+        seen = []
+
+        def mock_map_func(key, context, columns, s3_client=None):
+            seen.append((s3_client, context['ignored_student_ids'], context['lookup']))
+            return [key[1]]
+
+        keys = [("test-bucket", "key1"), ("test-bucket", "key2")]
+        result = list(process_partition_keys(mock_map_func, context, [], iter(keys)))
+
+        # One client and one compiled context are shared by every key of the partition
+        self.assertEqual(result, ["key1", "key2"])
+        self.assertEqual(mock_boto_client.call_count, 1)
+        self.assertIs(seen[0][0], seen[1][0])
+        self.assertIsInstance(seen[0][1], frozenset)
+        self.assertEqual(seen[0][2], {'users': {}})
+
     def test_serial_map(self):
         bucket_name = "test-bucket"
         keys = ["key1", "key2"]